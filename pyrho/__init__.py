@@ -71,36 +71,38 @@ if __name__ == '__main__':
 # TODO Move everything except imports elsewhere
 
 
-def runAll(listOfModels=[6], simList=['Python']):
+def runAll(listOfModels=[6], simList=['Python'], workers=None, plot=True, verbose=config.verbose):
     """
-    Run all protocols (with Python) on a list of models with default parameters.
+    Run all protocols on a list of models with default parameters.
 
     Parameters
     ----------
     listOfModels : int, str, list
         Individual or list of integers or strings specifying the models to run
         e.g. [3, 4, 6], 3, '4', ['4', '6'], modelList
-    
+    simList : list
+        Simulators to run each protocol with e.g. ['Python', 'NEURON']
+    workers : int, optional
+        Number of processes to run the protocols in (default: serial for small
+        batteries, otherwise the number of CPUs; see protocols.runBattery)
+    plot : bool, optional
+        Plot each protocol once they have all finished (default=True)
+
+    Returns
+    -------
+    BatteryReport
+        The results matrix and the wall time, solver calls and memory of each
+        (model, protocol, simulator) run (see protocols.runBattery).
     """
 
     if not isinstance(listOfModels, (list, tuple)):
         listOfModels = [listOfModels] # ints or strs
     listOfModels = [str(m) for m in listOfModels]
 
-    for model in listOfModels:
-        ### Select generative model
-        RhO = models[model]()
-        for prot in protocols:
-            ### Select simulation protocol
-            Prot = protocols[prot]()
-            for sim in simList: #['Python']:#simulators:
-                Sim = simulators[sim](Prot, RhO)
-                print("\nRunning Protocol '{}' on the {}-state model...".format(prot, model))
-                print(_DASH_LINE, '\n')
-                Sim.run()
-                Sim.plot()
-                print("\nFinished!")
-                print(_DOUB_DASH_LINE, '\n\n')
+    report = runBattery(listOfModels, list(protocols), simList, workers=workers, plot=plot, verbose=verbose)
+    if verbose > 0:
+        print(report)
+    return report
 
 
 def printVersions():
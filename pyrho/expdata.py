@@ -11,11 +11,12 @@ import scipy.io as sio # Use for Matlab files < v7.3
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 
-from pyrho.utilities import getIndex, times2cycles, setCrossAxes, round_sig, plotLight
+from pyrho.utilities import getIndex, times2cycles, setCrossAxes, round_sig, plotLight, solveAmplitude
 from pyrho.config import check_package
 from pyrho import config
 
-__all__ = ['PhotoCurrent', 'ProtocolData']
+__all__ = ['PhotoCurrent', 'StreamingPhotoCurrent', 'ProtocolData', 'extractFeatures',
+           'MovingAverage', 'LowPass', 'Notch', 'Despike', 'Decimate', 'Resample']
 
 
 # TODO: Import/Export from/to python electrophysiology modules
@@ -150,11 +151,13 @@ class PhotoCurrent(object):
             tdiff = self.t[1:] - self.t[:-1]
             self.dt = tdiff.sum()/len(tdiff)    # (Average) step size
             self.sr = 1000/(self.dt)            # Sampling rate [samples/s]
+            self.uniform = _isUniform(self.t)   # False for adaptive time grids
         elif len(t) == 1:                       # Assume time step is passed rather than time array
             assert(t > 0)
             self.t = np.array(t*range(len(I)))
             self.dt = t                         # Step size
             self.sr = 1000/t                    # Sampling rate [samples/s]
+            self.uniform = True
         else:
             raise ValueError("Dimension mismatch: |t|={}; |I|={}. t must be either an array of the same length as I or a scalar defining the timestep!".format(len(t), len(I)))
 
@@ -166,7 +169,7 @@ class PhotoCurrent(object):
         if stimuli is not None:
             # TODO: Remove stimuli and make it equivalent to t i.e. float or array
             # Expect nStimuli x nSamples row vectors
-            self.stimuli = np.copy(stimuli)
+            self.stimuli = np.asarray(stimuli) # Not copied so trials can share one (read-only) array
             ndim = self.stimuli.ndim
             shape = self.stimuli.shape
             if ndim == 1:
@@ -261,6 +264,22 @@ class PhotoCurrent(object):
 
 
         ### Derive properties from the data
+        self._setFeatures()
+
+        # Align t_0 to the start of the first pulse
+        self.pulseAligned = False
+        self.alignPoint = 0
+        self.p0 = None
+        self.alignToPulse()
+
+        #self.findKinetics()
+
+        if config.verbose > 1:
+            print("Photocurrent data loaded! nPulses={}; Total time={}ms; Range={}nA".format(self.nPulses, self.totT, str(self.range_)))
+
+
+    def _setFeatures(self):
+        """Derive the features (on/off currents, range, peaks, lags and steady-states) from the data"""
         self.on_ = np.array([self.I[pInd[0]] for pInd in self.pulseInds])     # Current at t_on[:]
         self.off_ = np.array([self.I[pInd[1]] for pInd in self.pulseInds])    # Current at t_off[:]
 
@@ -297,17 +316,6 @@ class PhotoCurrent(object):
         else:
             self.type = 'inhibitory' # Hyperpolarising
 
-        # Align t_0 to the start of the first pulse
-        self.pulseAligned = False
-        self.alignPoint = 0
-        self.p0 = None
-        self.alignToPulse()
-
-        #self.findKinetics()
-
-        if config.verbose > 1:
-            print("Photocurrent data loaded! nPulses={}; Total time={}ms; Range={}nA".format(self.nPulses, self.totT, str(self.range_)))
-
 
     def __len__(self):
         return self.totT
@@ -349,13 +357,13 @@ class PhotoCurrent(object):
             df[self.stateLabels] = self.states #.T?
         if self.stimuli is not None:
             df['stimuli'] = self.stimuli # TODO: Check this works with matrices
-        if self.isFiltered:
+        if self.isFiltered and len(self.Iorig) == self.nSamples:
             df['Iorig'] = self.Iorig
         return df
 
 
     #TODO: Finish this - avoid circular imports or move to fitting.py!
-    def fitKinetics(self, p=0, method='powell'): # trim=0.1, # defMethod
+    def fitKinetics(self, p=0, method='powell', varPro=True): # trim=0.1, # defMethod
         r"""
         Fit exponentials to a photocurrent to find time constants of kinetics.
 
@@ -370,6 +378,9 @@ class PhotoCurrent(object):
             Specify which pulse to use (default=0) ``0 <= p < nPulses``.
         method : str
             Optimisation method (default=defMethod)
+        varPro : bool
+            Solve the (linear) amplitudes in closed form so that the optimiser
+            only searches the time constants (default=True).
         """
 
         def calcOn(p, t):
@@ -391,6 +402,41 @@ class PhotoCurrent(object):
         def residOff(p, I, t):
             return I - calcOff(p, t)
 
+        # Variable projection: each amplitude is determined by the rates
+        # (and the constraints on the amplitudes) so is solved in closed form
+        def solveOn(p, I, t):
+            v = p.valuesdict()
+            eAct, eDeact = np.exp(-t/v['tau_act']), np.exp(-t/v['tau_deact'])
+            # I = Iss*(1-eDeact) + a_act*(eDeact-eAct) with a_deact = a_act - Iss
+            aMin = max(p['a_act'].min, p['a_deact'].min + Iss)
+            aMax = min(p['a_act'].max, p['a_deact'].max + Iss)
+            p['a_act'].value = solveAmplitude(I, Iss*(1-eDeact), eDeact-eAct, aMin, aMax)
+            return p
+
+        def solveOffs(p, I, t):
+            e1 = np.exp(-p['Gd1'].value*t)
+            # I = Iss*e1 + a0*(1-e1) with a1 = Iss - a0
+            p['a0'].value = solveAmplitude(I, Iss*e1, 1-e1, p['a0'].min, p['a0'].max)
+            return p
+
+        def solveOffd(p, I, t):
+            e1, e2 = np.exp(-p['Gd1'].value*t), np.exp(-p['Gd2'].value*t)
+            # I = Iss*e2 + a1*(e1-e2) with a0 = 0 and a2 = Iss - a1
+            aMin = max(p['a1'].min, Iss - p['a2'].max)
+            aMax = min(p['a1'].max, Iss - p['a2'].min)
+            p['a1'].value = solveAmplitude(I, Iss*e2, e1-e2, aMin, aMax)
+            return p
+
+        def fitSeparable(resid, solve, params, amp, I, t):
+            """Minimise over the rates only, solving the amplitude at each step"""
+            if not varPro:
+                return minimize(resid, params, args=(I, t), method=method)
+            params[amp].vary = False
+            minRes = minimize(lambda p, I, t: resid(solve(p, I, t), I, t),
+                              params, args=(I, t), method=method)
+            solve(minRes.params, I, t) # Amplitude for the final rates
+            return minRes
+
 
         plt.figure()
         self.plot()
@@ -431,7 +477,7 @@ class PhotoCurrent(object):
             # return I - biExpSum(t, **p.valuesdict())#v['a_act'], v['tau_act'], v['a_deact'], v['tau_deact'], v['a0'])
         # minRes = minimize(residBiExpSum, pOn, args=(Ion,ton), method=method)
 
-        minRes = minimize(residOn, pOn, args=(Ion, ton), method=method)
+        minRes = fitSeparable(residOn, solveOn, pOn, 'a_act', Ion, ton)
 
         fpOn = minRes.params #pOn
         v = fpOn.valuesdict()
@@ -470,7 +516,7 @@ class PhotoCurrent(object):
         pOffs.add('Gd2', value=0, min=0, max=1e3, vary=False) #, expr='Gd1')#, min=1e-9)
         pOffs.add('a2', value=0, min=-1e-9, max=1e-9, vary=False)
 
-        minRes = minimize(residOff, pOffs, args=(Ioff, toff-toff[0]), method=method)
+        minRes = fitSeparable(residOff, solveOffs, pOffs, 'a0', Ioff, toff-toff[0])
         fpOffs = minRes.params #pOff
         print('tau_{{off}} = {:.3g}'.format(1/fpOffs['Gd1'].value))
         if config.verbose > 1:
@@ -492,7 +538,7 @@ class PhotoCurrent(object):
         pOffd.add('Gd1', value=0.1, min=1e-9, max=1e3)
         pOffd.add('Gd2', value=0.01, min=1e-9, max=1e3)#, vary=True) #, expr='Gd1')#, min=1e-9)
 
-        minRes = minimize(residOff, pOffd, args=(Ioff, toff-toff[0]), method=method)
+        minRes = fitSeparable(residOff, solveOffd, pOffd, 'a1', Ioff, toff-toff[0])
         fpOffd = minRes.params #pOff
         print('tau_{{off1}} = {:.3g}, tau_{{off2}} = {:.3g}'.format(1/fpOffd['Gd1'].value, 1/fpOffd['Gd2'].value))
         if config.verbose > 1:
@@ -706,9 +752,13 @@ class PhotoCurrent(object):
         #    return None
 
         Ion, ton = self.getOnPhase(pulse)
+        uniform = getattr(self, 'uniform', True) # Older pickles predate non-uniform grids
 
         # Calculate step change (or gradient with t[1:] - t[:-1])
-        cutInd = max(2, int(round(tail*len(Ion)))) # Need at least 2 points to calculate the difference
+        if uniform:
+            cutInd = max(2, int(round(tail*len(Ion)))) # Need at least 2 points to calculate the difference
+        else: # Take the last tail proportion of the on-phase duration rather than of the samples
+            cutInd = max(2, len(ton) - np.searchsorted(ton, ton[-1] - tail*(ton[-1]-ton[0])))
         if cutInd < 5: # On-phase is too short
             warnings.warn('Duration Warning: The on-phase is too short for steady-state convergence!')
             #return None
@@ -722,7 +772,10 @@ class PhotoCurrent(object):
 
         if method == 0: # Empirical: Calculate Steady-state as the mean of the last 5% of the On phase
 
-            Iss = np.mean(Ion[-cutInd:])
+            if uniform:
+                Iss = np.mean(Ion[-cutInd:])
+            else: # Time-weighted mean
+                Iss = np.trapz(Ion[-cutInd:], ton[-cutInd:]) / (ton[-1] - ton[-cutInd])
 
             # Calculate Steady-state as the mean of the last 50ms of the On phase
             #tFromOffInd = np.searchsorted(t,t[offInd]-window,side="left")
@@ -1167,19 +1220,491 @@ class PhotoCurrent(object):
         Pass frequency bands to filter out
         t_window    := Time window [ms] over which to calculate the moving average
         """
+        self.filter([MovingAverage(t_window)])
+
+
+    def filter(self, filters, update=True):
+        """
+        Apply a pipeline of filters to the photocurrent.
 
-        if not self.isFiltered:
-            self.Iorig = np.copy(self.I) # TODO: Put in __init__
+        Parameters
+        ----------
+        filters : list
+            Filters applied in order e.g. [Despike(), Notch(50), LowPass(1000), Decimate(4)].
+            Each is called with (I, t) and returns the filtered (I, t).
+        update : bool, optional
+            Recompute the derived features (peaks, steady-states etc.) once the
+            pipeline is complete (default=True). Pass False when filtering in
+            stages and update on the last one.
+        """
+
+        if not isinstance(filters, (list, tuple)):
+            filters = [filters]
+        if not getattr(self, 'isFiltered', False): # The unfiltered arrays are kept rather than copied
+            self.Iorig = self.I
+            self.torig = self.t
             self.isFiltered = True
-            I = self.Iorig
         else:
-            self.Iprev = np.copy(self.I)
-            I = self.Iprev
+            self.Iprev = self.I
+
+        I, t = self.I, self.t
+        for filt in filters:
+            I, t = filt(I, t)
+
+        if len(t) != self.nSamples: # Resampled e.g. decimated
+            if getattr(self, 'stimuli', None) is not None: # Older pickles may lack these
+                self.stimuli = np.array([np.interp(t, self.t, stim) for stim in np.atleast_2d(self.stimuli)]).reshape(-1, len(t)).squeeze()
+            if getattr(self, 'synthetic', False):
+                self.states = np.column_stack([np.interp(t, self.t, state) for state in self.states.T])
+            self.nSamples = len(I)
+            self.dt = (t[-1] - t[0]) / (len(t) - 1)
+            self.sr = 1000/(self.dt)
+            self.uniform = _isUniform(t)
+            self.pulseInds = np.array([np.searchsorted(t, self.pulses[p, :]) for p in range(self.nPulses)], dtype=int)
+        self.I, self.t = I, t
+
+        if update:
+            self._setFeatures()
+
+
+
+def _isUniform(t, rtol=1e-3):
+    """Check whether a time series is evenly sampled (to within rtol of the mean step)"""
+    tdiff = np.diff(t)
+    return bool(np.ptp(tdiff) <= rtol * abs(tdiff.mean())) if len(tdiff) else True
+
+
+def _getFs(t):
+    """Sampling rate [Hz] of a time series in ms"""
+    if not _isUniform(t):
+        raise ValueError("Filters require uniformly sampled data: resample the non-uniform time series first e.g. with Resample(dt)!")
+    return 1000 * (len(t) - 1) / (t[-1] - t[0])
+
+
+class Resample(object):
+    """
+    Linearly interpolate onto a uniform grid with step dt [ms] e.g. to filter
+    photocurrents simulated on an adaptive time grid.
+    """
+
+    def __init__(self, dt):
+        self.dt = dt
+
+    def __call__(self, I, t):
+        tNew = np.linspace(t[0], t[-1], int(round((t[-1]-t[0])/self.dt))+1, endpoint=True)
+        return np.interp(tNew, t, I), tNew
+
+
+class MovingAverage(object):
+    """
+    Centred moving average over a time window [ms] computed with a running
+    sum in O(n) (equivalent to ``np.convolve(I, np.ones(n)/n, mode='same')``).
+    """
+
+    def __init__(self, t_window=1):
+        self.t_window = t_window
+
+    def __call__(self, I, t):
+        nPoints = max(1, int(round(self.t_window * _getFs(t) / 1000)))
+        n = len(I)
+        cs = np.r_[0, np.cumsum(I)]
+        inds = np.arange(n)
+        hi = np.minimum(inds + (nPoints-1)//2 + 1, n)
+        lo = np.maximum(inds - nPoints//2, 0)
+        return (cs[hi] - cs[lo]) / nPoints, t
+
+
+class LowPass(object):
+    """Zero-phase Butterworth low-pass filter with a cutoff frequency [Hz]"""
+
+    def __init__(self, cutoff, order=4):
+        self.cutoff = cutoff
+        self.order = order
+        self._sos = {} # Coefficients cached by sampling rate
+
+    def __call__(self, I, t):
+        from scipy.signal import butter, sosfiltfilt
+        fs = round(_getFs(t), 6)
+        if fs not in self._sos:
+            self._sos[fs] = butter(self.order, self.cutoff, btype='low', fs=fs, output='sos')
+        return sosfiltfilt(self._sos[fs], I), t
+
+
+class Notch(object):
+    """Zero-phase IIR notch filter to remove e.g. mains interference at freq [Hz] with quality factor Q"""
+
+    def __init__(self, freq=50, Q=30):
+        self.freq = freq
+        self.Q = Q
+        self._ba = {} # Coefficients cached by sampling rate
+
+    def __call__(self, I, t):
+        from scipy.signal import iirnotch, filtfilt
+        fs = round(_getFs(t), 6)
+        if fs not in self._ba:
+            self._ba[fs] = iirnotch(self.freq, self.Q, fs=fs)
+        b, a = self._ba[fs]
+        return filtfilt(b, a, I), t
+
+
+class Despike(object):
+    """
+    Replace spikes (samples deviating from the running median over t_window [ms]
+    by more than threshold times the median absolute deviation) with the median.
+    """
+
+    def __init__(self, t_window=0.5, threshold=5):
+        self.t_window = t_window
+        self.threshold = threshold
+
+    def __call__(self, I, t):
+        from scipy.ndimage import median_filter
+        nPoints = max(3, int(round(self.t_window * _getFs(t) / 1000)) | 1) # Odd
+        Imed = median_filter(I, size=nPoints, mode='nearest')
+        dev = np.abs(I - Imed)
+        mad = np.median(dev)
+        if mad == 0:
+            return I, t
+        return np.where(dev > self.threshold * 1.4826 * mad, Imed, I), t
+
+
+class Decimate(object):
+    """Downsample by an integer factor after a zero-phase anti-aliasing filter"""
+
+    def __init__(self, factor):
+        self.factor = int(factor)
+
+    def __call__(self, I, t):
+        if self.factor <= 1:
+            return I, t
+        from scipy.signal import decimate
+        return decimate(I, self.factor, ftype='iir', zero_phase=True), t[::self.factor]
+
+
+class StreamingPhotoCurrent(object):
+    """
+    Photocurrent built incrementally from chunks of samples during acquisition.
+
+    The stimulation protocol (pulses, phi, V) is known in advance so the
+    features are updated as each chunk arrives in time proportional to the
+    chunk: the offset calibration (from the delay phase), the current at the
+    start and end of each pulse, the peak of each pulse cycle and the steady-
+    state current of each on-phase. Samples are kept in growing buffers with a
+    running sum so that window means cost O(1). Until the first pulse starts,
+    ``offset_`` is the running mean of the delay phase. As in PhotoCurrent, the
+    features are corrected by the offset if it is more than 1% of the current
+    span (so far). Call ``finish`` at the end of the sweep to obtain a regular
+    PhotoCurrent (with its features recomputed from the complete trace).
+
+    Parameters
+    ----------
+    pulses : array, shape = [n_pulses, 2]
+        Pairs of time points describing the beginning and end of stimulation.
+    phi : float
+        Stimulating flux (max) [ph*mm^-2*s^-1].
+    V : float or ``None``
+        Voltage clamp potential [mV] or ``None`` if no clamp was used.
+    dt : float, optional
+        Sampling time step [ms] if chunks are appended without time points.
+    begT : float, optional
+        Time of the first sample [ms] if chunks are appended without time points (default=0).
+    tail : float, optional
+        Proportion of each on-phase to average over for the steady-state current (default=0.05).
+    label : str, optional
+        Optional trial label passed to the PhotoCurrent.
+    """
+
+    def __init__(self, pulses, phi, V, dt=None, begT=0, tail=0.05, label=None, capacity=4096):
+        self.pulses = np.array(pulses, dtype=float)
+        self.nPulses = self.pulses.shape[0]
+        self.phi = phi
+        self.V = V
+        self.dt = dt
+        self.begT = begT
+        self.tail = tail
+        self.label = label
+        self.overlap = int(PhotoCurrent.overlap)
+
+        self.nSamples = 0
+        self._I = np.empty(capacity)
+        self._t = np.empty(capacity)
+        self._cs = np.zeros(capacity + 1) # Running sum of I: _cs[n] = sum(I[:n])
+
+        self.offset_ = 0.
+        self.range_ = [np.inf, -np.inf]
+        self.pulseInds = -np.ones((self.nPulses, 2), dtype=int) # Filled as the pulses are reached
+        self.peakInds_ = -np.ones(self.nPulses, dtype=int)
+        # Uncorrected features (see the properties for the offset-corrected values)
+        self._on = np.full(self.nPulses, np.nan)
+        self._off = np.full(self.nPulses, np.nan)
+        self._peaks = np.full(self.nPulses, np.nan)
+        self._sss = np.full(self.nPulses, np.nan)
+        self._scanned = np.zeros(self.nPulses, dtype=int) # Next sample to scan for each cycle's peak
+
+    @property
+    def I(self):
+        """Samples acquired so far (uncorrected view)"""
+        return self._I[:self.nSamples]
+
+    @property
+    def t(self):
+        """Time points acquired so far (view)"""
+        return self._t[:self.nSamples]
+
+    @property
+    def calibration(self):
+        """The offset subtracted from the features (0 unless it is more than 1% of the span)"""
+        span = self.range_[1] - self.range_[0]
+        return self.offset_ if abs(self.offset_) > 0.01 * abs(span) else 0.
+
+    @property
+    def on_(self):
+        return self._on - self.calibration
+
+    @property
+    def off_(self):
+        return self._off - self.calibration
+
+    @property
+    def peaks_(self):
+        return self._peaks - self.calibration
+
+    @property
+    def sss_(self):
+        return self._sss - self.calibration
+
+    @property
+    def tpeaks_(self):
+        return np.where(self.peakInds_ >= 0, self._t[np.maximum(self.peakInds_, 0)], np.nan)
+
+    @property
+    def lags_(self):
+        return self.tpeaks_ - self.pulses[:, 0]
+
+    @property
+    def pulse(self):
+        """Index of the latest pulse to have started (-1 during the delay phase)"""
+        return int(np.sum(self.pulseInds[:, 0] >= 0)) - 1
+
+    def _reserve(self, n):
+        """Grow the buffers (by doubling) to hold n samples"""
+        capacity = len(self._I)
+        if n <= capacity:
+            return
+        while capacity < n:
+            capacity *= 2
+        for name in ['_I', '_t']:
+            buffer = np.empty(capacity)
+            buffer[:self.nSamples] = getattr(self, name)[:self.nSamples]
+            setattr(self, name, buffer)
+        cs = np.zeros(capacity + 1)
+        cs[:self.nSamples+1] = self._cs[:self.nSamples+1]
+        self._cs = cs
+
+    def _mean(self, start, stop):
+        """Mean of the raw samples I[start:stop]"""
+        return (self._cs[stop] - self._cs[start]) / (stop - start)
+
+    def append(self, I, t=None):
+        """
+        Append a chunk of samples and update the features.
+
+        Parameters
+        ----------
+        I : array
+            Photocurrent samples [nA].
+        t : array, optional
+            Corresponding time points [ms]. If omitted they continue from the
+            last sample in steps of ``dt``.
+
+        Returns
+        -------
+        StreamingPhotoCurrent
+            self (for chaining)
+        """
+        I = np.asarray(I, dtype=float).ravel()
+        n = len(I)
+        if n == 0:
+            return self
+        if t is None:
+            if self.dt is None:
+                raise ValueError("Time points must be given unless dt was specified!")
+            t0 = self._t[self.nSamples-1] + self.dt if self.nSamples > 0 else self.begT
+            t = t0 + self.dt * np.arange(n)
+        else:
+            t = np.asarray(t, dtype=float).ravel()
+            if len(t) != n:
+                raise ValueError("Dimension mismatch: |t|={}; |I|={}".format(len(t), n))
+
+        start, stop = self.nSamples, self.nSamples + n
+        self._reserve(stop)
+        self._I[start:stop] = I
+        self._t[start:stop] = t
+        self._cs[start+1:stop+1] = self._cs[start] + np.cumsum(I)
+        self.nSamples = stop
+        self.range_ = [min(self.range_[0], I.min()), max(self.range_[1], I.max())]
+
+        # Locate the pulse boundaries reached in this chunk (first sample at or after each time)
+        for p in range(self.nPulses):
+            for edge in range(2):
+                if self.pulseInds[p, edge] < 0 and t[-1] >= self.pulses[p, edge]:
+                    self.pulseInds[p, edge] = start + np.searchsorted(t, self.pulses[p, edge])
+
+        # Offset calibration from the first 90% of the delay phase (c.f. PhotoCurrent)
+        onInd0 = self.pulseInds[0, 0]
+        if onInd0 < 0:
+            self.offset_ = self._mean(0, stop)
+        elif onInd0 >= start: # The first pulse started in this chunk
+            nDel = onInd0 + self.overlap
+            self.offset_ = self._mean(0, min(int(round(0.9*nDel)) + 1, nDel))
+
+        for p in range(self.pulse + 1):
+            onInd, offInd = self.pulseInds[p]
+            if onInd >= start:
+                self._on[p] = self._I[onInd]
+            if start <= offInd < stop:
+                self._off[p] = self._I[offInd]
+
+            # Peaks: scan the new samples of the cycle (up to and including the start of the next pulse)
+            nextOn = self.pulseInds[p+1, 0] if p+1 < self.nPulses else -1
+            cycleStop = nextOn + self.overlap if nextOn >= 0 else stop
+            scanStart = max(onInd, self._scanned[p])
+            scanStop = min(cycleStop, stop)
+            if scanStop > scanStart:
+                calibration = self.calibration
+                Iabs = np.abs(self._I[scanStart:scanStop] - calibration)
+                ind = np.argmax(Iabs)
+                if self.peakInds_[p] < 0 or Iabs[ind] > abs(self._peaks[p] - calibration):
+                    self.peakInds_[p] = scanStart + ind
+                    self._peaks[p] = self._I[scanStart + ind]
+                self._scanned[p] = scanStop
+
+            # Steady-state: mean of the last tail proportion of the on-phase (so far)
+            if offInd >= 0:
+                if offInd >= start or np.isnan(self._sss[p]):
+                    onStop = min(offInd + self.overlap, stop)
+                    cutInd = min(max(2, int(round(self.tail * (onStop - onInd)))), onStop - onInd)
+                    self._sss[p] = self._mean(onStop - cutInd, onStop)
+            else:
+                dt = self.dt if self.dt is not None else (self._t[stop-1] - self._t[0]) / max(1, stop-1)
+                nOn = int(round((self.pulses[p, 1] - self.pulses[p, 0]) / dt)) + self.overlap # Expected length
+                cutInd = min(max(2, int(round(self.tail * nOn))), stop - onInd)
+                self._sss[p] = self._mean(stop - cutInd, stop)
+
+        return self
 
-        # Moving average
-        nPoints = int(round(t_window/self.dt))
-        self.I = np.convolve(I, np.ones(nPoints)/nPoints, mode='same')
+    def __len__(self):
+        return self.nSamples
+
+    def __str__(self):
+        return 'Streaming photocurrent: {} samples over {:.3g} ms; {} of {} pulses started; {:.3g} ph/s/mm^2'.format(
+                self.nSamples, self._t[self.nSamples-1] - self._t[0] if self.nSamples else 0, self.pulse+1, self.nPulses, self.phi)
 
+    def finish(self, stimuli=None, states=None, stateLabels=None):
+        """Return the completed sweep as a PhotoCurrent"""
+        return PhotoCurrent(self.I, self.t, self.pulses, self.phi, self.V, stimuli=stimuli,
+                            states=states, stateLabels=stateLabels, label=self.label)
+
+
+def extractFeatures(photocurrents, tail=0.05, chunkSize=2**18):
+    """
+    Compute the features of every pulse of a list of PhotoCurrents in one pass.
+
+    The traces are stacked into arrays of about chunkSize samples and the
+    features of all their pulses are found with segmented reductions rather
+    than per-trial loops.
+    The results match the PhotoCurrent attributes (``on_``, ``off_``,
+    ``peakInds_``, ``tpeaks_``, ``peaks_``, ``lags_`` and ``sss_`` from
+    ``findSteadyState(method=0)``), including the time-weighted steady-states
+    of trials sampled on non-uniform (adaptive) time grids.
+
+    Parameters
+    ----------
+    photocurrents : list[PhotoCurrent]
+        The photocurrents to extract features from.
+    tail : float, optional
+        Proportion of each on-phase to average over for the steady-state current (default=0.05).
+    chunkSize : int, optional
+        Approximate number of samples stacked at once to bound memory (default=2**18).
+
+    Returns
+    -------
+    numpy.recarray
+        One record per pulse with the fields: trial (index into ``photocurrents``),
+        pulse, t_on, t_off, onD, Ion (current at t_on), Ioff (current at t_off),
+        peakInd, tpeak, Ipeak, lag (tpeak - t_on) and Iss.
+    """
+
+    chunks, chunk, nChunk = [], [], 0
+    for pc in photocurrents:
+        chunk.append(pc)
+        nChunk += pc.nSamples
+        if nChunk >= chunkSize:
+            chunks.append(chunk)
+            chunk, nChunk = [], 0
+    if chunk:
+        chunks.append(chunk)
+
+    features, nTrials = [], 0
+    for chunk in chunks:
+        chunkFeatures = _extractChunkFeatures(chunk, tail)
+        chunkFeatures.trial += nTrials
+        features.append(chunkFeatures)
+        nTrials += len(chunk)
+    return np.concatenate(features).view(np.recarray)
+
+
+def _extractChunkFeatures(photocurrents, tail):
+    """Compute the features of every pulse of a list of PhotoCurrents stacked into one array (see extractFeatures)"""
+
+    overlap = int(PhotoCurrent.overlap)
+    nPulses = np.array([pc.nPulses for pc in photocurrents], dtype=int)
+    nSamples = np.array([pc.nSamples for pc in photocurrents], dtype=int)
+    trialStarts = np.r_[0, np.cumsum(nSamples)[:-1]].astype(int)
+    I = np.concatenate([pc.I for pc in photocurrents] + [np.zeros(1)]) # Padded for segment ends
+    t = np.concatenate([pc.t for pc in photocurrents])
+
+    trial = np.repeat(np.arange(len(photocurrents)), nPulses)
+    pulse = np.concatenate([np.arange(n) for n in nPulses])
+    pulses = np.concatenate([pc.pulses for pc in photocurrents]).astype(float)
+    trialEnds = np.repeat(trialStarts + nSamples, nPulses)
+    pulseInds = np.concatenate([pc.pulseInds for pc in photocurrents]) + np.repeat(trialStarts, nPulses)[:,None]
+    onInds = pulseInds[:,0]
+    offInds = np.minimum(pulseInds[:,1], trialEnds - 1)
+
+    # Peaks: first index of the most extreme current in each cycle. Cycles run
+    # from the start of each pulse to the start of the next (inclusive) or the
+    # end of the trial so the segments between consecutive bounds are maximised
+    # and the overlapping sample at the start of the next pulse is compared after.
+    absI = np.abs(I)
+    bounds = np.union1d(np.union1d(onInds, trialStarts), [len(I) - 1])
+    boundMax = np.maximum.reduceat(absI, bounds)
+    seg = np.searchsorted(bounds, onInds)
+    segEnds = bounds[seg + 1]
+    nextOn = np.minimum(segEnds, len(I) - 1)
+    hasNext = np.r_[(onInds[1:] == segEnds[:-1]) & (trial[1:] == trial[:-1]), False] & (overlap > 0)
+    cycleMax = np.where(hasNext, np.maximum(boundMax[seg], absI[nextOn]), boundMax[seg])
+    maxPos = np.flatnonzero(absI == np.repeat(boundMax, np.diff(np.r_[bounds, len(I)])))
+    firstPos = maxPos[np.minimum(np.searchsorted(maxPos, onInds), len(maxPos) - 1)]
+    peakInds = np.where(cycleMax > boundMax[seg], nextOn, firstPos)
+
+    # Steady-states: mean of the last tail proportion of each on-phase
+    onStops = np.minimum(offInds + overlap, trialEnds)
+    onLengths = onStops - onInds
+    cutInds = np.minimum(np.maximum(2, np.round(tail * onLengths).astype(int)), onLengths)
+    if np.any(cutInds < 5):
+        warnings.warn('Duration Warning: The on-phase is too short for steady-state convergence!')
+    Iss = np.add.reduceat(I, np.ravel(np.column_stack((onStops - cutInds, onStops))))[::2] / cutInds
+    nonUniform = ~np.repeat([getattr(pc, 'uniform', True) for pc in photocurrents], nPulses)
+    for k in np.flatnonzero(nonUniform): # Time-weighted over the tail of the on-phase duration
+        Iss[k] = photocurrents[trial[k]].findSteadyState(pulse[k], tail)
+
+    tpeak = t[peakInds]
+    return np.rec.fromarrays([trial, pulse, pulses[:,0], pulses[:,1], pulses[:,1] - pulses[:,0],
+                              I[onInds], I[offInds], peakInds - np.repeat(trialStarts, nPulses),
+                              tpeak, I[peakInds], tpeak - pulses[:,0], Iss],
+                             names=['trial', 'pulse', 't_on', 't_off', 'onD', 'Ion', 'Ioff',
+                                    'peakInd', 'tpeak', 'Ipeak', 'lag', 'Iss'])
 
 
 class ProtocolData(object):
@@ -1591,6 +2116,79 @@ class ProtocolData(object):
         return # ax
 
 
+    def filter(self, filters, update=True):
+        """
+        Apply a pipeline of filters to every trial (see PhotoCurrent.filter).
+
+        The filter objects (and their cached coefficients) are shared by all
+        trials and the derived features of each trial are recomputed once
+        after the whole pipeline, along with the protocol's peak_ and ss_
+        containers (if present).
+        """
+        for run in range(self.nRuns):
+            for phiInd in range(self.nPhis):
+                for vInd in range(self.nVs):
+                    if self.trials[run][phiInd][vInd] is not None:
+                        self.trials[run][phiInd][vInd].filter(filters, update)
+
+        if update:
+            for feature in ['peak_', 'ss_']: # Filled by Protocol.storeTrial
+                if hasattr(self, feature):
+                    setattr(self, feature, [[[getattr(self.trials[run][phiInd][vInd], feature, None)
+                                              if self.trials[run][phiInd][vInd] is not None else None
+                                              for vInd in range(self.nVs)]
+                                             for phiInd in range(self.nPhis)]
+                                            for run in range(self.nRuns)])
+
+
+    def getFeatures(self, tail=0.05, asDataFrame=False, run=None, phiInd=None, vInd=None):
+        """
+        Return a table of the features of every pulse of every trial (see extractFeatures).
+
+        Parameters
+        ----------
+        tail : float, optional
+            Proportion of each on-phase to average over for the steady-state current (default=0.05).
+        asDataFrame : bool, optional
+            Return a pandas DataFrame indexed by (run, phi, V, pulse) instead of a record array (default=False).
+        run, phiInd, vInd : int, optional
+            Only extract the features of the trials with these indices (default=None: all trials).
+
+        Returns
+        -------
+        numpy.recarray or pandas.DataFrame
+            One record per pulse with the fields: run, phiInd, vInd, phi, V
+            (nan if unclamped) and the fields returned by extractFeatures.
+        """
+
+        runs = range(self.nRuns) if run is None else [run]
+        phiInds = range(self.nPhis) if phiInd is None else [phiInd]
+        vInds = range(self.nVs) if vInd is None else [vInd]
+        keys, photocurrents = [], []
+        for run in runs:
+            for phiInd in phiInds:
+                for vInd in vInds:
+                    if self.trials[run][phiInd][vInd] is not None: # Skip missing PhotoCurrents
+                        keys.append((run, phiInd, vInd))
+                        photocurrents.append(self.trials[run][phiInd][vInd])
+        features = extractFeatures(photocurrents, tail)
+        keys = np.array(keys, dtype=int)[features.trial]
+        phis = np.array([pc.phi for pc in photocurrents], dtype=float)[features.trial]
+        Vs = np.array([np.nan if pc.V is None else pc.V for pc in photocurrents], dtype=float)[features.trial]
+
+        table = np.rec.fromarrays([keys[:,0], keys[:,1], keys[:,2], phis, Vs]
+                                  + [features[name] for name in features.dtype.names if name != 'trial'],
+                                  names=['run', 'phiInd', 'vInd', 'phi', 'V']
+                                  + [name for name in features.dtype.names if name != 'trial'])
+        if asDataFrame:
+            if not check_package('pandas'):
+                warnings.warn('Pandas not found!')
+                return table
+            import pandas as pd
+            return pd.DataFrame(table).set_index(['run', 'phi', 'V', 'pulse'])
+        return table
+
+
     def getIpmax(self, vInd=None):
         """
         Find the maximum peak current for the whole data set.
@@ -1610,26 +2208,21 @@ class ProtocolData(object):
             Indexes of the most extreme value found (rmax, pmax, vmax)
         """
 
-        self.Ipmax_ = 0
-        if vInd is None:
-            for run in range(self.nRuns):
-                for phiInd in range(self.nPhis):
-                    for vInd in range(self.nVs):
-                        if abs(self.trials[run][phiInd][vInd].peak_) > abs(self.Ipmax_):
-                            self.Ipmax = self.trials[run][phiInd][vInd].peak_
-                            rmax = run
-                            pmax = phiInd
-                            vmax = vInd
-        else:
+        if vInd is not None:
             assert(vInd < self.nVs)
-            for run in range(self.nRuns):
-                for phiInd in range(self.nPhis):
-                    if abs(self.trials[run][phiInd][vInd].peak_) > abs(self.Ipmax_):
-                        self.Ipmax_ = self.trials[run][phiInd][vInd].peak_
-                        rmax = run
-                        pmax = phiInd
-                        vmax = vInd
-        return self.Ipmax_, (rmax, pmax, vmax)
+        features = self.getFeatures(vInd=vInd)
+        k = np.argmax(np.abs(features.Ipeak)) # The first of any equal peaks
+        self.Ipmax_ = features.Ipeak[k]
+        return self.Ipmax_, (int(features.run[k]), int(features.phiInd[k]), int(features.vInd[k]))
+
+    @staticmethod
+    def _trialPeaks(features):
+        """Return the feature records of the most extreme peak of each trial (the first pulse to reach it)"""
+        starts = np.flatnonzero(features.pulse == 0) # Records are grouped by trial
+        absPeaks = np.abs(features.Ipeak)
+        trialMax = np.repeat(np.maximum.reduceat(absPeaks, starts), np.diff(np.r_[starts, len(features)]))
+        maxInds = np.flatnonzero(absPeaks == trialMax)
+        return features[maxInds[np.searchsorted(maxInds, starts)]]
 
     # reduce(lambda a,b: a if (a > b) else b, list)
 
@@ -1645,24 +2238,21 @@ class ProtocolData(object):
             Nested lists of peak value times: nRuns x nPhis x nVs.
         """
         if self.nRuns > 1:
-            phiInd = 0
-            vInd = 0
-            self.IrunPeaks = [self.trials[run][phiInd][vInd].peak_ for run in range(self.nRuns)]
-            self.trunPeaks = [self.trials[run][phiInd][vInd].tpeak_ for run in range(self.nRuns)]
+            peaks = self._trialPeaks(self.getFeatures(phiInd=0, vInd=0))
+            self.IrunPeaks = list(peaks.Ipeak)
+            self.trunPeaks = list(peaks.tpeak)
             Ipeaks = self.IrunPeaks
             tpeaks = self.trunPeaks
         if self.nPhis > 1:
-            run = 0
-            vInd = 0
-            self.IphiPeaks = [self.trials[run][phiInd][vInd].peak_ for phiInd in range(self.nPhis)]
-            self.trunPeaks = [self.trials[run][phiInd][vInd].tpeak_ for phiInd in range(self.nPhis)]
+            peaks = self._trialPeaks(self.getFeatures(run=0, vInd=0))
+            self.IphiPeaks = list(peaks.Ipeak)
+            self.trunPeaks = list(peaks.tpeak)
             Ipeaks = self.IphiPeaks
             tpeaks = self.trunPeaks
         if self.nVs > 1:
-            run = 0
-            phiInd = 0
-            self.IVPeaks = [self.trials[run][phiInd][vInd].peak_ for vInd in range(self.nVs)]
-            self.tVPeaks = [self.trials[run][phiInd][vInd].tpeak_ for vInd in range(self.nVs)]
+            peaks = self._trialPeaks(self.getFeatures(run=0, phiInd=0))
+            self.IVPeaks = list(peaks.Ipeak)
+            self.tVPeaks = list(peaks.tpeak)
             Ipeaks = self.IVPeaks
             tpeaks = self.tVPeaks
         return Ipeaks, tpeaks
@@ -1690,19 +2280,12 @@ class ProtocolData(object):
         """
 
         assert(self.nVs > 1)
-        if phiInd is None: # Return 2D array
-            self.Isss_ = np.zeros((self.nPhis, self.nVs))
-            self.Vss_ = np.zeros((self.nPhis, self.nVs))
-            for phiInd, phi in enumerate(self.phis):
-                for vInd, V in enumerate(self.Vs):
-                    self.Isss_[phiInd, vInd] = self.trials[run][phiInd][vInd].ss_ # Variations along runs are not useful here
-                    self.Vss_[phiInd, vInd] = self.trials[run][phiInd][vInd].V
-        else:
-            self.Isss_ = np.zeros(self.nVs)
-            self.Vss_ = np.zeros(self.nVs)
-            for vInd, V in enumerate(self.Vs):
-                self.Isss_[vInd] = self.trials[run][phiInd][vInd].ss_
-                self.Vss_[vInd] = self.trials[run][phiInd][vInd].V
+        # Steady-states of the first pulses of one run (variations along runs are not useful here)
+        features = self.getFeatures(run=run, phiInd=phiInd)
+        features = features[features.pulse == 0]
+        shape = (self.nPhis, self.nVs) if phiInd is None else self.nVs # Return 2D array for all fluxes
+        self.Isss_ = features.Iss.reshape(shape)
+        self.Vss_ = features.V.reshape(shape)
         return self.Isss_, self.Vss_
 
 
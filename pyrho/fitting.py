@@ -2,8 +2,11 @@
 
 from __future__ import print_function, division
 import os
+import glob
 import pickle
+import hashlib
 import warnings
+import multiprocessing
 #from copy import deepcopy
 import copy
 
@@ -13,12 +16,13 @@ import matplotlib.pyplot as plt
 from lmfit import minimize, Parameters, fit_report, Model
 from scipy.optimize import curve_fit
 from scipy.integrate import odeint
+from scipy.stats import chi2
 
 from pyrho.parameters import *
 #from pyrho.expdata import *
 from pyrho.expdata import ProtocolData, PhotoCurrent
 from pyrho.utilities import * # plotLight, round_sig, findPeaks, findPlateauCurrent
-from pyrho.utilities import plotLight, round_sig, printParams, compareParams
+from pyrho.utilities import plotLight, round_sig, printParams, compareParams, solveAmplitude
 from pyrho.models import * # for fitPeaks
 
 from pyrho.config import * #verbose, saveFigFormat, addTitles, fDir, dDir, eqSize
@@ -26,7 +30,7 @@ from pyrho.config import * #verbose, saveFigFormat, addTitles, fDir, dDir, eqSiz
 from pyrho import config
 from pyrho.config import wallTime
 
-__all__ = ['fitModels', 'plotFluxSetFits', 'reportFit', 'methods', 'defMethod']
+__all__ = ['fitModels', 'fitPopulation', 'PopulationFit', 'bootstrapFit', 'profileFit', 'plotFluxSetFits', 'reportFit', 'methods', 'defMethod', 'FitStore']
 # ['fitModel', 'copyParam', 'getRecoveryPeaks', 'fitRecovery', 'fitfV']
 
 methods = ('leastsq', 'nelder', 'lbfgsb', 'powell', 'cg', 'cobyla', 'tnc', 'slsqp', 'differential_evolution')
@@ -104,6 +108,171 @@ def errPhase(p, residual, Is, ts, RhO, Vs, phis):
 
 ##### Main fitting routines #####
 
+class FitData(object):
+    """
+    Read-only view of the trials of a flux set (for one run and voltage clamp) used for fitting.
+
+    The on and off-phases of the first pulse of every trial are copied once
+    into contiguous arrays with their times shifted to start at 0. The per-trial
+    segments (Ions, tons, Ioffs, toffs) are views into these arrays. The
+    normalisation factors (nfs), fluxes (phis) and voltages (Vs) are precomputed
+    so that every fitting stage shares the same data without copying the dataset.
+    """
+
+    def __init__(self, fluxSet, run=0, vInd=0):
+        assert(0 < fluxSet.nPhis)
+        assert(0 <= run < fluxSet.nRuns)
+        assert(0 <= vInd < fluxSet.nVs)
+
+        self.run = run
+        self.vInd = vInd
+        PCs = [fluxSet.trials[run][phiInd][vInd] for phiInd in range(fluxSet.nPhis)]
+        self.nTrials = len(PCs)
+        self.phis = np.array([pc.phi for pc in PCs])
+        self.Vs = np.array([pc.V for pc in PCs])
+
+        onInds = [pc.pulseInds[0,0] for pc in PCs] ### Consider multiple pulse scenarios
+        offInds = [pc.pulseInds[0,1] for pc in PCs]
+        self.Ion = np.concatenate([pc.I[on:off+1] for pc, on, off in zip(PCs, onInds, offInds)])
+        self.ton = np.concatenate([pc.t[on:off+1]-pc.t[on] for pc, on, off in zip(PCs, onInds, offInds)])
+        self.Ioff = np.concatenate([pc.I[off:] for pc, off in zip(PCs, offInds)])
+        self.toff = np.concatenate([pc.t[off:]-pc.t[off] for pc, off in zip(PCs, offInds)])
+        self.onLengths = np.array([off+1-on for on, off in zip(onInds, offInds)])
+        self.offLengths = np.array([len(pc.I)-off for pc, off in zip(PCs, offInds)])
+        self.onWeight = np.ones(len(self.Ion)) # Residual weights (for decimated data)
+        self.offWeight = np.ones(len(self.Ioff))
+        self.factor = 1
+
+        self._setDerived()
+
+    def _setDerived(self):
+        """Set the views, normalisation factors and masks derived from the segment arrays"""
+        self._setViews()
+
+        # Normalisation factors: the final on-phase current for on-phase fits
+        # and the current at light off (nfs) for off-phase and whole cycle fits
+        self.nfs = np.array([Ioff[0] for Ioff in self.Ioffs])
+        self.onNorm = np.repeat([Ion[-1] for Ion in self.Ions], self.onLengths)
+        self.offNorm = np.repeat(self.nfs, self.offLengths)
+
+        # The first point of each off-phase is shared with the end of the on-phase
+        self.offTail = np.ones(len(self.Ioff), dtype=bool)
+        self.offTail[np.cumsum(self.offLengths)-self.offLengths] = False
+        self.IoffTail = self.Ioff[self.offTail]
+        self.offTailNorm = self.offNorm[self.offTail]
+        self.offTailWeight = self.offWeight[self.offTail]
+        self.onVs = np.repeat(self.Vs, self.onLengths)
+        self.offVs = np.repeat(self.Vs, self.offLengths)
+
+        for arr in self.__dict__.values():
+            if isinstance(arr, np.ndarray):
+                arr.flags.writeable = False
+
+    def decimate(self, factor):
+        """
+        Return a coarser FitData keeping about 1/factor of the samples of each segment.
+
+        Samples are placed uniformly in the cumulative (smoothed) change in
+        current plus elapsed time, so they are concentrated around the onsets,
+        peaks and offsets where the current changes fastest. The first and last
+        sample of every segment are kept so the normalisation factors are unchanged.
+        Residuals are weighted by the square root of the number of original
+        samples each retained sample represents so that the coarse objective
+        approximates the full one.
+        """
+        if factor <= 1:
+            return self
+
+        def sampleSegment(I, t):
+            n = len(I)
+            nKeep = max(2, int(np.ceil(n / factor)))
+            if nKeep >= n:
+                return np.arange(n)
+            window = int(min(factor, n))
+            Ismooth = np.convolve(I, np.ones(window)/window, mode='same') # Suppress noise
+            Irange, tRange = np.ptp(Ismooth), t[-1] - t[0]
+            weights = np.diff(t) / tRange if tRange > 0 else np.ones(n-1) / (n-1)
+            if Irange > 0:
+                weights += np.abs(np.diff(Ismooth)) / Irange
+            arcLength = np.r_[0, np.cumsum(weights)]
+            inds = np.searchsorted(arcLength, np.linspace(0, arcLength[-1], nKeep))
+            return np.unique(np.r_[0, np.clip(inds, 0, n-1), n-1])
+
+        def weighSamples(inds, n):
+            bounds = np.r_[0, (inds[1:] + inds[:-1]) / 2, n]
+            return np.sqrt(np.diff(bounds))
+
+        coarse = copy.copy(self)
+        onInds = [sampleSegment(I, t) for I, t in zip(self.Ions, self.tons)]
+        offInds = [sampleSegment(I, t) for I, t in zip(self.Ioffs, self.toffs)]
+        coarse.onWeight = np.concatenate([weighSamples(inds, len(I)) for I, inds in zip(self.Ions, onInds)])
+        coarse.offWeight = np.concatenate([weighSamples(inds, len(I)) for I, inds in zip(self.Ioffs, offInds)])
+        coarse.Ion = np.concatenate([I[inds] for I, inds in zip(self.Ions, onInds)])
+        coarse.ton = np.concatenate([t[inds] for t, inds in zip(self.tons, onInds)])
+        coarse.Ioff = np.concatenate([I[inds] for I, inds in zip(self.Ioffs, offInds)])
+        coarse.toff = np.concatenate([t[inds] for t, inds in zip(self.toffs, offInds)])
+        coarse.onLengths = np.array([len(inds) for inds in onInds])
+        coarse.offLengths = np.array([len(inds) for inds in offInds])
+        coarse.factor = self.factor * factor
+        coarse._setDerived()
+        return coarse
+
+    def withCurrents(self, Ion, Ioff):
+        """Return a copy with the on and off-phase currents replaced (e.g. for bootstrapping), keeping the normalisation factors"""
+        new = copy.copy(self)
+        new.Ion = np.array(Ion, dtype=float)
+        new.Ioff = np.array(Ioff, dtype=float)
+        new._setViews()
+        new.IoffTail = new.Ioff[new.offTail]
+        for arr in [new.Ion, new.Ioff, new.IoffTail]:
+            arr.flags.writeable = False
+        return new
+
+    def select(self, trials):
+        """Return a FitData set of the given trials (which may be repeated e.g. for bootstrapping)"""
+        new = copy.copy(self)
+        onWeights = np.split(self.onWeight, np.cumsum(self.onLengths)[:-1])
+        new.Ion = np.concatenate([self.Ions[trial] for trial in trials])
+        new.ton = np.concatenate([self.tons[trial] for trial in trials])
+        new.onWeight = np.concatenate([onWeights[trial] for trial in trials])
+        new.Ioff = np.concatenate([self.Ioffs[trial] for trial in trials])
+        new.toff = np.concatenate([self.toffs[trial] for trial in trials])
+        new.offWeight = np.concatenate([self.offWeights[trial] for trial in trials])
+        new.onLengths = self.onLengths[trials]
+        new.offLengths = self.offLengths[trials]
+        new.phis = self.phis[trials]
+        new.Vs = self.Vs[trials]
+        new.nTrials = len(trials)
+        new._setDerived()
+        return new
+
+    def _setViews(self):
+        """Set the per-trial views into the contiguous segment arrays"""
+        self.Ions = np.split(self.Ion, np.cumsum(self.onLengths)[:-1])
+        self.tons = np.split(self.ton, np.cumsum(self.onLengths)[:-1])
+        self.Ioffs = np.split(self.Ioff, np.cumsum(self.offLengths)[:-1])
+        self.toffs = np.split(self.toff, np.cumsum(self.offLengths)[:-1])
+        self.offWeights = np.split(self.offWeight, np.cumsum(self.offLengths)[:-1])
+
+    def __getstate__(self):
+        """Pickle (e.g. for worker processes) without duplicating the views"""
+        state = self.__dict__.copy()
+        for views in ['Ions', 'tons', 'Ioffs', 'toffs', 'offWeights']:
+            del state[views]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setViews()
+
+
+def getFitData(fluxSet, run=0, vInd=0):
+    """Return fluxSet if it is already a FitData view, otherwise build one for the run and voltage clamp"""
+    if isinstance(fluxSet, FitData):
+        return fluxSet
+    return FitData(fluxSet, run, vInd)
+
+
 def calcOnPhase(p, t, RhO, V, phi):
     """Simulate the on-phase from base parameters"""
 
@@ -125,8 +294,11 @@ def calcOnPhase(p, t, RhO, V, phi):
 
 
 # Normalise? e.g. /Ions[trial][-1] or /min(Ions[trial])
-def errOnPhase(p, Ions, tons, RhO, Vs, phis):
-    return np.r_[[(Ions[i] - calcOnPhase(p, tons[i], RhO, Vs[i], phis[i]))/Ions[i][-1] for i in range(len(Ions))]]
+def errOnPhase(p, data, RhO):
+    """Residuals of the on-phases for all fluxes in a FitData set, solved together (see RhO.calcSolns)"""
+    RhO.updateParams(p)
+    states, _ = RhO.calcSolns(data.ton, data.phis, lengths=data.onLengths)
+    return data.onWeight * (data.Ion - RhO.calcI(data.onVs, states)) / data.onNorm
 
 
 def reportFit(minResult, description, method):
@@ -202,6 +374,37 @@ def copyParam(name, source, target):
     return #target
 
 
+def solveOffAmplitudes(Ioffs, toffs, lam1, lam2, weights=None):
+    """
+    Solve the slow and fast amplitudes of biexponential off-phase decays in
+    closed form for given rates, subject to Islow + Ifast = Ioff[0] (with the
+    same sign) for each trial. Returns a list of Islow values.
+    """
+    if weights is None:
+        weights = [1 for Ioff in Ioffs]
+    Islows = []
+    for Ioff, toff, w in zip(Ioffs, toffs, weights):
+        Iss = Ioff[0]
+        slow, fast = np.exp(-lam1*toff), np.exp(-lam2*toff)
+        Islows.append(solveAmplitude(w*Ioff, w*Iss*fast, w*(slow-fast), min(Iss, 0), max(Iss, 0)))
+    return Islows
+
+
+def errOffPhase(lam1, lam2, Ioffs, toffs, weights=None):
+    """Residuals of biexponential off-phase decays with the amplitudes projected out (normalised by Ioff[0])"""
+    if weights is None:
+        weights = [1 for Ioff in Ioffs]
+    Islows = solveOffAmplitudes(Ioffs, toffs, lam1, lam2, weights)
+    return np.concatenate([w*(Ioff - (Islow*np.exp(-lam1*toff) + (Ioff[0]-Islow)*np.exp(-lam2*toff)))/Ioff[0]
+                           for Ioff, toff, w, Islow in zip(Ioffs, toffs, weights, Islows)])
+
+
+def setOffAmplitudes(pOffs, Ioffs, toffs, lam1, lam2, weights=None):
+    """Store the closed-form off-phase amplitudes in the Islow_i (and hence Ifast_i) parameters"""
+    for phiInd, Islow in enumerate(solveOffAmplitudes(Ioffs, toffs, lam1, lam2, weights)):
+        pOffs['Islow_'+str(phiInd)].value = Islow
+
+
 def plotOffPhaseFits(toffs, Ioffs, pOffs, phis, nStates, fitFunc, Exp1, Exp2, Gd=None):
     fig = plt.figure()
     #gs = plt.GridSpec(nTrials,1)
@@ -381,13 +584,14 @@ def plotFit(PC, nStates, params, fitRates=False, index=None):
 
 
 
-def fit3states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verbose):
+def fit3states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verbose, varPro=True):
     """
-    fluxSet := ProtocolData set (of Photocurrent objects) to fit
+    fluxSet := ProtocolData set (of Photocurrent objects) or FitData view to fit
     run     := Index for the run within the ProtocolData set
     vInd    := Index for Voltage clamp value within the ProtocolData set
     params  := Parameters object of model parameters with initial values [and bounds, expressions]
     method  := Fitting algorithm for the optimiser to use
+    varPro  := Solve the off-phase amplitudes in closed form and only search the decay rates
     """
 
     plotResult = bool(verbose > 1)
@@ -395,66 +599,10 @@ def fit3states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verb
     nStates = 3
 
     ### Prepare the data
-    nRuns = fluxSet.nRuns
-    nPhis = fluxSet.nPhis
-    nVs = fluxSet.nVs
-
-    assert(0 < nPhis)
-    assert(0 <= run < nRuns)
-    assert(0 <= vInd < nVs)
-
-    Ions = [None for phiInd in range(nPhis)]
-    Ioffs = [None for phiInd in range(nPhis)]
-    tons = [None for phiInd in range(nPhis)]
-    toffs = [None for phiInd in range(nPhis)]
-    phis = []
-    Is = []
-    ts = []
-    Vs = []
-
-    Icycles = []
-    nfs = []
-
-    #offTally = 0
-    #soffs = [None for phiInd in range(nPhis)]
-    #onTally = 0
-    #sons = [None for phiInd in range(nPhis)]
-
-    # Trim off phase data
-    #frac = 1
-    #chop = int(round(len(Ioffs[0])*frac))
-
-    for phiInd in range(nPhis):
-        targetPC = fluxSet.trials[run][phiInd][vInd]
-        #targetPC.alignToTime()
-        I = targetPC.I
-        t = targetPC.t
-        onInd = targetPC.pulseInds[0,0] ### Consider multiple pulse scenarios
-        offInd = targetPC.pulseInds[0,1]
-        Ions[phiInd] = I[onInd:offInd+1]
-        Ioffs[phiInd] = I[offInd:] #[I[offInd:] for I in Is]
-        tons[phiInd] = t[onInd:offInd+1]-t[onInd]
-        toffs[phiInd] = t[offInd:]-t[offInd] #[t[offInd:]-t[offInd] for t in ts]
-        #args=(Ioffs[phiInd][:chop+1],toffs[phiInd][:chop+1])
-        phi = targetPC.phi
-        phis.append(phi)
-
-        Is.append(I)
-        ts.append(t)
-        V = targetPC.V
-        Vs.append(V)
-
-        Icycles.append(I[onInd:])
-        nfs.append(I[offInd])
-
-        # if phiInd < nPhis-1:
-            # soffs[phiInd] = slice(offTally, len(Ioffs[phiInd])+offTally)
-            # sons[phiInd] = slice(onTally, len(Ions[phiInd])+onTally)
-        # else:
-            # soffs[phiInd] = slice(offTally, None)
-            # sons[phiInd] = slice(onTally, None)
-        # offTally += len(Ioffs[phiInd])
-        # onTally += len(Ions[phiInd])
+    data = getFitData(fluxSet, run, vInd)
+    nPhis = data.nTrials
+    Ions, tons, Ioffs, toffs = data.Ions, data.tons, data.Ioffs, data.toffs
+    phis, Vs = data.phis, data.Vs
 
 
     #nTrials = nPhis
@@ -472,10 +620,10 @@ def fit3states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verb
     for phiInd in range(nPhis):
         Iss = Ioffs[phiInd][0]
         if Iss < 0: # Excitatory
-            iOffPs.add('Islow_'+str(phiInd), value=0.2*Iss, vary=True, max=0)
+            iOffPs.add('Islow_'+str(phiInd), value=0.2*Iss, vary=not varPro, max=0)
             iOffPs.add('Ifast_'+str(phiInd), value=0.8*Iss, vary=True, max=0, expr='{} - {}'.format(Iss, 'Islow_'+str(phiInd)))
         else:
-            iOffPs.add('Islow_'+str(phiInd), value=0.2*Iss, vary=True, min=0)
+            iOffPs.add('Islow_'+str(phiInd), value=0.2*Iss, vary=not varPro, min=0)
             iOffPs.add('Ifast_'+str(phiInd), value=0.8*Iss, vary=True, min=0, expr='{} - {}'.format(Iss, 'Islow_'+str(phiInd)))
 
     iOffPs.add('Gd1', value=params['Gd'].value/5, min=params['Gd'].min, max=params['Gd'].max)
@@ -492,8 +640,14 @@ def fit3states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verb
     def err3off(p,Ioffs,toffs):
         return np.r_[ [(Ioffs[i] - fit3off(p,toffs[i],i))/Ioffs[i][0] for i in range(len(Ioffs))] ]
 
-    offPmin = minimize(err3off, iOffPs, args=(Ioffs,toffs), method=method)
-    pOffs = offPmin.params
+    if varPro: # Only the rates are searched
+        offPmin = minimize(lambda p, Ioffs, toffs, ws: errOffPhase(p['Gd1'].value, p['Gd2'].value, Ioffs, toffs, ws),
+                           iOffPs, args=(Ioffs,toffs,data.offWeights), method=method)
+        pOffs = offPmin.params
+        setOffAmplitudes(pOffs, Ioffs, toffs, pOffs['Gd1'].value, pOffs['Gd2'].value, data.offWeights)
+    else:
+        offPmin = minimize(err3off, iOffPs, args=(Ioffs,toffs), method=method)
+        pOffs = offPmin.params
 
     #def err3off(p,Ioffs,toffs,soffs):
     #    return np.concatenate( [(Ioffs[s] - fit3off(p,toffs[s],i))/Ioffs[s][0] for i,s in enumerate(soffs)] )
@@ -516,8 +670,9 @@ def fit3states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verb
     if plotResult:
         plotOffPhaseFits(toffs, Ioffs, pOffs, phis, nStates, fit3off, v['Gd1'], v['Gd2'], Gd=Gd)
 
-    reportFit(offPmin, "Off-phase fit report for the 3-state model", method)
-    print('Gd1 = {}; Gd2 = {} ==> Gd = {}'.format(pOffs['Gd1'].value, pOffs['Gd2'].value, Gd))
+    if verbose > 0:
+        reportFit(offPmin, "Off-phase fit report for the 3-state model", method)
+        print('Gd1 = {}; Gd2 = {} ==> Gd = {}'.format(pOffs['Gd1'].value, pOffs['Gd2'].value, Gd))
 
 
     ### Fit on curve
@@ -529,24 +684,14 @@ def fit3states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verb
 
     RhO = models['3']()
 
-    def fit3on(p,t,RhO,phi,V):
-        RhO.updateParams(p)
-        RhO.setLight(phi)
-        states = RhO.calcSoln(t, s0=[1,0,0]) # t starts at 0
-        #states = odeint(RhO.solveStates, RhO.s_0, t, Dfun=RhO.jacobian)
-        return RhO.calcI(V, states)
-
-    def err3on(p,Ions,tons,RhO,phis,Vs):
-        return np.r_[ [(Ions[i] - fit3on(p,tons[i],RhO,phis[i],Vs[i]))/Ions[i][-1] for i in range(len(Ions))] ]
-
-    onPmin = minimize(err3on, iOnPs, args=(Ions,tons,RhO,phis,Vs), method=method)
+    onPmin = minimize(errOnPhase, iOnPs, args=(data,RhO), method=method)
     pOns = onPmin.params
 
     # if (Gr + Gd - 2*np.sqrt(Gr*Gd)) < Ga < (Gr + Gd + 2*np.sqrt(Gr*Gd)):
         # print('\n\nWarning! No real solution exists!\n\n')
 
-    reportFit(onPmin, "On-phase fit report for the 3-state model", method)
     if verbose > 0:
+        reportFit(onPmin, "On-phase fit report for the 3-state model", method)
         print('k_a = {}; p = {}; k_r = {}; q = {}; phi_m = {}'.format(pOns['k_a'].value, pOns['p'].value,
                                                 pOns['k_r'].value, pOns['q'].value, pOns['phi_m'].value))
 
@@ -556,14 +701,15 @@ def fit3states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verb
 
 
 
-def fit4states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verbose):
+def fit4states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verbose, varPro=True):
     """
-    fluxSet := ProtocolData set (of Photocurrent objects) to fit
+    fluxSet := ProtocolData set (of Photocurrent objects) or FitData view to fit
     run     := Index for the run within the ProtocolData set
     vInd    := Index for Voltage clamp value within the ProtocolData set
     params  := Parameters object of model parameters with initial values [and bounds, expressions]
     method  := Fitting algorithm for the optimiser to use
     verbose := Text output (verbosity) level
+    varPro  := Solve the off-phase amplitudes in closed form and only search the decay rates
     """
 
     plotResult = bool(verbose > 1)
@@ -571,53 +717,10 @@ def fit4states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verb
     nStates = 4
 
     ### Prepare the data
-    nRuns = fluxSet.nRuns
-    nPhis = fluxSet.nPhis
-    nVs = fluxSet.nVs
-
-    assert(0 < nPhis)
-    assert(0 <= run < nRuns)
-    assert(0 <= vInd < nVs)
-
-    Ions = [None for phiInd in range(nPhis)]
-    Ioffs = [None for phiInd in range(nPhis)]
-    tons = [None for phiInd in range(nPhis)]
-    toffs = [None for phiInd in range(nPhis)]
-    phis = []
-    Is = []
-    ts = []
-    Vs = []
-
-    Icycles = []
-    nfs = []
-
-
-    # Trim off phase data
-    #frac = 1
-    #chop = int(round(len(Ioffs[0])*frac))
-
-    for phiInd in range(nPhis):
-        targetPC = fluxSet.trials[run][phiInd][vInd]
-        #targetPC.alignToTime()
-        I = targetPC.I
-        t = targetPC.t
-        onInd = targetPC.pulseInds[0,0] ### Consider multiple pulse scenarios
-        offInd = targetPC.pulseInds[0,1]
-        Ions[phiInd] = I[onInd:offInd+1]
-        Ioffs[phiInd] = I[offInd:] #[I[offInd:] for I in Is]
-        tons[phiInd] = t[onInd:offInd+1]-t[onInd]
-        toffs[phiInd] = t[offInd:]-t[offInd] #[t[offInd:]-t[offInd] for t in ts]
-        #args=(Ioffs[phiInd][:chop+1],toffs[phiInd][:chop+1])
-        phi = targetPC.phi
-        phis.append(phi)
-
-        Is.append(I)
-        ts.append(t)
-        V = targetPC.V
-        Vs.append(V)
-
-        Icycles.append(I[onInd:])
-        nfs.append(I[offInd])
+    data = getFitData(fluxSet, run, vInd)
+    nPhis = data.nTrials
+    Ions, tons, Ioffs, toffs = data.Ions, data.tons, data.Ioffs, data.toffs
+    phis, Vs = data.phis, data.Vs
 
 
     ### OFF PHASE
@@ -633,10 +736,10 @@ def fit4states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verb
     for phiInd in range(nPhis):
         Iss = Ioffs[phiInd][0]
         if Iss < 0:
-            iOffPs.add('Islow_'+str(phiInd), value=0.2*Iss, vary=True, max=0)
+            iOffPs.add('Islow_'+str(phiInd), value=0.2*Iss, vary=not varPro, max=0)
             iOffPs.add('Ifast_'+str(phiInd), value=0.8*Iss, vary=True, max=0, expr='{} - {}'.format(Iss, 'Islow_'+str(phiInd)))
         else:
-            iOffPs.add('Islow_'+str(phiInd), value=0.2*Iss, vary=True, min=0)
+            iOffPs.add('Islow_'+str(phiInd), value=0.2*Iss, vary=not varPro, min=0)
             iOffPs.add('Ifast_'+str(phiInd), value=0.8*Iss, vary=True, min=0, expr='{} - {}'.format(Iss, 'Islow_'+str(phiInd)))
 
     # lam1 + lam2 == Gd1 + Gd2 + Gf0 + Gb0
@@ -668,11 +771,17 @@ def fit4states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verb
     ##fitfunc = lambda p, t: -(p['a0'].value + p['a1'].value*np.exp(-p['lam1'].value*t) + p['a2'].value*np.exp(-p['lam2'].value*t))
     #errfunc = lambda p, Ioff, toff: Ioff - fitfunc(p,toff)
 
-    offPmin = minimize(err4off, iOffPs, args=(Ioffs,toffs), method=method)#, fit_kws={'maxfun':100000})
-    pOffs = offPmin.params
+    if varPro: # Only the rates are searched
+        offPmin = minimize(lambda p, Ioffs, toffs, ws: errOffPhase(*lams(p), Ioffs=Ioffs, toffs=toffs, weights=ws),
+                           iOffPs, args=(Ioffs,toffs,data.offWeights), method=method)
+        pOffs = offPmin.params
+        setOffAmplitudes(pOffs, Ioffs, toffs, *lams(pOffs), weights=data.offWeights)
+    else:
+        offPmin = minimize(err4off, iOffPs, args=(Ioffs,toffs), method=method)#, fit_kws={'maxfun':100000})
+        pOffs = offPmin.params
 
-    reportFit(offPmin, "Off-phase fit report for the 4-state model", method)
     if verbose > 0:
+        reportFit(offPmin, "Off-phase fit report for the 4-state model", method)
         vd = pOffs.valuesdict()
         print('Gd1 = {Gd1}; Gd2 = {Gd2}; Gf0 = {Gf0}; Gb0 = {Gb0}'.format(**vd))
 
@@ -702,11 +811,11 @@ def fit4states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verb
     if verbose > 2:
         print('Optimising ',end='')
 
-    onPmin = minimize(errOnPhase, iOnPs, args=(Ions,tons,RhO,Vs,phis), method=method)
+    onPmin = minimize(errOnPhase, iOnPs, args=(data,RhO), method=method)
     pOns = onPmin.params
 
-    reportFit(onPmin, "On-phase fit report for the 4-state model", method)
     if verbose > 0:
+        reportFit(onPmin, "On-phase fit report for the 4-state model", method)
         print('k1 = {}; k2 = {}; k_f = {}; k_b = {}'.format(pOns['k1'].value, pOns['k2'].value, pOns['k_f'].value, pOns['k_b'].value))
         print('gam = {}; phi_m = {}; p = {}; q = {}'.format(pOns['gam'].value, pOns['phi_m'].value, pOns['p'].value, pOns['q'].value))
 
@@ -716,15 +825,16 @@ def fit4states(fluxSet, run, vInd, params, method=defMethod, verbose=config.verb
 
 
 
-def fit6states(fluxSet, quickSet, run, vInd, params, method=defMethod, verbose=config.verbose):
+def fit6states(fluxSet, quickSet, run, vInd, params, method=defMethod, verbose=config.verbose, varPro=True):
     """
-    fluxSet := ProtocolData set (of Photocurrent objects) to fit
+    fluxSet := ProtocolData set (of Photocurrent objects) or FitData view to fit
     quickSet:= ProtocolData set (of Photocurrent objects) with short pulses to fit opsin activation rates
     run     := Index for the run within the ProtocolData set
     vInd    := Index for Voltage clamp value within the ProtocolData set
     params  := Parameters object of model parameters with initial values [and bounds, expressions]
     method  := Fitting algorithm for the optimiser to use
     verbose := Text output (verbosity) level
+    varPro  := Solve the off-phase amplitudes in closed form and only search the decay rates
     """
 
     plotResult = bool(verbose > 1)
@@ -732,54 +842,10 @@ def fit6states(fluxSet, quickSet, run, vInd, params, method=defMethod, verbose=c
     nStates = 6
 
     ### Prepare the data
-    nRuns = fluxSet.nRuns
-    nPhis = fluxSet.nPhis
-    nVs = fluxSet.nVs
-
-    assert(0 < nPhis)
-    assert(0 <= run < nRuns)
-    assert(0 <= vInd < nVs)
-
-    Ions = [None for phiInd in range(nPhis)]
-    Ioffs = [None for phiInd in range(nPhis)]
-    tons = [None for phiInd in range(nPhis)]
-    toffs = [None for phiInd in range(nPhis)]
-    phis = []
-    Is = []
-    ts = []
-    Vs = []
-
-    Icycles = []
-    nfs = [] # Normalisation factors: e.g. /Ions[trial][-1] or /min(Ions[trial])
-
-
-    # Trim off phase data
-    #frac = 1
-    #chop = int(round(len(Ioffs[0])*frac))
-
-    for phiInd in range(nPhis):
-        targetPC = fluxSet.trials[run][phiInd][vInd]
-        #targetPC.alignToTime()
-        I = targetPC.I
-        t = targetPC.t
-        onInd = targetPC.pulseInds[0,0] ### Consider multiple pulse scenarios
-        offInd = targetPC.pulseInds[0,1]
-        Ions[phiInd] = I[onInd:offInd+1]
-        Ioffs[phiInd] = I[offInd:] #[I[offInd:] for I in Is]
-        tons[phiInd] = t[onInd:offInd+1]-t[onInd]
-        toffs[phiInd] = t[offInd:]-t[offInd] #[t[offInd:]-t[offInd] for t in ts]
-        #args=(Ioffs[phiInd][:chop+1],toffs[phiInd][:chop+1])
-        phi = targetPC.phi
-        phis.append(phi)
-
-        Is.append(I)
-        ts.append(t)
-        V = targetPC.V
-        Vs.append(V)
-
-        Icycles.append(I[onInd:])
-        nfs.append(I[offInd])
-        #nfs.append(targetPC.peak_)
+    data = getFitData(fluxSet, run, vInd)
+    nPhis = data.nTrials
+    Ions, tons, Ioffs, toffs = data.Ions, data.tons, data.Ioffs, data.toffs
+    phis, Vs = data.phis, data.Vs
 
 
     ### OFF PHASE
@@ -815,10 +881,10 @@ def fit6states(fluxSet, quickSet, run, vInd, params, method=defMethod, verbose=c
     for phiInd in range(nPhis):
         Iss = Ioffs[phiInd][0]
         if Iss < 0:
-            iOffPs.add('Islow_'+str(phiInd), value=0.2*Iss, vary=True, max=0)
+            iOffPs.add('Islow_'+str(phiInd), value=0.2*Iss, vary=not varPro, max=0)
             iOffPs.add('Ifast_'+str(phiInd), value=0.8*Iss, vary=True, max=0, expr='{} - {}'.format(Iss, 'Islow_'+str(phiInd)))
         else:
-            iOffPs.add('Islow_'+str(phiInd), value=0.2*Iss, vary=True, min=0)
+            iOffPs.add('Islow_'+str(phiInd), value=0.2*Iss, vary=not varPro, min=0)
             iOffPs.add('Ifast_'+str(phiInd), value=0.8*Iss, vary=True, min=0, expr='{} - {}'.format(Iss, 'Islow_'+str(phiInd)))
 
     def fit6off(p,t,trial):
@@ -835,11 +901,17 @@ def fit6states(fluxSet, quickSet, run, vInd, params, method=defMethod, verbose=c
     ##fitfunc = lambda p, t: -(p['a0'].value + p['a1'].value*np.exp(-p['lam1'].value*t) + p['a2'].value*np.exp(-p['lam2'].value*t))
     #errfunc = lambda p, Ioff, toff: Ioff - fitfunc(p,toff)
 
-    offPmin = minimize(err6off, iOffPs, args=(Ioffs,toffs), method=method)#, fit_kws={'maxfun':100000})
-    pOffs = offPmin.params
+    if varPro: # Only the rates are searched
+        offPmin = minimize(lambda p, Ioffs, toffs, ws: errOffPhase(*lams(p), Ioffs=Ioffs, toffs=toffs, weights=ws),
+                           iOffPs, args=(Ioffs,toffs,data.offWeights), method=method)
+        pOffs = offPmin.params
+        setOffAmplitudes(pOffs, Ioffs, toffs, *lams(pOffs), weights=data.offWeights)
+    else:
+        offPmin = minimize(err6off, iOffPs, args=(Ioffs,toffs), method=method)#, fit_kws={'maxfun':100000})
+        pOffs = offPmin.params
 
-    reportFit(offPmin, "Off-phase fit report for the 6-state model", method)
     if verbose > 0:
+        reportFit(offPmin, "Off-phase fit report for the 6-state model", method)
         print('Gd1 = {}; Gd2 = {}; Gf0 = {}; Gb0 = {}'.format(pOffs['Gd1'].value, pOffs['Gd2'].value,
                                                             pOffs['Gf0'].value, pOffs['Gb0'].value))
 
@@ -940,11 +1012,11 @@ def fit6states(fluxSet, quickSet, run, vInd, params, method=defMethod, verbose=c
     if verbose > 2:
         print('Optimising ',end='')
 
-    onPmin = minimize(errOnPhase, iOnPs, args=(Ions,tons,RhO,Vs,phis), method=method)
+    onPmin = minimize(errOnPhase, iOnPs, args=(data,RhO), method=method)
     pOns = onPmin.params
 
-    reportFit(onPmin, "On-phase fit report for the 6-state model", method)
     if verbose > 0:
+        reportFit(onPmin, "On-phase fit report for the 6-state model", method)
         print('k1 = {}; k2 = {}; k_f = {}; k_b = {}'.format(pOns['k1'].value, pOns['k2'].value,
                                                         pOns['k_f'].value, pOns['k_b'].value))
         print('gam = {}; phi_m = {}; p = {}; q = {}'.format(pOns['gam'].value, pOns['phi_m'].value,
@@ -1669,13 +1741,51 @@ def calcCycle(p, ton, toff, RhO, V, phi): #, fitRates=False): #,fitDelay=False
     return RhO.calcI(V, RhO.states)
 
 
-def errCycle(p,Is,tons,toffs,nfs,RhO,Vs,phis):
-    return np.r_[ [(Is[i] - calcCycle(p,tons[i],toffs[i],RhO,Vs[i],phis[i]))/nfs[i] for i in range(len(Is))]]
+def calcCycleCurrents(p, data, RhO):
+    """Model currents over the on and off-phases for all fluxes in a FitData set, solved together (see RhO.calcSolns)"""
+    RhO.updateParams(p)
+    onStates, _ = RhO.calcSolns(data.ton, data.phis, lengths=data.onLengths)
+    offStates, _ = RhO.calcSolns(data.toff, np.zeros(data.nTrials), s0s=onStates[np.cumsum(data.onLengths)-1],
+                                 lengths=data.offLengths)
+    return RhO.calcI(data.onVs, onStates), RhO.calcI(data.offVs, offStates)
+
+
+def errCycle(p, data, RhO):
+    """Residuals of the on and off-phases for all fluxes in a FitData set"""
+    Ion, Ioff = calcCycleCurrents(p, data, RhO)
+    Ioff = Ioff[data.offTail]
+    return np.concatenate((data.onWeight * (data.Ion - Ion) / data.onNorm,
+                           data.offTailWeight * (data.IoffTail - Ioff) / data.offTailNorm))
 
 
 
-def fitModels(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, method=defMethod, postFitOptMethod=None, verbose=config.verbose):
-    """Fit a list of models and compare thier goodness-of-fit metrics"""
+def _fitModelWorker(job):
+    """Fit a single model in a worker process for fitModels"""
+    ind, dataSet, kwargs = job
+    plt.switch_backend('Agg') # Figures are saved but cannot be shown from a worker
+    t0 = wallTime()
+    fittedParams, miniObj = fitModel(dataSet, **kwargs)
+    return ind, fittedParams, miniObj, wallTime() - t0
+
+
+def fitModels(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, method=defMethod, postFitOptMethod=None, nStarts=1, sampler='lhs', seed=None, multiRes=None, store=None, workers=None, plot=True, verbose=config.verbose):
+    """
+    Fit a list of models and compare thier goodness-of-fit metrics
+
+    The models are independent so they are fit concurrently in a pool of
+    ``workers`` processes (default: one per model up to the number of CPUs).
+    Each result is reported as soon as it finishes and the comparison table
+    is printed once all fits are complete. Set ``workers=1`` to fit the
+    models serially in the current process. With ``nStarts > 1`` each model
+    is fit from multiple starting points (see fitModel); the starts share the
+    workers when a single model is fit. multiRes sets a coarse-to-fine
+    schedule of decimation factors for each fit and store a FitStore
+    for recording, reusing and warm-starting fits (see fitModel). plot=False
+    skips the figures of each fit and the comparison of the fits.
+
+    Returns the fitted parameters and minimizer result for a single model
+    or lists of them for several models.
+    """
 
     '''
     #TODO """Routine to fit as many models as possible and select between them according to some parsimony criterion"""
@@ -1699,7 +1809,9 @@ def fitModels(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, met
         nStates = [nStates]
     else:
         nStates = nStates
-    if not isinstance(params, (list, tuple)):
+    if params is None:
+        params = [None for nSt in nStates]
+    elif not isinstance(params, (list, tuple)):
         params = [params]
     else:
         params = params
@@ -1707,12 +1819,36 @@ def fitModels(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, met
     assert(len(nStates) == len(params))
     nModels = len(nStates)
 
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    # Worker processes cannot start their own pools so multiple starts are
+    # only run in parallel when the models themselves are fit serially
+    modelWorkers = min(workers, nModels)
+    startWorkers = workers if modelWorkers <= 1 else 1
+    workers = modelWorkers
+
+    jobs = [(i, dataSet, dict(nStates=nStates[i], params=params[i], postFitOpt=postFitOpt,
+                              relaxFact=relaxFact, method=method,
+                              postFitOptMethod=postFitOptMethod, nStarts=nStarts,
+                              sampler=sampler, seed=seed, multiRes=multiRes, store=store, workers=startWorkers,
+                              plot=plot, verbose=verbose))
+            for i in range(nModels)]
+
     fitParams = [None for nSt in nStates]
     miniObjs = [None for nSt in nStates]
-    for i in range(nModels): #, nSt in enumerate(nStates):
-        fitParams[i], miniObjs[i] = fitModel(dataSet, nStates=nStates[i], params=params[i],
-                                postFitOpt=postFitOpt, relaxFact=relaxFact,
-                                method=method, postFitOptMethod=postFitOptMethod, verbose=verbose)
+    if workers > 1:
+        pool = multiprocessing.Pool(min(workers, nModels))
+        try:
+            results = pool.imap_unordered(_fitModelWorker, jobs)
+            for i, fitParams[i], miniObjs[i], fitTime in results: # Stream results as they finish
+                if verbose > 0:
+                    print("Finished fitting the {}-state model in {:.3g}s: chi^2 = {:.3g}".format(nStates[i], fitTime, miniObjs[i].chisqr))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for i, dataSet_i, kwargs in jobs: #, nSt in enumerate(nStates):
+            fitParams[i], miniObjs[i] = fitModel(dataSet_i, **kwargs)
 
     if verbose > 0 and nModels > 1:
         if isinstance(dataSet, dict):
@@ -1725,7 +1861,8 @@ def fitModels(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, met
         else:
             fluxKey = 'step'
 
-        plotFluxSetFits(fluxSet=dataSet[fluxKey], nStates=nStates, params=fitParams)
+        if plot:
+            plotFluxSetFits(fluxSet=dataSet[fluxKey], nStates=nStates, params=fitParams)
 
         print("\n--------------------------------------------------------------------------------")
         print("Model comparison with the '{}' algorithm".format(method), end=" ")
@@ -1750,9 +1887,741 @@ def fitModels(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, met
 
         print("================================================================================\n")
 
+    if nModels == 1:
+        return fitParams[0], miniObjs[0]
+    return fitParams, miniObjs
+
+
+class PopulationFit(object):
+    """
+    Table of model fits over a population of cells (one row per cell and model).
+
+    Each row holds the cell's key, the model (nStates), the fitted parameter
+    values, the goodness-of-fit statistics (chisqr, redchi, aic, bic, nfev,
+    ndata), the fitting time and the error message if the fit failed. Columns
+    are returned as arrays by indexing with their name (missing values are
+    nan) and rows as dictionaries by indexing with an integer. The fitted
+    Parameters are kept in ``params``, keyed by (cell, nStates).
+    """
+
+    statColumns = ['chisqr', 'redchi', 'aic', 'bic', 'nfev', 'ndata']
+
+    def __init__(self, rows, params=None):
+        self.rows = rows
+        self.params = params if params is not None else {}
+        self.columns = ['cell', 'nStates'] + self.statColumns + ['time', 'error']
+        for row in rows:
+            for col in row:
+                if col not in self.columns:
+                    self.columns.insert(-2, col) # Parameters before time and error
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in ('cell', 'error'):
+                return [row.get(key) for row in self.rows]
+            return np.array([row.get(key, np.nan) for row in self.rows], dtype=float)
+        return self.rows[key]
+
+    def __str__(self):
+        return 'Population fit of {} cells: {} fits ({} failed)'.format(len(set(self['cell'])), len(self), len(self.failures))
+
+    @property
+    def failures(self):
+        """Rows of the fits which failed"""
+        return [row for row in self.rows if row['error'] is not None]
+
+    def toDF(self):
+        """Export to a pandas DataFrame"""
+        if not check_package('pandas'):
+            warnings.warn('Pandas not found!')
+            return
+        else:
+            import pandas as pd
+        return pd.DataFrame(self.rows, columns=self.columns)
+
+    def toCSV(self, fileName):
+        """Write the table to a csv file"""
+        import csv
+        with open(fileName, 'w') as fh:
+            writer = csv.DictWriter(fh, fieldnames=self.columns, restval='')
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+
+def _fitCellWorker(job):
+    """Fit a model to one cell for fitPopulation, returning the error message instead of raising"""
+    ind, cell, dataSet, kwargs = job
+    t0 = wallTime()
+    try:
+        if isinstance(dataSet, str):
+            dataSet = loadData(dataSet)
+        fittedParams, miniObj = fitModel(dataSet, **kwargs)
+    except Exception as err:
+        return ind, cell, kwargs['nStates'], None, None, wallTime() - t0, '{}: {}'.format(type(err).__name__, err)
+    stats = dict((stat, getattr(miniObj, stat)) for stat in PopulationFit.statColumns)
+    return ind, cell, kwargs['nStates'], fittedParams, stats, wallTime() - t0, None
+
+
+def fitPopulation(datasets, nStates=3, params=None, workers=None, verbose=config.verbose, **kwargs):
+    """
+    Fit a model (or list of models) to every cell in a population of datasets
+
+    datasets is a dictionary of {cell: dataSet} or a list of dataSets where
+    each dataSet is a dictionary of ProtocolData (as passed to fitModel) or
+    the name of a pickled dataSet, which is loaded by the worker (see loadData).
+    The cells are fit concurrently in a pool of ``workers`` processes (default:
+    one per CPU) without plotting. A cell which fails to fit is recorded with
+    its error and the remaining cells are fit. Other keyword arguments (e.g.
+    method, postFitOpt, multiRes, store) are passed to fitModel. Passing a
+    FitStore as ``store`` allows an interrupted population fit to be resumed.
+
+    Returns a PopulationFit table with a row per cell and model.
+    """
+
+    if isinstance(datasets, dict):
+        cells = list(datasets.keys())
+        datasets = [datasets[cell] for cell in cells]
+    else:
+        cells = list(range(len(datasets)))
+
+    if not isinstance(nStates, (list, tuple)):
+        nStates = [nStates]
+    if params is None or not isinstance(params, (list, tuple)):
+        params = [params for nSt in nStates]
+    assert(len(nStates) == len(params))
+
+    if kwargs.get('store') is True:
+        kwargs['store'] = FitStore() # Create the directory before the workers start
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    # Each cell is fit serially in its worker with plotting and printing suppressed
+    kwargs.update(plot=False, verbose=0, workers=1)
+    jobs = []
+    for c, (cell, dataSet) in enumerate(zip(cells, datasets)):
+        for m, nSt in enumerate(nStates):
+            jobKwargs = dict(kwargs, nStates=nSt, params=copy.deepcopy(params[m]))
+            jobs.append((len(jobs), cell, dataSet, jobKwargs))
+    nJobs = len(jobs)
+
+    if verbose > 0:
+        print("\n================================================================================")
+        print("Fitting {} model{} to {} cells with {} worker{}".format(len(nStates), 's' if len(nStates) > 1 else '',
+                                                                   len(cells), workers, 's' if workers > 1 else ''))
+        print("================================================================================")
+
+    t0 = wallTime()
+    rows = [None for job in jobs]
+    fitParams = {}
+    pool = multiprocessing.Pool(min(workers, nJobs)) if workers > 1 and nJobs > 1 else None
+    try:
+        results = pool.imap_unordered(_fitCellWorker, jobs) if pool is not None else map(_fitCellWorker, jobs)
+        for done, (ind, cell, nSt, fittedParams, stats, fitTime, error) in enumerate(results, 1):
+            row = dict(cell=cell, nStates=nSt, time=fitTime, error=error)
+            if error is None:
+                row.update(stats)
+                row.update(fittedParams.valuesdict())
+                fitParams[(cell, nSt)] = fittedParams
+            rows[ind] = row
+            if verbose > 0:
+                if error is None:
+                    print("[{}/{}] {} ({}-state): chi^2 = {:.4g} in {:.3g}s".format(done, nJobs, cell, nSt, stats['chisqr'], fitTime))
+                else:
+                    print("[{}/{}] {} ({}-state): FAILED after {:.3g}s - {}".format(done, nJobs, cell, nSt, fitTime, error))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    population = PopulationFit(rows, fitParams)
+    if verbose > 0:
+        print("--------------------------------------------------------------------------------")
+        print("{} in {:.3g}s".format(population, wallTime() - t0))
+        print("================================================================================\n")
+
+    return population
+
+
+def fitStages(fluxSet, quickSet, run, vInd, params, nStates, method=defMethod, verbose=config.verbose):
+    """Run the staged (off-phase then on-phase) fits for a model from the initial values in params (fluxSet may be a FitData view)"""
+
+    if nStates == 3:
+        return fit3states(fluxSet, run, vInd, params, method, verbose)
+    elif nStates == 4:
+        return fit4states(fluxSet, run, vInd, params, method, verbose)
+    elif nStates == 6:
+        return fit6states(fluxSet, quickSet, run, vInd, params, method, verbose)
+    else:
+        raise Exception('Invalid choice for nStates: {}!'.format(nStates))
+
+
+def postFitOptimise(fluxSet, run, vInd, fittedParams, nStates, constrainedParams, nonOptParams, relaxFact=2, method=defMethod, verbose=config.verbose):
+    """Relax all parameters (except nonOptParams) and reoptimise over whole photocurrent cycles"""
+
+    data = getFitData(fluxSet, run, vInd)
+
+    if verbose > 1:
+        print("\n\nPerforming post-fit optimisation with the '{}' algorithm [relaxFact={}]!".format(method, relaxFact))
+
+    assert(relaxFact >= 1)
+
+    for p in constrainedParams:
+        setBounds(fittedParams[p], relaxFact)
+
+    for p in fittedParams:
+        if p not in nonOptParams:
+            fittedParams[p].vary = True
+
+    RhO = models[str(nStates)]()
+    postPmin = minimize(errCycle, fittedParams, args=(data,RhO), method=method)
+
+    if verbose > 0:
+        reportFit(postPmin, "Post-fit optimisation report for the {}-state model".format(nStates), method)
+
+    return postPmin
+
+
+def warmStart(params, fittedParams):
+    """Copy params (keeping their bounds and vary flags) with initial values from fittedParams"""
+    warm = copy.deepcopy(params)
+    for p in warm:
+        if p in fittedParams and warm[p].expr is None:
+            warm[p].value = np.clip(fittedParams[p].value, warm[p].min, warm[p].max)
+    return warm
+
+
+def fitMultiRes(fluxSet, quickSet, run, vInd, params, nStates, constrainedParams, nonOptParams,
+                factors=(16, 4, 1), postFitOpt=True, relaxFact=2, method=defMethod,
+                postFitOptMethod=None, verbose=config.verbose):
+    """
+    Coarse-to-fine fit: run the staged fits (and post-fit optimisation) on
+    the most decimated data (see FitData.decimate) then refine the fit on
+    progressively finer data, warm-starting each level from the parameters fit
+    at the previous one. The final factor should be 1 to finish on the full
+    resolution data.
+    """
+
+    data = getFitData(fluxSet, run, vInd)
+    if postFitOptMethod is None:
+        postFitOptMethod = method
 
-def fitModel(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, method=defMethod, postFitOptMethod=None, verbose=config.verbose):
-    """Fit a model (with initial parameters) to a dataset of optogenetic photocurrents"""
+    levelData = data.decimate(factors[0])
+    if verbose > 0:
+        print("Fitting at resolution level 1 of {}: {} points".format(len(factors), len(levelData.Ion)+len(levelData.Ioff)))
+    fittedParams, miniObj = fitStages(levelData, quickSet, run, vInd, params, nStates, method, verbose)
+    if postFitOpt:
+        miniObj = postFitOptimise(levelData, run, vInd, fittedParams, nStates, constrainedParams,
+                                  nonOptParams, relaxFact, postFitOptMethod, verbose)
+        if len(factors) > 1:
+            return refineFit(data, run, vInd, miniObj.params, nStates, factors[1:], postFitOptMethod, verbose)
+        return miniObj.params, miniObj
+
+    for level, factor in enumerate(factors[1:]):
+        levelData = data.decimate(factor)
+        if verbose > 0:
+            print("Fitting at resolution level {} of {}: {} points".format(level+2, len(factors), len(levelData.Ion)+len(levelData.Ioff)))
+        fittedParams, miniObj = fitStages(levelData, quickSet, run, vInd, warmStart(params, fittedParams),
+                                          nStates, method, verbose)
+    return fittedParams, miniObj
+
+
+def refineFit(fluxSet, run, vInd, fittedParams, nStates, factors, method=defMethod, verbose=config.verbose):
+    """
+    Refine a (post-fit optimised) set of parameters by reoptimising over whole
+    photocurrent cycles at each decimation factor in turn (finishing with 1).
+    """
+
+    data = getFitData(fluxSet, run, vInd)
+    RhO = models[str(nStates)]()
+    for level, factor in enumerate(factors):
+        levelData = data.decimate(factor)
+        miniObj = minimize(errCycle, fittedParams, args=(levelData, RhO), method=method)
+        fittedParams = miniObj.params
+        if verbose > 0:
+            reportFit(miniObj, "Refined fit for the {}-state model on 1/{} of the samples".format(nStates, factor), method)
+    return fittedParams, miniObj
+
+
+def sampleStarts(params, nStarts, sampler='lhs', spread=10, seed=None):
+    """
+    Generate a list of nStarts Parameters objects with initial values spread
+    over the bounds of the varying parameters. The first start keeps the
+    initial values given in params.
+
+    sampler := 'lhs' (Latin hypercube) or 'sobol' (scrambled Sobol sequence)
+    spread  := Factor limiting each positive parameter to [value/spread, value*spread]
+               within its bounds, sampled logarithmically
+    """
+
+    rng = np.random.RandomState(seed)
+    names = [p for p in params if params[p].vary and params[p].expr is None]
+    nDims = len(names)
+
+    if sampler == 'lhs':
+        u = (np.arange(nStarts)[:,None] + rng.rand(nStarts, nDims)) / nStarts
+        for d in range(nDims):
+            u[:,d] = u[rng.permutation(nStarts),d]
+    elif sampler == 'sobol':
+        from scipy.stats import qmc # Requires scipy >= 1.7
+        u = qmc.Sobol(nDims, scramble=True, seed=rng).random(nStarts)
+    else:
+        raise ValueError("Unknown sampler: '{}'. Choose from 'lhs' or 'sobol'.".format(sampler))
+
+    starts = [copy.deepcopy(params)]
+    for s in range(1, nStarts):
+        start = copy.deepcopy(params)
+        for d, p in enumerate(names):
+            value, pMin, pMax = start[p].value, start[p].min, start[p].max
+            if value > 0:
+                lo = np.log(max(pMin, value / spread))
+                hi = np.log(min(pMax, value * spread))
+                start[p].value = np.exp(lo + u[s,d] * (hi - lo))
+            elif np.isfinite(pMin) and np.isfinite(pMax):
+                start[p].value = pMin + u[s,d] * (pMax - pMin)
+        starts.append(start)
+
+    return starts
+
+
+def _fitStageWorker(job):
+    """Run the staged fits from one starting point (used by fitStarts)"""
+    ind, args = job
+    try:
+        fittedParams, miniObj = fitStages(*args)
+    except Exception: # Discard starts which fail e.g. from unphysical rates
+        return ind, None, None, np.inf
+    chisqr = miniObj.chisqr if np.isfinite(miniObj.chisqr) else np.inf
+    return ind, fittedParams, miniObj, chisqr
+
+
+def _postFitWorker(job):
+    """Run the post-fit optimisation from one starting point (used by fitStarts)"""
+    ind, args = job
+    try:
+        miniObj = postFitOptimise(*args)
+    except Exception:
+        return ind, None, np.inf
+    chisqr = miniObj.chisqr if np.isfinite(miniObj.chisqr) else np.inf
+    return ind, miniObj, chisqr
+
+
+def _mapJobs(worker, jobs, workers):
+    """Map jobs over a pool of worker processes (or serially if workers <= 1)"""
+    if workers <= 1 or len(jobs) <= 1:
+        return [worker(job) for job in jobs]
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    try:
+        return pool.map(worker, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fitStarts(fluxSet, quickSet, run, vInd, params, nStates, constrainedParams, nonOptParams,
+              nStarts=8, sampler='lhs', keepFrac=0.25, postFitOpt=True, relaxFact=2,
+              method=defMethod, postFitOptMethod=None, workers=None, seed=None, verbose=config.verbose):
+    """
+    Multi-start fit: run the staged fits from nStarts initial points sampled
+    within the parameter bounds in parallel, stop all but the best keepFrac
+    of them and carry these through the post-fit optimisation.
+
+    Returns the best Parameters and minimizer result. The minimizer result
+    has a ``starts`` attribute holding the ranked (start, stage chi^2, final chi^2)
+    summary, with final chi^2 = None for starts which were stopped early.
+    """
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if postFitOptMethod is None:
+        postFitOptMethod = method
+
+    fluxSet = getFitData(fluxSet, run, vInd) # Shared by (and sent once to) each start
+    starts = sampleStarts(params, nStarts, sampler, seed=seed)
+
+    ### Stage fits for every start (quiet since these run concurrently)
+    jobs = [(i, (fluxSet, quickSet, run, vInd, starts[i], nStates, method, 0))
+            for i in range(nStarts)]
+    stageResults = sorted(_mapJobs(_fitStageWorker, jobs, workers), key=lambda r: r[3])
+    stageChisqr = {ind: chisqr for ind, _, _, chisqr in stageResults}
+    if not np.isfinite(stageResults[0][3]):
+        raise RuntimeError("All {} starts failed to fit the {}-state model!".format(nStarts, nStates))
+
+    ### Early stopping: only refine the most promising starts
+    nKeep = max(1, int(np.ceil(keepFrac * nStarts)))
+    kept = [r for r in stageResults[:nKeep] if np.isfinite(r[3])]
+
+    if postFitOpt:
+        jobs = [(ind, (fluxSet, run, vInd, fittedParams, nStates, constrainedParams,
+                       nonOptParams, relaxFact, postFitOptMethod, 0))
+                for ind, fittedParams, _, _ in kept]
+        finalResults = [(ind, miniObj.params if miniObj is not None else None, miniObj, chisqr)
+                        for ind, miniObj, chisqr in _mapJobs(_postFitWorker, jobs, workers)]
+        finalResults.sort(key=lambda r: r[3])
+    else:
+        finalResults = kept
+
+    bestInd, bestParams, bestMiniObj, bestChisqr = finalResults[0]
+    finalChisqr = {ind: chisqr for ind, _, _, chisqr in finalResults}
+    ranking = [(ind, stageChisqr[ind], finalChisqr[ind]) for ind, _, _, _ in finalResults]
+    ranking += [(ind, stageChisqr[ind], None) for ind, _, _, _ in stageResults if ind not in finalChisqr]
+    bestMiniObj.starts = ranking
+
+    if verbose > 0:
+        print("\nMulti-start summary for the {}-state model ({} '{}' starts, {} refined):".format(nStates, nStarts, sampler, len(kept)))
+        print("--------------------------------------------------------------------------------")
+        print("Rank    Start     Stage Chi^2     Final Chi^2")
+        for rank, (ind, stage, final) in enumerate(ranking):
+            print("{:4d} {:8d} {:15.4g} {:>15}".format(rank+1, ind, stage,
+                                                   '{:.4g}'.format(final) if final is not None else 'stopped'))
+        print("--------------------------------------------------------------------------------")
+        print("Best fit from start {}: Chi^2 = {:.4g}\n".format(bestInd, bestChisqr))
+
+    return bestParams, bestMiniObj
+
+
+def _printIntervals(params, cis, description):
+    """Print confidence intervals for the fitted parameters"""
+    print("\n--------------------------------------------------------------------------------")
+    print(description)
+    print("--------------------------------------------------------------------------------")
+    print('Parameter'.ljust(10), 'Fit'.rjust(12), 'Lower'.rjust(12), 'Upper'.rjust(12))
+    for p in cis:
+        print(p.ljust(10), '{:12.4g} {:12.4g} {:12.4g}'.format(params[p].value, cis[p][0], cis[p][1]))
+    print("================================================================================\n")
+
+
+def resampleBlocks(residuals, lengths, blockLength=None, rng=np.random):
+    """
+    Circular block bootstrap of the residuals of each segment (of the given
+    lengths) to preserve their autocorrelation. The default blockLength is the
+    cube root of each segment's length.
+    """
+    resampled = np.empty_like(residuals)
+    start = 0
+    for n in lengths:
+        b = blockLength if blockLength is not None else max(1, int(round(n ** (1/3))))
+        b = min(b, n)
+        nBlocks = int(np.ceil(n / b))
+        inds = (rng.randint(0, n, nBlocks)[:,None] + np.arange(b)).ravel()[:n] % n
+        resampled[start:start+n] = residuals[start:start+n][inds]
+        start += n
+    return resampled
+
+
+def _bootstrapWorker(job):
+    """Refit whole photocurrent cycles to one bootstrap sample (used by bootstrapFit)"""
+    ind, seed, kind, data, IonFit, IoffFit, blockLength, factor, params, nStates, method = job
+    rng = np.random.RandomState(seed)
+    if kind == 'case': # Resample the trials
+        sample = data.select(rng.randint(0, data.nTrials, data.nTrials))
+    else: # Add resampled residuals to the fitted currents
+        Ion = IonFit + resampleBlocks(data.Ion - IonFit, data.onLengths, blockLength, rng)
+        Ioff = IoffFit + resampleBlocks(data.Ioff - IoffFit, data.offLengths, blockLength, rng)
+        offStarts = np.cumsum(data.offLengths) - data.offLengths
+        Ioff[offStarts] = data.Ioff[offStarts] # Shared with the on-phase and used for normalisation
+        sample = data.withCurrents(Ion, Ioff)
+    RhO = models[str(nStates)]()
+    try:
+        miniObj = minimize(errCycle, copy.deepcopy(params), args=(sample.decimate(factor), RhO), method=method)
+    except Exception: # Discard samples which fail e.g. from unphysical rates
+        return ind, None
+    if not np.isfinite(miniObj.chisqr):
+        return ind, None
+    return ind, miniObj.params.valuesdict()
+
+
+def bootstrapFit(fluxSet, nStates, fittedParams, nBoot=200, kind='residual', blockLength=None,
+                 alpha=0.05, run=0, vInd=0, factor=1, method='lbfgsb', workers=None, seed=None,
+                 verbose=config.verbose):
+    """
+    Bootstrap confidence intervals for the parameters of a fitted model.
+
+    The model is refit over whole photocurrent cycles (see errCycle) to nBoot
+    resampled datasets in a pool of ``workers`` processes (default: one per CPU),
+    warm-starting from fittedParams (e.g. as returned by fitModel). Only the
+    parameters which vary in fittedParams are refit. The refits are local so
+    the default method is 'lbfgsb', which converges more tightly than the
+    derivative-free methods used to find the fit (and unlike 'leastsq' does not
+    stall on parameters at their bounds).
+
+    kind := 'residual' (block-resampled residuals added to the fitted currents; see resampleBlocks)
+            'case' (trials resampled with replacement; requires several fluxes)
+    factor := Decimation factor applied to each sample to speed up the refits
+              (see FitData.decimate). The fit is first refined at this resolution.
+
+    Returns a dictionary of (lower, upper) percentile intervals at the
+    (1-alpha) level and a dictionary of arrays of the bootstrapped values.
+    """
+
+    data = getFitData(fluxSet, run, vInd)
+    if kind not in ('residual', 'case'):
+        raise ValueError("Unknown bootstrap: '{}'. Choose from 'residual' or 'case'.".format(kind))
+    if kind == 'case' and data.nTrials < 2:
+        raise ValueError("Case bootstrapping requires more than one trial")
+
+    RhO = models[str(nStates)]()
+    if factor > 1: # Re-centre the fit at the resolution of the refits
+        fittedParams = minimize(errCycle, copy.deepcopy(fittedParams), args=(data.decimate(factor), RhO), method=method).params
+    IonFit, IoffFit = calcCycleCurrents(fittedParams, data, RhO)
+    names = [p for p in fittedParams if fittedParams[p].vary and fittedParams[p].expr is None]
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, nBoot)
+    jobs = [(b, seeds[b], kind, data, IonFit, IoffFit, blockLength, factor, fittedParams, nStates, method)
+            for b in range(nBoot)]
+
+    t0 = wallTime()
+    results = [values for ind, values in _mapJobs(_bootstrapWorker, jobs, workers) if values is not None]
+    if len(results) == 0:
+        raise RuntimeError("All bootstrap refits failed")
+
+    samples = dict((p, np.array([values[p] for values in results])) for p in names)
+    cis = dict((p, tuple(np.percentile(samples[p], [100*alpha/2, 100*(1-alpha/2)]))) for p in names)
+
+    if verbose > 0:
+        _printIntervals(fittedParams, cis, "{:.3g}% {} bootstrap intervals for the {}-state model ({} of {} refits in {:.3g}s)"
+                        .format(100*(1-alpha), kind, nStates, len(results), nBoot, wallTime() - t0))
+
+    return cis, samples
+
+
+def _profileWorker(job):
+    """Profile the objective for one parameter in one direction from the fit (used by profileFit)"""
+    name, values, data, params, nStates, method, threshold = job
+    RhO = models[str(nStates)]()
+    profParams = copy.deepcopy(params)
+    profParams[name].vary = False
+    chisqrs = []
+    for value in values: # Step away from the fit, warm-starting from the previous point
+        profParams[name].value = value
+        try:
+            miniObj = minimize(errCycle, profParams, args=(data, RhO), method=method)
+        except Exception:
+            break
+        chisqrs.append(miniObj.chisqr)
+        profParams = miniObj.params
+        if not miniObj.chisqr <= threshold: # Outside the interval (or failed)
+            break
+    return name, values[:len(chisqrs)], np.array(chisqrs)
+
+
+def profileFit(fluxSet, nStates, fittedParams, names=None, nPoints=8, spread=4, alpha=0.05,
+               run=0, vInd=0, factor=1, method='lbfgsb', workers=None, verbose=config.verbose):
+    """
+    Profile-likelihood confidence intervals for the parameters of a fitted model.
+
+    Each parameter (default: all varying parameters of fittedParams) is
+    stepped away from its fitted value in up to nPoints logarithmic steps
+    towards [value/spread, value*spread] (within its bounds) and the remaining
+    parameters are refit over whole photocurrent cycles (see errCycle) at each
+    step, warm-starting from the previous one (with 'lbfgsb' by default, see
+    bootstrapFit). The scans for each parameter
+    and direction run in parallel in a pool of ``workers`` processes and stop
+    once chi^2 rises above the likelihood-ratio threshold (scaled by the
+    reduced chi^2 of the fit). With factor > 1 the data are decimated (see
+    FitData.decimate) and the fit is first refined at that resolution. The residuals of densely sampled currents are
+    correlated so the intervals may be optimistic (c.f. bootstrapFit).
+
+    Returns a dictionary of (lower, upper) intervals at the (1-alpha) level
+    (nan where the profile does not cross the threshold within the scanned
+    range) and a dictionary of the (values, chisqrs) profiles.
+    """
+
+    data = getFitData(fluxSet, run, vInd).decimate(factor)
+    varying = [p for p in fittedParams if fittedParams[p].vary and fittedParams[p].expr is None]
+    if names is None:
+        names = varying
+
+    RhO = models[str(nStates)]()
+    if factor > 1: # Re-centre the fit at the resolution of the profiles
+        fittedParams = minimize(errCycle, copy.deepcopy(fittedParams), args=(data, RhO), method=method).params
+    chisqr0 = np.sum(errCycle(fittedParams, data, RhO)**2)
+    nData = np.sum(data.onWeight**2) + np.sum(data.offTailWeight**2) # Samples represented
+    redchi = chisqr0 / (nData - len(varying))
+    threshold = chisqr0 + redchi * chi2.ppf(1 - alpha, 1)
+
+    jobs = []
+    for p in names:
+        value, pMin, pMax = fittedParams[p].value, fittedParams[p].min, fittedParams[p].max
+        if value > 0:
+            lower = np.geomspace(value, max(pMin, value/spread), nPoints+1)[1:]
+            upper = np.geomspace(value, min(pMax, value*spread), nPoints+1)[1:]
+        else:
+            span = abs(value) * (spread - 1) if value != 0 else 1
+            lower = np.linspace(value, max(pMin, value - span), nPoints+1)[1:]
+            upper = np.linspace(value, min(pMax, value + span), nPoints+1)[1:]
+        lower, upper = lower[lower < value], upper[upper > value] # At a bound
+        jobs.append((p, lower, data, fittedParams, nStates, method, threshold))
+        jobs.append((p, upper, data, fittedParams, nStates, method, threshold))
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    t0 = wallTime()
+    results = _mapJobs(_profileWorker, jobs, workers)
+
+    def crossing(value, values, chisqrs):
+        """Interpolate the value where the profile crosses the threshold"""
+        outside = np.nonzero(~(chisqrs <= threshold))[0]
+        if len(outside) == 0:
+            return np.nan
+        i = outside[0]
+        vIn, cIn = (values[i-1], chisqrs[i-1]) if i > 0 else (value, chisqr0)
+        if not np.isfinite(chisqrs[i]):
+            return values[i]
+        return vIn + (values[i] - vIn) * (threshold - cIn) / (chisqrs[i] - cIn)
+
+    cis, profiles = {}, {}
+    for (name, lowVals, lowChis), (_, upVals, upChis) in zip(results[::2], results[1::2]):
+        profiles[name] = (np.r_[lowVals[::-1], fittedParams[name].value, upVals],
+                          np.r_[lowChis[::-1], chisqr0, upChis])
+        value = fittedParams[name].value
+        cis[name] = (crossing(value, lowVals, lowChis), crossing(value, upVals, upChis))
+
+    if verbose > 0:
+        _printIntervals(fittedParams, cis, "{:.3g}% profile-likelihood intervals for the {}-state model ({:.3g}s)"
+                        .format(100*(1-alpha), nStates, wallTime() - t0))
+
+    return cis, profiles
+
+
+class FitStore(object):
+    """
+    Persistent store of fit results indexed by a fingerprint of the dataset and model.
+
+    Each result (fitted parameters, minimizer result, chi^2, method, settings
+    and timing) is pickled to its own file in ``path`` (default: dDir/fitStore)
+    so that concurrent fits may share a store. fitModel skips fits which exactly
+    match a stored result and otherwise warm-starts from the result for the
+    most similar dataset (see describe).
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(config.dDir, 'fitStore')
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @staticmethod
+    def fingerprint(dataSet):
+        """Hash the photocurrents of a (dictionary of) dataset(s) (independent of time alignment)"""
+        md5 = hashlib.md5()
+
+        def update(data):
+            if isinstance(data, dict):
+                for key in sorted(data):
+                    md5.update(str(key).encode())
+                    update(data[key])
+            elif isinstance(data, ProtocolData):
+                for run in range(data.nRuns):
+                    for phiInd in range(data.nPhis):
+                        for vInd in range(data.nVs):
+                            if data.trials[run][phiInd][vInd] is not None:
+                                update(data.trials[run][phiInd][vInd])
+            elif isinstance(data, PhotoCurrent):
+                t0 = data.t[0]
+                for arr in [data.I, data.t - t0, data.pulses - t0]:
+                    md5.update(np.ascontiguousarray(arr, dtype=float).tobytes())
+                md5.update(repr((data.phi, data.V)).encode())
+            else:
+                md5.update(repr(data).encode())
+
+        update(dataSet)
+        return md5.hexdigest()
+
+    @staticmethod
+    def describe(fitData):
+        """Summarise a FitData set (log flux, voltage, peak and plateau currents of each trial) to compare datasets"""
+        order = np.argsort(fitData.phis)
+        Ipeaks = np.array([Ion[np.argmax(abs(Ion))] for Ion in fitData.Ions])
+        Iscale = max(abs(Ipeaks)) if max(abs(Ipeaks)) > 0 else 1
+        return np.r_[np.log10(fitData.phis[order]), fitData.Vs[order] / 100,
+                     Ipeaks[order] / Iscale, fitData.nfs[order] / Iscale]
+
+    @staticmethod
+    def dumpParams(params):
+        """Canonical description of the initial values, constraints and bounds of a set of Parameters"""
+        return tuple((name, repr(params[name].value), params[name].vary, repr(params[name].min),
+                      repr(params[name].max), params[name].expr) for name in sorted(params))
+
+    def key(self, fingerprint, nStates, settings):
+        """Key of a result for a dataset fingerprint, model and fitting settings"""
+        return '{}s-{}'.format(nStates, hashlib.md5((fingerprint + repr(sorted(settings.items()))).encode()).hexdigest())
+
+    def records(self, nStates=None):
+        """Load all stored results (for a model)"""
+        pattern = '{}s-*.pkl'.format(nStates) if nStates is not None else '*.pkl'
+        records = []
+        for fileName in sorted(glob.glob(os.path.join(self.path, pattern))):
+            with open(fileName, 'rb') as fh:
+                records.append(pickle.load(fh))
+        return records
+
+    def get(self, key):
+        """Return the stored result for a key or None"""
+        fileName = os.path.join(self.path, key + '.pkl')
+        if not os.path.isfile(fileName):
+            return None
+        with open(fileName, 'rb') as fh:
+            return pickle.load(fh)
+
+    def nearest(self, nStates, description):
+        """Return the stored result for the model with the most similar dataset description or None"""
+        best, bestDist = None, np.inf
+        for record in self.records(nStates):
+            if len(record['description']) != len(description):
+                continue
+            dist = np.linalg.norm(record['description'] - description)
+            if dist < bestDist:
+                best, bestDist = record, dist
+        return best
+
+    def add(self, key, record):
+        """Store a result (written atomically)"""
+        record['key'] = key
+        fileName = os.path.join(self.path, key + '.pkl')
+        tmpName = '{}.{}.tmp'.format(fileName, os.getpid())
+        with open(tmpName, 'wb') as fh:
+            pickle.dump(record, fh)
+        try:
+            os.replace(tmpName, fileName) # Atomic (Python 3.3+)
+        except AttributeError:
+            os.rename(tmpName, fileName)
+
+
+def fitModel(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, method=defMethod, postFitOptMethod=None,
+             nStarts=1, sampler='lhs', keepFrac=0.25, workers=None, seed=None, multiRes=None,
+             store=None, refit=False, plot=True, verbose=config.verbose):
+    """
+    Fit a model (with initial parameters) to a dataset of optogenetic photocurrents
+
+    With nStarts > 1 the staged fits are repeated from starting points sampled
+    within the parameter bounds (sampler = 'lhs' or 'sobol') in a pool of
+    workers. Only the best keepFrac of the starts are refined by the post-fit
+    optimisation and the best result is returned (see fitStarts).
+
+    multiRes is an optional coarse-to-fine schedule of decimation factors
+    e.g. (16, 4, 1): the model is fit to adaptively decimated data first and
+    refined on progressively finer data (see fitMultiRes). Multiple starts are
+    run at the coarsest level and the best is refined through the rest.
+
+    store may be a FitStore (or True for the default store) to record the
+    result. A stored fit of the same data, model, initial parameters (values,
+    vary flags, bounds and expressions) and settings is returned without
+    refitting (unless refit=True) and otherwise the fit is warm-started from
+    the stored result for the most similar dataset.
+
+    plot=False skips the figures and the exported parameters file.
+    """
 
 
     ### Define non-optimised parameters to exclude in post-fit optimisation
@@ -1766,8 +2635,24 @@ def fitModel(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, meth
         print("Error in selecting model - please choose from 3, 4 or 6 states")
         raise NotImplementedError(nStates)
 
+    t0 = wallTime()
+
+    if store is True:
+        store = FitStore()
+    if store:
+        settings = dict(postFitOpt=postFitOpt, relaxFact=relaxFact, method=method,
+                        postFitOptMethod=postFitOptMethod if postFitOptMethod is not None else method,
+                        nStarts=nStarts, sampler=sampler, keepFrac=keepFrac, seed=seed,
+                        multiRes=None if multiRes is None else tuple(multiRes),
+                        params=FitStore.dumpParams(params if params is not None else modelParams[str(nStates)]))
+        storeKey = store.key(FitStore.fingerprint(dataSet), nStates, settings)
+        record = store.get(storeKey) if not refit else None
+        if record is not None:
+            if verbose > 0:
+                print("Found a stored {}-state fit for this dataset (chi^2 = {:.4g}) - skipping refit".format(nStates, record['chisqr']))
+            return record['params'], record['miniObj']
+
     if verbose > 0:
-        t0 = wallTime()
         print("\n================================================================================")
         print("Fitting parameters for the {}-state model with the '{}' algorithm... ".format(nStates, method))
         print("================================================================================\n")
@@ -1779,8 +2664,8 @@ def fitModel(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, meth
 
     ### Could use precalculated lookup tables to find the values of steady state O1 & O2 occupancies?
 
-    if params is None:
-        params = modelParams[str(nStates)]
+    if params is None: # Copy the defaults so that they are not changed by the fit
+        params = copy.deepcopy(modelParams[str(nStates)])
 
     if isinstance(dataSet, dict):
         if 'step' in dataSet:
@@ -1794,16 +2679,17 @@ def fitModel(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, meth
 
 
     # Determine the data type passed
+    # The data are not copied: the fits read from a FitData view built below
     if isinstance(dataSet, PhotoCurrent): # Single photocurrent
         nRuns = 1
         nPhis = 1
         nVs = 1
-        pc = copy.deepcopy(dataSet)
+        pc = dataSet
         setPC = ProtocolData(fluxKey, nRuns, [pc.phi], [pc.V])
         setPC.trials[0][0][0] = pc
         dataSet = {fluxKey:setPC}
     elif isinstance(dataSet, ProtocolData): # Set of photocurrents
-        setPC = copy.deepcopy(dataSet)
+        setPC = dataSet
         nRuns = setPC.nRuns
         nPhis = setPC.nPhis
         nVs = setPC.nVs
@@ -1812,7 +2698,7 @@ def fitModel(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, meth
         nRuns = 1
         nPhis = 1
         nVs = 1
-        pc = copy.deepcopy(dataSet[fluxKey])
+        pc = dataSet[fluxKey]
         setPC = ProtocolData(fluxKey, nRuns, [pc.phi], [pc.V])
         setPC.trials[0][0][0] = pc
         dataSet = {fluxKey:setPC}
@@ -1877,7 +2763,8 @@ def fitModel(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, meth
         rectKey = fluxKey
     else:
         rectKey = None
-        print("Only one voltage clamp value found [{}] - fixing parameters of f(v): ".format(setPC.Vs[0]), end='')
+        if verbose > 0:
+            print("Only one voltage clamp value found [{}] - fixing parameters of f(v): ".format(setPC.Vs[0]), end='')
 
     if rectKey is not None:
         if verbose > 0:
@@ -1893,7 +2780,8 @@ def fitModel(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, meth
     params['v0'].vary = False
     params['v1'].vary = False
 
-    print('E = {} mV; v0 = {} mV**-1; v1 = {} mV**-1'.format(params['E'].value, params['v0'].value, params['v1'].value))
+    if verbose > 0:
+        print('E = {} mV; v0 = {} mV**-1; v1 = {} mV**-1'.format(params['E'].value, params['v0'].value, params['v1'].value))
 
 
     ### Find most extreme peak current in the fluxSet: Ipmax
@@ -1921,13 +2809,15 @@ def fitModel(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, meth
             Vpmax = Vsat
             peakKey = 'delta'
 
-    print("Estimating g0 from '{}'; Ipmax = {:.3} nA: ".format(peakKey, Ipmax), end='')
+    if verbose > 0:
+        print("Estimating g0 from '{}'; Ipmax = {:.3} nA: ".format(peakKey, Ipmax), end='')
 
     ### Maximum conductance: g0
     assert(Vpmax != params['E'].value)
     g0 = 1e6 * Ipmax / (Vpmax - params['E'].value)
     params['g0'].value = g0
-    print('g0 = {} pS'.format(round_sig(g0, n=3)))
+    if verbose > 0:
+        print('g0 = {} pS'.format(round_sig(g0, n=3)))
 
 
 
@@ -1943,7 +2833,8 @@ def fitModel(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, meth
         if verbose > 0:
             print('Recovery protocol not found, fixing initial value: ', end='')
     params['Gr0'].vary = False
-    print('Gr0 = {} ms**-1'.format(params['Gr0'].value))
+    if verbose > 0:
+        print('Gr0 = {} ms**-1'.format(params['Gr0'].value))
 
 
     if 'shortPulse' in dataSet:
@@ -1975,75 +2866,84 @@ def fitModel(dataSet, nStates=3, params=None, postFitOpt=True, relaxFact=2, meth
 
 
     if nStates == 3:
-        #phiFits[phiInd] = fit3states(I,t,onInd,offInd,phi,V,Gr0,gmax,Ipmax,params=pOns,method=method)#,Iss)
-        fittedParams, miniObj = fit3states(setPC, runInd, vIndm70, fitParams, method, verbose)
         constrainedParams = ['Gd']
     elif nStates == 4:
-        #phiFits[phiInd] = fit4states(I,t,onInd,offInd,phi,V,Gr0,gmax,params=pOns,method=method)
-        fittedParams, miniObj = fit4states(setPC, runInd, vIndm70, fitParams, method, verbose)
         constrainedParams = ['Gd1', 'Gd2', 'Gf0', 'Gb0']
     elif nStates == 6:
-        fittedParams, miniObj = fit6states(setPC, quickSet, runInd, vIndm70, fitParams, method, verbose)
         constrainedParams = ['Gd1', 'Gd2', 'Gf0', 'Gb0', 'Go1', 'Go2']
         #constrainedParams = ['Go1', 'Go2', 'Gf0', 'Gb0']
         #nonOptParams.append(['Gd1', 'Gd2'])
     else:
         raise Exception('Invalid choice for nStates: {}!'.format(nStates))
 
+    if postFitOptMethod is None:
+        postFitOptMethod = method
 
-    if postFitOpt: # Relax all parameters (except nonOptParams) and reoptimise
-        PCs = [setPC.trials[runInd][phiInd][vIndm70] for phiInd in range(setPC.nPhis)]
-        Icycles = [pc.getCycle()[0] for pc in PCs]
-        nfs = [pc.I[pc.pulseInds[0,1]] for pc in PCs]
-        tons = [pc.getOnPhase()[1] for pc in PCs]
-        toffs = [pc.getOffPhase()[1] for pc in PCs]
-        Vs = [pc.V for pc in PCs]
-        phis = [pc.phi for pc in PCs]
-
-        if postFitOptMethod is None:
-            postFitOptMethod = method
+    fitData = FitData(setPC, runInd, vIndm70) # Shared by all fitting stages
 
-        if verbose > 1:
-            print("\n\nPerforming post-fit optimisation with the '{}' algorithm [relaxFact={}]!".format(postFitOptMethod, relaxFact))
+    if store:
+        description = FitStore.describe(fitData)
+        nearest = store.nearest(nStates, description)
+        if nearest is not None: # Warm-start the rates (g0 is estimated from these data)
+            if verbose > 0:
+                print("Warm-starting from the stored fit of the most similar dataset ({})".format(nearest['key']))
+            for p in fitParams:
+                if fitParams[p].vary and fitParams[p].expr is None and p != 'g0' and p in nearest['params']:
+                    fitParams[p].value = np.clip(nearest['params'][p].value, fitParams[p].min, fitParams[p].max)
 
-        assert(relaxFact >= 1)
-
-        for p in constrainedParams:
-            setBounds(fittedParams[p], relaxFact)
-
-        for p in fittedParams:
-            if p not in nonOptParams:
-                fittedParams[p].vary = True
-
-        RhO = models[str(nStates)]()
-        postPmin = minimize(errCycle, fittedParams, args=(Icycles,tons,toffs,nfs,RhO,Vs,phis), method=postFitOptMethod)
-        #optParams = postPmin.params
-
-        if verbose > 0:
-            reportFit(postPmin, "Post-fit optimisation report for the {}-state model".format(nStates), postFitOptMethod)
-
-        # Create new Parameters object to ensure the default ordering
-        orderedParams = Parameters()
-        for p in params:
-            copyParam(p, postPmin.params, orderedParams)
-
-        miniObj = postPmin
+    if multiRes is not None and len(multiRes) > 0:
+        startData, refineFactors = fitData.decimate(multiRes[0]), multiRes[1:]
     else:
-        # Create new Parameters object to ensure the default ordering
-        orderedParams = Parameters()
-        for p in params:
-            copyParam(p, fittedParams, orderedParams)
-
-
-    for trial in range(len(PCs)):
-        plotFit(PCs[trial], nStates, orderedParams, fitRates=False, index=trial)#, postPmin, fitRates=False, index=trial)
-
-    exportName = 'fitted{}sParams.pkl'.format(nStates)
-    with open(os.path.join(config.dDir, exportName), "wb") as fh:
-        pickle.dump(orderedParams, fh)
-
-    # Plot set of curves
-    plotFluxSetFits(fluxSet=setPC, nStates=nStates, params=orderedParams)
+        startData, refineFactors = fitData, []
+
+    if nStarts > 1:
+        fittedParams, miniObj = fitStarts(startData, quickSet, runInd, vIndm70, fitParams,
+                                          nStates, constrainedParams, nonOptParams,
+                                          nStarts=nStarts, sampler=sampler, keepFrac=keepFrac,
+                                          postFitOpt=postFitOpt, relaxFact=relaxFact,
+                                          method=method, postFitOptMethod=postFitOptMethod,
+                                          workers=workers, seed=seed, verbose=verbose)
+        if len(refineFactors) > 0 and postFitOpt:
+            fittedParams, miniObj = refineFit(fitData, runInd, vIndm70, fittedParams, nStates,
+                                              refineFactors, postFitOptMethod, verbose)
+        elif len(refineFactors) > 0:
+            fittedParams, miniObj = fitMultiRes(fitData, quickSet, runInd, vIndm70,
+                                                warmStart(fitParams, fittedParams), nStates,
+                                                constrainedParams, nonOptParams, refineFactors,
+                                                postFitOpt, relaxFact, method, postFitOptMethod, verbose)
+    elif multiRes is not None and len(multiRes) > 0:
+        fittedParams, miniObj = fitMultiRes(fitData, quickSet, runInd, vIndm70, fitParams, nStates,
+                                            constrainedParams, nonOptParams, multiRes,
+                                            postFitOpt, relaxFact, method, postFitOptMethod, verbose)
+    else:
+        fittedParams, miniObj = fitStages(fitData, quickSet, runInd, vIndm70, fitParams,
+                                          nStates, method, verbose)
+        if postFitOpt: # Relax all parameters (except nonOptParams) and reoptimise
+            miniObj = postFitOptimise(fitData, runInd, vIndm70, fittedParams, nStates,
+                                      constrainedParams, nonOptParams, relaxFact,
+                                      postFitOptMethod, verbose)
+            fittedParams = miniObj.params
+
+    # Create new Parameters object to ensure the default ordering
+    orderedParams = Parameters()
+    for p in params:
+        copyParam(p, fittedParams, orderedParams)
+
+    if plot:
+        for trial in range(len(PCs)):
+            plotFit(PCs[trial], nStates, orderedParams, fitRates=False, index=trial)#, postPmin, fitRates=False, index=trial)
+
+        exportName = 'fitted{}sParams.pkl'.format(nStates)
+        with open(os.path.join(config.dDir, exportName), "wb") as fh:
+            pickle.dump(orderedParams, fh)
+
+        # Plot set of curves
+        plotFluxSetFits(fluxSet=setPC, nStates=nStates, params=orderedParams)
+
+    if store:
+        store.add(storeKey, dict(params=orderedParams, miniObj=miniObj, chisqr=miniObj.chisqr,
+                                 redchi=miniObj.redchi, nStates=nStates, method=method,
+                                 settings=settings, description=description, time=wallTime() - t0))
 
     if verbose > 0:
         print('')
@@ -2068,9 +2968,12 @@ def plotFluxSetFits(fluxSet, nStates, params, runInd=0, vInd=0):
     colours = config.colours
     styles = config.styles
 
+    # Align copies of the photocurrents so that the data are not changed
+    PCs = [copy.deepcopy(fluxSet.trials[runInd][phiInd][vInd]) for phiInd in range(fluxSet.nPhis)]
+
     # Plot experimental data
     for phiInd in range(fluxSet.nPhis):
-        PC = fluxSet.trials[runInd][phiInd][vInd]
+        PC = PCs[phiInd]
         PC.alignToTime()
         phi = PC.phi
         setAx.plot(PC.t, PC.I, color=colours[phiInd%len(colours)],
@@ -2089,7 +2992,7 @@ def plotFluxSetFits(fluxSet, nStates, params, runInd=0, vInd=0):
         # see ProtocolData.plot()
 
         for phiInd in range(fluxSet.nPhis):
-            PC = fluxSet.trials[runInd][phiInd][vInd]
+            PC = PCs[phiInd]
             phi = PC.phi
             V = PC.V
 
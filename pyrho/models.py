@@ -154,6 +154,63 @@ class RhodopsinModel(PyRhOobject):
             s0 = self.s_0
         return odeint(self.solveStates, s0, t, args=(None,), Dfun=self.jacobian)
 
+    def calcSolns(self, ts, phis, s0s=None, lengths=None):
+        """
+        Solve the states for a set of trials with constant fluxes in one pass.
+
+        The transition matrices for all fluxes are diagonalised together and
+        the analytic solution s(t) = V*exp(lambda*t)*V^-1*s0 is evaluated over
+        the concatenated time arrays. If any matrix is (numerically) defective
+        the trials are integrated individually instead.
+
+        Parameters
+        ----------
+        ts : list of ndarrays or ndarray
+            Time arrays for each trial (shifted to start at 0) or their
+            concatenation (each starting at 0) if ``lengths`` is given.
+        phis : list of floats
+            Flux for each trial.
+        s0s : ndarray, optional
+            Initial states for each trial [nTrials x nStates] (default=s_0).
+        lengths : ndarray, optional
+            Length of each trial in the concatenated time array ``ts``.
+
+        Returns
+        -------
+        tuple
+            Concatenated states [sum(lengths) x nStates] and the length of each trial.
+        """
+        nTrials = len(phis)
+        if s0s is None:
+            s0s = np.tile(self.s_0, (nTrials, 1))
+        if lengths is None:
+            lengths = np.array([len(t) for t in ts])
+            tAll = np.concatenate([t - t[0] for t in ts])
+        else:
+            tAll = ts
+        ends = np.cumsum(lengths)
+
+        Js = np.empty((nTrials, self.nStates, self.nStates))
+        for trial, phi in enumerate(phis):
+            self.setLight(phi)
+            Js[trial] = self.jacobian(None, None)
+
+        lams, vecs = np.linalg.eig(Js)
+        if np.all(np.isfinite(lams)) and np.all(np.linalg.cond(vecs) < 1e10):
+            if not np.iscomplexobj(lams) or np.all(lams.imag == 0): # Avoid complex arithmetic where possible
+                lams, vecs = lams.real, vecs.real
+            coeffs = np.linalg.solve(vecs, s0s[..., np.newaxis])[..., 0]
+            modes = np.exp(np.repeat(lams, lengths, axis=0) * tAll[:, np.newaxis])
+            modes *= np.repeat(coeffs, lengths, axis=0)
+            states = np.concatenate([np.dot(modes[start:stop], vecs[trial].T).real
+                                     for trial, (start, stop) in enumerate(zip(ends-lengths, ends))])
+        else:
+            states = np.empty((len(tAll), self.nStates))
+            for trial, (start, stop) in enumerate(zip(ends-lengths, ends)):
+                self.setLight(phis[trial])
+                states[start:stop] = odeint(self.solveStates, s0s[trial], tAll[start:stop], Dfun=self.jacobian)
+        return states, lengths
+
     def plotActivation(self, actFunc, label=None, phis=np.logspace(12, 21, 1001), ax=None):
         if ax == None:
             ax = plt.gca()
@@ -602,33 +602,50 @@ protParams['recovery'].add_many(('phis',[1e17],             None,   None,   mole
 simUnitLabels = defaultdict(lambda: '')
 simUnitLabels['dt'] = 'ms'
 simUnitLabels['v_init'] = 'mV'
+simUnitLabels['dtMax'] = 'ms'
 
 simParamNotes = defaultdict(lambda: '')
 simParamNotes['cell'] = 'List of hoc files'
 simParamNotes['Vclamp'] = 'Use voltage clamp'
 simParamNotes['Vcomp'] = 'Compartment to record from'
 simParamNotes['expProb'] = 'Expresssion probability'
+simParamNotes['expVar'] = 'Coefficient of variation of expression level'
+simParamNotes['seed'] = 'Random seed for opsin expression'
 simParamNotes['v_init'] = 'Initialisation voltage'
 simParamNotes['CVode'] = 'Use variable timestep integrator'
 simParamNotes['dt'] = 'Numerical integration timestep'
+simParamNotes['adaptive'] = 'Output a non-uniform time grid: dense after light transitions, sparse on plateaus'
+simParamNotes['growth'] = 'Ratio between successive adaptive output steps'
+simParamNotes['dtMax'] = 'Largest adaptive output step'
+simParamNotes['dedup'] = 'Share the results of identical trials instead of simulating them again'
+simParamNotes['batch'] = 'Simulate all trials at once with one opsin per trial'
+simParamNotes['standalone'] = 'Use the C++ standalone device (cached builds)'
 
 #simParams = OrderedDict([('Python',Parameters()), ('NEURON',Parameters()), ('Brian',Parameters())])
 simParams = OrderedDict([('Python',PyRhOparameters()), ('NEURON',PyRhOparameters()), ('Brian',PyRhOparameters())])
 simList = list(simParams)
 
 
-simParams['Python'].add_many(('dt', 0.1, 0, None)) #'ms'
+simParams['Python'].add_many(('dt', 0.1, 0, None), #'ms'
+                             ('adaptive', False, False, True), # Grow the output step after each light transition
+                             ('growth', 1.05, 1, None),
+                             ('dtMax', 1.0, 0, None), #'ms'
+                             ('dedup', False, False, True)) # Simulate identical trials once (see trialCache)
 
 # atol
 simParams['NEURON'].add_many(('cell',   ['minimal.hoc'], None, None), #'morphology'
                              ('Vclamp', False,     False,  True), # Changed to False by default
                              ('Vcomp',  'soma',    None,   None),
                              ('expProb',1.0,       0.,     1.),
+                             ('expVar', 0.0,       0.,     None), # CV of g0 across rhodopsins
+                             ('seed',   0,         None,   None), # None for an unseeded draw
                              ('v_init', -65,       None,   None), # 'mV'
                              ('CVode',  False,     False,  True),
                              ('dt',     0.1,       0,   None)) # 'ms' #, 0.025
 
-simParams['Brian'].add_many(('dt', 0.1, 0, None)) #, # 'ms'
+simParams['Brian'].add_many(('dt', 0.1, 0, None), #, # 'ms'
+                            ('batch', False, False, True), # Run all trials in one network of clamped opsins
+                            ('standalone', False, False, True)) # Compile batches with the C++ standalone device
                             
 
 ### Move somewhere else e.g. base.py
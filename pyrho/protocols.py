@@ -10,6 +10,11 @@ import warnings
 import logging
 import os
 import abc
+import copy
+import hashlib
+import itertools
+import multiprocessing
+from collections import namedtuple
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -25,10 +30,161 @@ from pyrho.expdata import * #import loadData
 from pyrho.fitting import fitFV, errFV, fitfV, errfV, getRecoveryPeaks, fitRecovery
 from pyrho.models import *
 from pyrho.simulators import * # For characterise()
+from pyrho.simulators import TrialCache
 from pyrho.config import *
 from pyrho import config
 
-__all__ = ['protocols', 'selectProtocol', 'characterise']
+__all__ = ['protocols', 'selectProtocol', 'characterise', 'runBattery', 'Sweep', 'TrialSpec']
+
+
+TrialSpec = namedtuple('TrialSpec', ['run', 'phiInd', 'vInd', 'phi', 'V', 'cycles', 'delD', 'pulses', 'totT', 'stimulus', 'dt'])
+TrialSpec.__doc__ = """
+Immutable record describing one trial of a protocol (see Protocol.plan).
+
+run, phiInd, vInd : indexes of the trial in the protocol's ProtocolData
+phi, V : flux [ph/mm^2/s] and clamp voltage [mV] (or None)
+cycles, delD : read-only nPulses x 2 array of [onD, offD] and the delay [ms]
+pulses, totT : read-only nPulses x 2 array of [t_on, t_off] and the trial duration [ms]
+stimulus : tuple of the phi(t) functions for each pulse
+dt : time step [ms]
+"""
+
+
+class Pulse(object):
+    """
+    Analytic light flux phi(t) of a square pulse from start to end [ms].
+
+    Pulses are called with a time or an array of times like the splines they
+    replace and are zero outside [start, end] (c.f. ``ext=1``). Subclasses
+    override ``shape`` which is given the time since the pulse started.
+    """
+
+    ext = 1 # Zero outside the pulse as for splines
+
+    def __init__(self, start, end, phi):
+        self.start = start
+        self.end = end
+        self.phi = phi
+
+    def __repr__(self):
+        return "<{} [{:.4g}, {:.4g}]ms>".format(self.__class__.__name__, self.start, self.end)
+
+    def shape(self, tau):
+        return self.phi + 0 * tau
+
+    def get_knots(self):
+        return np.array([self.start, self.end])
+
+    def key(self):
+        """Canonical description of the pulse for comparing trials"""
+        return (self.__class__.__name__,) + tuple(sorted(self.__dict__.items()))
+
+    def __call__(self, t):
+        if np.isscalar(t): # Fast path for the integrators
+            return self.shape(t - self.start) if self.start <= t <= self.end else 0.
+        t = np.asarray(t, dtype=float)
+        phi_t = np.zeros_like(t)
+        on = (t >= self.start) & (t <= self.end)
+        phi_t[on] = self.shape(t[on] - self.start)
+        return phi_t
+
+
+class RampPulse(Pulse):
+    """Flux rising linearly from phi0 to phi0+phi over the pulse"""
+
+    def __init__(self, start, end, phi, phi0=0):
+        super(RampPulse, self).__init__(start, end, phi)
+        self.phi0 = phi0
+
+    def shape(self, tau):
+        return self.phi0 + self.phi * tau / (self.end - self.start)
+
+
+class SinusoidPulse(Pulse):
+    """Flux oscillating at w [rads/ms] between phi0 and phi0+phi, starting from the trough (or peak if startOn)"""
+
+    def __init__(self, start, end, phi, w, phi0=0, startOn=False):
+        super(SinusoidPulse, self).__init__(start, end, phi)
+        self.w = w
+        self.phi0 = phi0
+        self.startOn = startOn
+
+    def shape(self, tau):
+        sign = 1 if self.startOn else -1
+        return self.phi0 + 0.5*self.phi*(1 + sign*np.cos(self.w*tau))
+
+
+class ChirpPulse(Pulse):
+    """Sinusoidal flux sweeping from f0 to fT [Hz] either linearly or exponentially over the pulse"""
+
+    def __init__(self, start, end, phi, f0, fT, linear=True, phi0=0, startOn=False):
+        super(ChirpPulse, self).__init__(start, end, phi)
+        self.f0 = f0
+        self.fT = fT
+        self.linear = linear
+        self.phi0 = phi0
+        self.startOn = startOn
+
+    def shape(self, tau):
+        onD = self.end - self.start
+        if self.linear: # Linear sweep
+            ft = self.f0 + (self.fT-self.f0)*(tau/onD)
+        else:           # Exponential sweep
+            ft = self.f0 * (self.fT/self.f0)**(tau/onD)
+        ft = ft / 1000 # Convert to frequency in ms
+        sign = 1 if self.startOn else -1
+        return self.phi0 + 0.5*self.phi*(1 + sign*np.cos(ft*tau))
+
+
+class PulseSet(object):
+    """
+    Stimulus functions for every trial of a protocol, indexed as
+    ``phi_ts[run][phiInd][pulse]``. Each trial's pulses are generated on
+    first access and then reused.
+    """
+
+    def __init__(self, Prot, genPulse):
+        self.Prot = Prot
+        self.genPulse = genPulse
+        self.nRuns = Prot.nRuns
+        self.phis = list(Prot.phis)
+        self._pulses = {}
+
+    def __repr__(self):
+        return "<PulseSet ({} of {} trials generated)>".format(len(self._pulses), self.nRuns * len(self.phis))
+
+    def __len__(self):
+        return self.nRuns
+
+    def __getitem__(self, run):
+        if not -self.nRuns <= run < self.nRuns:
+            raise IndexError("Run {} out of range!".format(run))
+        return _RunPulses(self, run % self.nRuns)
+
+    def get(self, run, phiInd):
+        """Return the list of pulse functions for a trial, generating them if necessary"""
+        phiInd = phiInd % len(self.phis)
+        if (run, phiInd) not in self._pulses:
+            cycles, delD = self.Prot.getRunCycles(run)
+            pulses, _ = cycles2times(cycles, delD)
+            self._pulses[(run, phiInd)] = [self.genPulse(run, self.phis[phiInd], pulse) for pulse in pulses]
+        return self._pulses[(run, phiInd)]
+
+
+class _RunPulses(object):
+    """View of the pulse functions of one run in a PulseSet"""
+
+    def __init__(self, pulseSet, run):
+        self.pulseSet = pulseSet
+        self.run = run
+
+    def __len__(self):
+        return len(self.pulseSet.phis)
+
+    def __getitem__(self, phiInd):
+        if not -len(self) <= phiInd < len(self):
+            raise IndexError("Flux index {} out of range!".format(phiInd))
+        return self.pulseSet.get(self.run, phiInd)
 
 
 class Protocol(PyRhOobject): #, metaclass=ABCMeta
@@ -44,6 +200,7 @@ class Protocol(PyRhOobject): #, metaclass=ABCMeta
     dt = None
     phis = None
     Vs = None
+    stimCacheBytes = 2**26 # Limit of the stimulus arrays cached by getStimArray
 
     def __init__(self, params=None, saveData=True):
         if params is None:
@@ -68,6 +225,12 @@ class Protocol(PyRhOobject): #, metaclass=ABCMeta
     def __repr__(self):
         return "<PyRhO {} Protocol object (nRuns={}, nPhis={}, nVs={})>".format(self.protocol, self.nRuns, self.nPhis, self.nVs)
 
+    def __getstate__(self):
+        """Pickle (e.g. for worker processes) without the cached stimulus arrays"""
+        state = self.__dict__.copy()
+        state.pop('_stimCache', None)
+        return state
+
     def __iter__(self):
         """Iterator to return the pulse sequence for the next trial"""
         self.run = 0
@@ -133,25 +296,57 @@ class Protocol(PyRhOobject): #, metaclass=ABCMeta
     def getRunCycles(self, run):
         return (self.cycles, self.delD)
 
-    def genPulseSet(self, genPulse=None):
-        """Function to generate a set of spline functions to phi(t) simulations"""
-        if genPulse is None: # Default to square pulse generator
-            genPulse = self.genPulse
-        phi_ts = [[[None for pulse in range(self.nPulses)] for phi in range(self.nPhis)] for run in range(self.nRuns)]
+    def plan(self, dt=None):
+        """
+        Return the trials of the protocol as a tuple of TrialSpec records in
+        (run, phiInd, vInd) order.
+
+        The plan separates scheduling from execution: any executor may run the
+        trials (in any order), store each PhotoCurrent with ``storeTrial`` in
+        the ProtocolData created by ``initData`` and then call ``finish``.
+        """
+        if dt is None:
+            dt = self.dt
+        if self.phi_ts is None:
+            self.genPulseSet()
+        specs = []
         for run in range(self.nRuns):
             cycles, delD = self.getRunCycles(run)
+            cycles = np.array(cycles)
             pulses, totT = cycles2times(cycles, delD)
+            cycles.flags.writeable = pulses.flags.writeable = False
             for phiInd, phi in enumerate(self.phis):
-                for pInd, pulse in enumerate(pulses):
-                    phi_ts[run][phiInd][pInd] = genPulse(run, phi, pulse)
-        self.phi_ts = phi_ts
-        return phi_ts
+                stimulus = tuple(self.phi_ts[run][phiInd])
+                for vInd, V in enumerate(self.Vs):
+                    specs.append(TrialSpec(run, phiInd, vInd, phi, V, cycles, delD, pulses, totT, stimulus, dt))
+        return tuple(specs)
+
+    def initData(self):
+        """Create an empty ProtocolData for the results of the protocol's trials"""
+        self.PD = ProtocolData(self.protocol, self.nRuns, self.phis, self.Vs)
+        self.PD.peak_ = self.genContainer()
+        self.PD.ss_ = self.genContainer()
+        if hasattr(self, 'runLabels'):
+            self.PD.runLabels = self.runLabels
+        return self.PD
+
+    def storeTrial(self, spec, PC):
+        """Store the PhotoCurrent from the trial described by spec"""
+        self.PD.trials[spec.run][spec.phiInd][spec.vInd] = PC
+        self.PD.peak_[spec.run][spec.phiInd][spec.vInd] = PC.peak_
+        self.PD.ss_[spec.run][spec.phiInd][spec.vInd] = PC.ss_
+
+    def genPulseSet(self, genPulse=None):
+        """Function to set up the phi(t) functions for simulations (generated lazily for each trial)"""
+        if genPulse is None: # Default to square pulse generator
+            genPulse = self.genPulse
+        self.phi_ts = PulseSet(self, genPulse)
+        return self.phi_ts
 
     def genPulse(self, run, phi, pulse):
-        """Default interpolation function for square pulses"""
+        """Default function for square pulses"""
         pStart, pEnd = pulse
-        phi_t = spline([pStart,pEnd], [phi,phi], k=1, ext=1)
-        return phi_t
+        return Pulse(pStart, pEnd, phi)
 
     def genPlottingStimuli(self, genPulse=None, vInd=0):
         """Redraw stimulus functions in case data has been realigned"""
@@ -173,40 +368,60 @@ class Protocol(PyRhOobject): #, metaclass=ABCMeta
         return phi_ts
 
 
-    def getStimArray(self, run, phiInd, dt) : #phi_ts, delD, cycles, dt):
-        """Return a stimulus array (not spline) with the same sampling rate as the photocurrent"""
+    def getStimArray(self, run, phiInd, dt, t=None) : #phi_ts, delD, cycles, dt):
+        """
+        Return a stimulus array (not spline) with the same sampling as the photocurrent.
+
+        The stimulus is sampled every dt from 0 unless the (possibly
+        non-uniform) time points t are given, in which case it is evaluated
+        at each of them. Arrays are cached per (run, phiInd, dt, t) up to
+        stimCacheBytes (least recently used first out) and returned read-only
+        so that trials (e.g. at different clamp voltages) share them.
+        """
 
         cycles, delD = self.getRunCycles(run)
-        phi_ts = self.phi_ts[run][phiInd][:]
+        phi_ts = self.phi_ts[run][phiInd]
 
         nPulses = cycles.shape[0]
         assert(len(phi_ts) == nPulses)
 
-        #start, end = RhO.t[0], RhO.t[0]+delD #start, end = 0.00, delD
-        start, end = 0, delD
-        nSteps = int(round(((end-start)/dt)+1))
-        t = np.linspace(start, end, nSteps, endpoint=True)
-        phi_tV = np.zeros_like(t)
-        #pulseInds = np.empty([0,2],dtype=int) # Light on and off indexes for each pulse
+        if t is not None:
+            t = np.asarray(t, dtype=float)
+        key = (run, phiInd, dt, delD, cycles.tobytes(), None if t is None else hashlib.sha1(t.tobytes()).hexdigest())
+        if getattr(self, '_stimCache', (None,))[0] is not self.phi_ts: # Invalidate when the pulses are regenerated
+            self._stimCache = (self.phi_ts, TrialCache(maxBytes=self.stimCacheBytes))
+        cache = self._stimCache[1]
+        cached = cache.get(key)
+        if cached is not None:
+            return cached[0]
+
+        # Segment boundaries: the delay then each pulse cycle (on + off)
+        ends = np.cumsum(np.r_[delD, cycles[:,0] + cycles[:,1]])
+        starts = np.r_[0, ends[:-1]]
+
+        if t is None: # Fill the piecewise uniform grid in a preallocated buffer
+            nSteps = [int(round((end-start)/dt)) for start, end in zip(starts, ends)]
+            bounds = np.r_[0, np.cumsum(nSteps)] + 1 # Each segment starts at the last point of the preceding one
+            t = np.empty(bounds[-1])
+            t[0] = 0
+            for s, (start, end) in enumerate(zip(starts, ends)):
+                t[bounds[s]:bounds[s+1]] = np.linspace(start, end, nSteps[s]+1, endpoint=True)[1:]
+        else:
+            bounds = np.searchsorted(t, np.r_[starts[0], ends], side='right')
 
+        phi_tV = np.zeros(len(t))
         for p in range(nPulses):
-            start = end
-            onD, offD = cycles[p,0], cycles[p,1]
-            end = start + onD + offD
-            nSteps = int(round(((end-start)/dt)+1))
-            tPulse = np.linspace(start, end, nSteps, endpoint=True)
+            lo, hi = bounds[p+1], bounds[p+2]
             phi_t = phi_ts[p]
-            phiPulse = phi_t(tPulse) # -tPulse[0] # Align time vector to 0 for phi_t to work properly
-
-            #onInd = len(t) - 1 # Start of on-phase
-            #offInd = onInd + int(round(onD/dt))
-            #pulseInds = np.vstack((pulseInds, [onInd,offInd]))
-
-            #t = np.r_[t, tPulse[1:]]
-
-            phi_tV = np.r_[phi_tV, phiPulse[1:]]
-
-        phi_tV[np.ma.where(phi_tV < 0)] = 0 # Safeguard for negative phi values
+            if getattr(phi_t, 'ext', None) == 1: # Splines are zero beyond their knots so only evaluate within them
+                knots = phi_t.get_knots()
+                lo, hi = max(lo, np.searchsorted(t, knots[0])), min(hi, np.searchsorted(t, knots[-1], side='right'))
+            if hi > lo:
+                phi_tV[lo:hi] = phi_t(t[lo:hi])
+
+        phi_tV[phi_tV < 0] = 0 # Safeguard for negative phi values
+        phi_tV.flags.writeable = False
+        cache.add(key, (phi_tV,))
         return phi_tV #, t, pulseInds
 
 
@@ -456,14 +671,7 @@ class protSinusoid(Protocol):
 
     def genPulse(self, run, phi, pulse):
         pStart, pEnd = pulse
-        onD = pEnd - pStart
-        t = np.linspace(0.0, onD, int(round((onD*self.sr/1000))+1), endpoint=True) # Create smooth series of time points to interpolate between
-        if self.startOn: # Generalise to phase offset
-            phi_t = spline(pStart + t, self.phi0[run] + 0.5*phi*(1+np.cos(self.ws[run]*t)), ext=1, k=5)
-        else:
-            phi_t = spline(pStart + t, self.phi0[run] + 0.5*phi*(1-np.cos(self.ws[run]*t)), ext=1, k=5)
-
-        return phi_t
+        return SinusoidPulse(pStart, pEnd, phi, self.ws[run], self.phi0[run], self.startOn) # Generalise to phase offset
 
     def createLayout(self, Ifig=None, vInd=0):
 
@@ -716,18 +924,7 @@ class protChirp(Protocol):
 
     def genPulse(self, run, phi, pulse):
         pStart, pEnd = pulse
-        onD = pEnd - pStart
-        t = np.linspace(0.0, onD, (onD*self.sr/1000)+1, endpoint=True) # Create smooth series of time points to interpolate between
-        if self.linear: # Linear sweep
-            ft = self.f0 + (self.fT-self.f0)*(t/onD)
-        else:           # Exponential sweep
-            ft = self.f0 * (self.fT/self.f0)**(t/onD)
-        ft /= 1000 # Convert to frequency in ms
-        if self.startOn:
-            phi_t = spline(pStart + t, self.phi0[run] + 0.5*phi*(1+np.cos(ft*t)), ext=1, k=5)
-        else:
-            phi_t = spline(pStart + t, self.phi0[run] + 0.5*phi*(1-np.cos(ft*t)), ext=1, k=5)
-        return phi_t
+        return ChirpPulse(pStart, pEnd, phi, self.f0, self.fT, self.linear, self.phi0[run], self.startOn)
 
     def createLayout(self, Ifig=None, vInd=0):
 
@@ -825,10 +1022,9 @@ class protRamp(Protocol):
 
 
     def genPulse(self, run, phi, pulse):
-        """Generate spline for a particular pulse. phi0 is the offset so decreasing ramps can be created with negative phi values. """
+        """Generate the function for a particular pulse. phi0 is the offset so decreasing ramps can be created with negative phi values. """
         pStart, pEnd = pulse
-        phi_t = spline([pStart, pEnd], [self.phi0, self.phi0+phi], k=1, ext=1)
-        return phi_t
+        return RampPulse(pStart, pEnd, phi, self.phi0)
 
 
 class protDelta(Protocol):
@@ -1398,12 +1594,451 @@ def selectProtocol(protocol, params=None, saveData=True):
 ### - Wavelength (lambda)
 
 
-def characterise(RhO):
-    """Run small signal analysis on Rhodopsin"""
-    for protocol in smallSignalAnalysis:
-        RhO.setLight(0.0)
-        Prot = protocols[protocol]()
-        Sim = simulators['Python'](Prot, RhO)
-        Sim.run()
-        Sim.plot()
-    return
+def characterise(RhO, workers=None, plot=True, verbose=config.verbose):
+    """
+    Run small signal analysis on Rhodopsin: the protocols in
+    smallSignalAnalysis are run with the Python simulator (see runBattery)
+    and plotted once they have all finished. This short battery runs
+    serially by default, leaving RhO in its state after the last protocol;
+    with workers > 1 the protocols run on copies of RhO in worker processes.
+    """
+    return runBattery([RhO], smallSignalAnalysis, ['Python'], workers=workers, plot=plot, verbose=verbose)
+
+
+class BatteryReport(object):
+    """
+    Results and timings of a battery of protocol runs (see runBattery).
+
+    There is one row per (model, protocol, simulator) cell holding the wall
+    time [s], the number of evaluations of the model's derivatives and
+    Jacobian (nfev) and of its analytic solution (nSoln), the size of the
+    simulated data (dataMB), the peak memory allocated during the run
+    (peakMB; nan unless traced), and the error message if the run failed.
+    Columns are returned as arrays by indexing with their name and rows as
+    dictionaries by indexing with an integer. The Protocols holding the data
+    (in their ``PD``) are kept in ``results`` keyed by the positions of the
+    (model, protocol, simulator) in the battery's lists, so that models with
+    the same number of states are kept apart, and arranged as an array by
+    ``matrix``.
+    """
+
+    columns = ['model', 'protocol', 'simulator', 'wallTime', 'nfev', 'nSoln', 'dataMB', 'peakMB', 'error']
+
+    def __init__(self, rows, results, models, protocols, simulators):
+        self.rows = rows
+        self.results = results
+        self.models = models
+        self.protocols = protocols
+        self.simulators = simulators
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in ('model', 'protocol', 'simulator', 'error'):
+                return [row.get(key) for row in self.rows]
+            return np.array([row.get(key, np.nan) for row in self.rows], dtype=float)
+        return self.rows[key]
+
+    def __str__(self):
+        lines = ['Battery of {} runs in {:.3g}s of worker time ({} failed)'.format(len(self), np.nansum(self['wallTime']), len(self.failures))]
+        lines.append('{:>8} {:>12} {:>10} {:>10} {:>10} {:>8} {:>8} {:>8}'.format(*self.columns[:-1]))
+        for row in sorted(self.rows, key=lambda row: -row['wallTime']): # Slowest first
+            lines.append('{:>8} {:>12} {:>10} {:>10.3g} {:>10} {:>8} {:>8.3g} {:>8.3g}{}'.format(
+                row['model'], row['protocol'], row['simulator'], row['wallTime'], row['nfev'], row['nSoln'],
+                row['dataMB'], row['peakMB'], '' if row['error'] is None else '  FAILED: ' + row['error']))
+        return '\n'.join(lines)
+
+    @property
+    def failures(self):
+        """Rows of the runs which failed"""
+        return [row for row in self.rows if row['error'] is not None]
+
+    @property
+    def matrix(self):
+        """Array (nModels x nProtocols x nSimulators) of the Protocols (None where the run failed)"""
+        matrix = np.empty((len(self.models), len(self.protocols), len(self.simulators)), dtype=object)
+        for (m, p, s), _ in np.ndenumerate(matrix):
+            matrix[m, p, s] = self.results.get((m, p, s))
+        return matrix
+
+    def plot(self):
+        """Plot the data from every successful run"""
+        for Prot in self.matrix.ravel():
+            if Prot is not None:
+                Prot.plot()
+
+    def toDF(self):
+        """Export to a pandas DataFrame"""
+        if not check_package('pandas'):
+            warnings.warn('Pandas not found!')
+            return
+        else:
+            import pandas as pd
+        return pd.DataFrame(self.rows, columns=self.columns)
+
+    def toCSV(self, fileName):
+        """Write the report to a csv file"""
+        import csv
+        with open(fileName, 'w') as fh:
+            writer = csv.DictWriter(fh, fieldnames=self.columns, restval='')
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+
+class _CallCounter(object):
+    """Wrap a function to count its calls"""
+
+    def __init__(self, func):
+        self.func = func
+        self.n = 0
+
+    def __call__(self, *args, **kwargs):
+        self.n += 1
+        return self.func(*args, **kwargs)
+
+
+def _batteryWorker(job):
+    """Run one protocol for runBattery, returning the error message instead of raising"""
+    ind, cell, model, RhO, protocol, simulator, saveData, traceMemory = job
+    row = dict(model=model, protocol=protocol, simulator=simulator, nfev=0, nSoln=0, dataMB=0., peakMB=np.nan, error=None)
+    Prot = None
+    t0 = config.wallTime()
+    try:
+        import tracemalloc
+    except ImportError: # Python 2
+        traceMemory = False
+    if traceMemory:
+        tracemalloc.start()
+    try:
+        if RhO is None:
+            RhO = models[model]()
+        counters = dict((name, _CallCounter(getattr(RhO, name))) for name in ('solveStates', 'jacobian', 'calcSoln')
+                        if hasattr(RhO, name))
+        for name, counter in counters.items():
+            setattr(RhO, name, counter)
+        try:
+            RhO.setLight(0.0)
+            Prot = protocols[protocol](saveData=saveData)
+            Sim = simulators[simulator](Prot, RhO)
+            Sim.run(verbose=0)
+        finally:
+            for name in counters:
+                delattr(RhO, name)
+        row['nfev'] = sum(counters[name].n for name in ('solveStates', 'jacobian') if name in counters)
+        row['nSoln'] = counters['calcSoln'].n if 'calcSoln' in counters else 0
+        row['dataMB'] = sum(arr.nbytes for pc in Prot.PD.trials for pcs in pc for p in pcs if p is not None
+                            for arr in (p.I, p.t, getattr(p, 'states', np.empty(0)))) / 2**20
+    except Exception as err:
+        row['error'] = '{}: {}'.format(type(err).__name__, err)
+        Prot = None
+    finally:
+        if traceMemory:
+            row['peakMB'] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+    row['wallTime'] = config.wallTime() - t0
+    return ind, cell, row, Prot
+
+
+minParallelRuns = 8 # Smallest battery run on a pool of workers by default (see runBattery)
+
+
+def runBattery(listOfModels=(6,), listOfProtocols=None, simList=('Python',), workers=None, plot=False,
+               saveData=True, traceMemory=False, verbose=config.verbose):
+    """
+    Run every protocol on every model with every simulator.
+
+    The independent (model, protocol, simulator) runs are scheduled on a
+    pool of ``workers`` processes. By default batteries of fewer than
+    minParallelRuns runs are run serially (starting the pool costs more than
+    it saves) and larger ones use a process per CPU. Parallel runs simulate
+    pickled copies of any RhO objects given, so these are left unchanged,
+    whereas serial runs simulate the objects themselves.
+
+    Parameters
+    ----------
+    listOfModels : list
+        Models given by their number of states (e.g. [3, 4, 6]) or as RhO objects.
+    listOfProtocols : list[str], optional
+        Protocol names (default: all protocols).
+    simList : list[str], optional
+        Simulator names (default=['Python']).
+    workers : int, optional
+        Number of worker processes (1 runs the battery serially).
+    plot : bool, optional
+        Plot each protocol once all the runs have finished (default=False).
+    saveData : bool, optional
+        Save the data from each protocol (default=True).
+    traceMemory : bool, optional
+        Record the peak memory allocated during each run with tracemalloc,
+        which slows the runs down (default=False).
+
+    Returns
+    -------
+    BatteryReport
+        The Protocols (with their data) and the timing and memory report for each run.
+    """
+
+    if not isinstance(listOfModels, (list, tuple)):
+        listOfModels = [listOfModels]
+    if listOfProtocols is None:
+        listOfProtocols = list(protocols)
+    if not isinstance(listOfProtocols, (list, tuple)):
+        listOfProtocols = [listOfProtocols]
+    if not isinstance(simList, (list, tuple)):
+        simList = [simList]
+
+    modelNames, jobs = [], []
+    for m, model in enumerate(listOfModels):
+        if isinstance(model, (int, str)):
+            name, RhO = str(model), None # Created by the worker
+        else:
+            name, RhO = str(model.nStates), model
+        modelNames.append(name)
+        for p, protocol in enumerate(listOfProtocols):
+            for s, sim in enumerate(simList):
+                jobs.append((len(jobs), (m, p, s), name, RhO, protocol, sim, saveData, traceMemory))
+    nJobs = len(jobs)
+
+    if workers is None:
+        workers = multiprocessing.cpu_count() if nJobs >= minParallelRuns else 1
+
+    if verbose > 0:
+        print("\n================================================================================")
+        print("Running {} protocol{} on {} model{} with {} ({} worker{})".format(
+              len(listOfProtocols), 's' if len(listOfProtocols) > 1 else '', len(modelNames),
+              's' if len(modelNames) > 1 else '', ', '.join(simList), workers, 's' if workers > 1 else ''))
+        print("================================================================================")
+
+    t0 = config.wallTime()
+    rows = [None for job in jobs]
+    results = {}
+    pool = multiprocessing.Pool(min(workers, nJobs)) if workers > 1 and nJobs > 1 else None
+    try:
+        batches = pool.imap_unordered(_batteryWorker, jobs) if pool is not None else map(_batteryWorker, jobs)
+        for done, (ind, cell, row, Prot) in enumerate(batches, 1):
+            rows[ind] = row
+            if Prot is not None:
+                results[cell] = Prot
+            if verbose > 0:
+                status = 'FAILED - ' + row['error'] if row['error'] is not None else 'nfev={}; nSoln={}'.format(row['nfev'], row['nSoln'])
+                print("[{}/{}] '{}' on the {}-state model with {}: {:.3g}s; {}".format(
+                      done, nJobs, row['protocol'], row['model'], row['simulator'], row['wallTime'], status))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    report = BatteryReport(rows, results, modelNames, list(listOfProtocols), list(simList))
+    if verbose > 0:
+        print("--------------------------------------------------------------------------------")
+        print("Finished in {:.3g}s".format(config.wallTime() - t0))
+        print("================================================================================\n")
+    if plot:
+        report.plot()
+    return report
+
+
+def _hashable(value):
+    """Convert (nested) lists and arrays to tuples so that values can be compared as keys"""
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+def _sweepWorker(job):
+    """Simulate one point of a Sweep (see Sweep.run)"""
+    protocol, nStates, simulator, protValues, modelValues, simValues = job
+    pParams = copy.deepcopy(protParams[protocol])
+    mParams = copy.deepcopy(modelParams[str(nStates)])
+    sParams = copy.deepcopy(simParams[simulator])
+    for params, values in ((pParams, protValues), (mParams, modelValues), (sParams, simValues)):
+        for name, value in values:
+            params[name].value = value
+    Prot = protocols[protocol](pParams, saveData=False)
+    RhO = models[str(nStates)](mParams)
+    Sim = simulators[simulator](Prot, RhO, sParams)
+    Sim.run(verbose=0)
+    return Prot.PD
+
+
+class Sweep(object):
+    """
+    Simulate a protocol over a grid of protocol, model and simulator parameters.
+
+    Parameters
+    ----------
+    protocol : str
+        Name of the protocol to run e.g. 'step'.
+    grid : dict or list of (str, list) pairs
+        Values for each swept parameter e.g. {'cycles': [[[50, 450]], [[100, 400]]], 'Gd': [0.1, 0.2]}.
+        Names are looked up in the protocol, model then simulator parameters
+        and must be unique across them. Unswept parameters keep their defaults.
+        Pass an OrderedDict or list of pairs to fix the order of the axes.
+    nStates : int or str, optional
+        Number of model states (default=3).
+    simulator : str, optional
+        Simulator name (default='Python').
+    mode : str, optional
+        'product' sweeps the Cartesian product of the values (one axis per
+        parameter) and 'zip' pairs up values of equal length lists (one axis)
+        (default='product').
+
+    Attributes
+    ----------
+    names : list[str]
+        The swept parameters.
+    shape : tuple[int]
+        The shape of the result array.
+    results : ndarray(ProtocolData)
+        The data for each grid point, set by ``run``. Axis i corresponds to
+        ``names[i]`` in 'product' mode.
+    """
+
+    def __init__(self, protocol, grid, nStates=3, simulator='Python', mode='product'):
+        if protocol not in protocols:
+            raise NotImplementedError(protocol)
+        if mode not in ('product', 'zip'):
+            raise ValueError("mode must be 'product' or 'zip'!")
+        self.protocol = protocol
+        self.nStates = nStates
+        self.simulator = simulator
+        self.mode = mode
+
+        grid = OrderedDict(grid)
+        self.names = list(grid)
+        self.values = [list(values) for values in grid.values()]
+        self.kinds = []
+        for name in self.names:
+            kinds = [kind for kind, params in (('protocol', protParams[protocol]),
+                                               ('model', modelParams[str(nStates)]),
+                                               ('simulator', simParams[simulator])) if name in params]
+            if len(kinds) != 1:
+                raise ValueError("Parameter '{}' is {} for the '{}' protocol, {}-state model and {} simulator!"
+                                 .format(name, 'ambiguous' if kinds else 'unknown', protocol, nStates, simulator))
+            self.kinds.append(kinds[0])
+
+        if mode == 'product':
+            self.shape = tuple(len(values) for values in self.values)
+        else:
+            if len(set(len(values) for values in self.values)) > 1:
+                raise ValueError('Zipped parameters must have the same number of values!')
+            self.shape = (len(self.values[0]),) if self.values else (0,)
+        self.results = None
+
+    def __repr__(self):
+        return "<PyRhO Sweep of '{}' over {} ({} mode; shape={})>".format(self.protocol, self.names, self.mode, self.shape)
+
+    def __len__(self):
+        return int(np.prod(self.shape))
+
+    def points(self):
+        """Iterate over the grid as (index, OrderedDict(name=value)) pairs"""
+        if self.mode == 'product':
+            for index in np.ndindex(*self.shape):
+                yield index, OrderedDict((name, self.values[i][j]) for i, (name, j) in enumerate(zip(self.names, index)))
+        else:
+            for j in range(self.shape[0]):
+                yield (j,), OrderedDict((name, values[j]) for name, values in zip(self.names, self.values))
+
+    def plan(self):
+        """
+        Plan the simulations needed for the grid, simulating identical points only once.
+
+        Returns
+        -------
+        jobs : list[tuple]
+            The unique jobs for the worker processes.
+        cells : list[int]
+            The job index for each grid point (in the order of ``points``).
+        """
+        jobs, cells, seen = [], [], {}
+        for index, point in self.points():
+            key = tuple(_hashable(value) for value in point.values())
+            if key not in seen:
+                seen[key] = len(jobs)
+                values = {kind: tuple((name, point[name]) for name, k in zip(self.names, self.kinds) if k == kind)
+                          for kind in ('protocol', 'model', 'simulator')}
+                jobs.append((self.protocol, self.nStates, self.simulator,
+                             values['protocol'], values['model'], values['simulator']))
+            cells.append(seen[key])
+        return jobs, cells
+
+    def run(self, workers=None, batchSize=1, verbose=config.verbose):
+        """
+        Simulate every unique grid point in a pool of ``workers`` processes
+        (default: the number of CPUs), sending ``batchSize`` points to a
+        worker at a time, and return the results array.
+        """
+        jobs, cells = self.plan()
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        if verbose > 0:
+            print("Sweeping the '{}' protocol over {} ({} grid points; {} unique) with {} worker{}"
+                  .format(self.protocol, self.names, len(cells), len(jobs), workers, 's' if workers > 1 else ''))
+
+        t0 = config.wallTime()
+        pool = multiprocessing.Pool(min(workers, len(jobs))) if workers > 1 and len(jobs) > 1 else None
+        try:
+            if pool is not None:
+                data = pool.imap(_sweepWorker, jobs, chunksize=max(1, int(batchSize)))
+            else:
+                data = (_sweepWorker(job) for job in jobs)
+            PDs = []
+            for PD in data:
+                PDs.append(PD)
+                if verbose > 1:
+                    print('[{}/{}] simulated'.format(len(PDs), len(jobs)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.results = np.empty(len(cells), dtype=object)
+        self.results[:] = [PDs[job] for job in cells] # Duplicate points share their data
+        self.results = self.results.reshape(self.shape)
+        if verbose > 0:
+            print("Sweep completed in {:.3g}s".format(config.wallTime() - t0))
+        return self.results
+
+    def sel(self, **coords):
+        """Return the ProtocolData for the grid point with the given parameter values"""
+        if self.results is None:
+            raise RuntimeError('The sweep has not been run!')
+        for index, point in self.points():
+            if all(_hashable(point[name]) == _hashable(value) for name, value in coords.items()):
+                return self.results[index]
+        raise KeyError(coords)
+
+    def getFeatures(self, tail=0.05, asDataFrame=False):
+        """
+        Return a table of the features of every pulse at every grid point
+        (see ProtocolData.getFeatures) with a field for the index along each
+        sweep axis (``<name>Ind``) and for each scalar parameter value.
+        """
+        if self.results is None:
+            raise RuntimeError('The sweep has not been run!')
+        tables = []
+        for index, point in self.points():
+            table = self.results[index].getFeatures(tail)
+            axes = [np.full(len(table), i, dtype=int) for i in (index if self.mode == 'product' else index * len(self.names))]
+            labels = [name + 'Ind' for name in self.names]
+            for name, value in point.items():
+                if np.isscalar(value) and name not in table.dtype.names:
+                    axes.append(np.full(len(table), value))
+                    labels.append(name)
+            tables.append(np.rec.fromarrays(axes + [table[field] for field in table.dtype.names],
+                                            names=labels + list(table.dtype.names)))
+        table = np.concatenate(tables).view(np.recarray)
+        if asDataFrame:
+            if not check_package('pandas'):
+                warnings.warn('Pandas not found!')
+                return table
+            import pandas as pd
+            return pd.DataFrame(table)
+        return table
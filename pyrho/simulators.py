@@ -11,6 +11,7 @@ import logging
 import os
 import copy
 import abc
+import hashlib
 from collections import OrderedDict
 
 import numpy as np
@@ -27,7 +28,64 @@ from pyrho.config import * #verbose
 from pyrho.config import wallTime
 from pyrho import config
 
-__all__ = ['simulators']
+__all__ = ['simulators', 'trialCache']
+
+
+class TrialCache(object):
+    """
+    Least recently used store of simulated trials keyed by their canonical
+    description (see Simulator.trialKey) so that identical trials, within or
+    across protocols, are only integrated once. The stored arrays are limited
+    to maxBytes in total.
+
+    Sharing is opt-in (the 'dedup' simulator parameter) and the module-level
+    trialCache persists between runs until trialCache.clear() is called.
+    Note that the protocols of the default characterise battery have no
+    identical trials (their fluxes, cycles and delays all differ) so sharing
+    only pays off for repeated or overlapping runs e.g. in parameter sweeps.
+    """
+
+    def __init__(self, maxBytes=2**28):
+        self.maxBytes = maxBytes
+        self.clear()
+
+    def __repr__(self):
+        return "<TrialCache ({} trials; {:.3g}MB; {} hits; {} misses)>".format(len(self._trials), self.nBytes/2**20, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._trials)
+
+    def clear(self):
+        self._trials = OrderedDict()
+        self.nBytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the stored arrays for a trial (or None) and mark them as recently used"""
+        trial = self._trials.pop(key, None)
+        if trial is None:
+            self.misses += 1
+            return None
+        self._trials[key] = trial
+        self.hits += 1
+        return trial
+
+    def add(self, key, trial):
+        """Store a tuple of (read-only) arrays for a trial, evicting the least recently used trials if necessary"""
+        nBytes = sum(arr.nbytes for arr in trial)
+        if nBytes > self.maxBytes:
+            return
+        for arr in trial:
+            arr.flags.writeable = False
+        self._trials[key] = trial
+        self.nBytes += nBytes
+        while self.nBytes > self.maxBytes:
+            _, old = self._trials.popitem(last=False)
+            self.nBytes -= sum(arr.nbytes for arr in old)
+
+
+trialCache = TrialCache() # Shared by all simulators e.g. across the protocols of characterise
 
 
 class Simulator(PyRhOobject):  # object
@@ -39,6 +97,7 @@ class Simulator(PyRhOobject):  # object
     RhO = None
     simulator = None
     clampProts = ['rectifier']
+    dedup = False # Only share trials free of side effects (see trialKey)
     
     @abc.abstractmethod
     def __init__(self, Prot, RhO, params=None):
@@ -87,6 +146,7 @@ class Simulator(PyRhOobject):  # object
         Prot = self.Prot
 
         self.prepare(Prot)
+        self._stim = None
 
         if verbose > 0:
             print("\n================================================================================")
@@ -94,52 +154,25 @@ class Simulator(PyRhOobject):  # object
             print("================================================================================\n")
             print("{{nRuns={}, nPhis={}, nVs={}}}".format(Prot.nRuns, Prot.nPhis, Prot.nVs))
 
-        Prot.PD = ProtocolData(Prot.protocol, Prot.nRuns, Prot.phis, Prot.Vs)
-        Prot.PD.peak_ = [[[None for v in range(Prot.nVs)] for p in range(Prot.nPhis)] for r in range(Prot.nRuns)]
-        Prot.PD.ss_ = [[[None for v in range(Prot.nVs)] for p in range(Prot.nPhis)] for r in range(Prot.nRuns)]
-        if hasattr(Prot, 'runLabels'):
-            Prot.PD.runLabels = Prot.runLabels
+        Prot.initData()
 
         if verbose > 1:
             Prot.printParams()
         Prot.logParams()
 
-        for run in range(Prot.nRuns):                   # Loop over the number of runs...
-
-            cycles, delD = Prot.getRunCycles(run)
-            pulses, totT = cycles2times(cycles, delD)
-
-            for phiInd, phiOn in enumerate(Prot.phis):  # Loop over light intensity...
-
-                if verbose > 1 and (Prot.nPhis > 1 or (run == 0 and phiInd == 0)):
-                    RhO.dispRates()
-
-                for vInd, V in enumerate(Prot.Vs):      # Loop over clamp voltage
-                    ### N.B. solution variables are not currently dependent on V
-
-                    ### Reset simulation environment...
-                    self.initialise()
-
-                    # TODO: Deprecate special square pulse fucntions
-                    if Prot.squarePulse and self.simulator is 'Python':
-                        I_RhO, t, soln = self.runTrial(RhO, phiOn, V, delD, cycles, self.dt, verbose)
-                    else: # Arbitrary functions of time: phi(t)
-                        phi_ts = Prot.phi_ts[run][phiInd][:]
-                        I_RhO, t, soln = self.runTrialPhi_t(RhO, phi_ts, V, delD, cycles, self.dt, verbose)
-
-                    stim = Prot.getStimArray(run, phiInd, self.dt) # phi_ts, delD, cycles, 
-                    PC = PhotoCurrent(I_RhO, t, pulses, phiOn, V, stimuli=stim, states=soln, stateLabels=RhO.stateLabels, label=Prot.protocol)
-                    #PC.alignToTime()
+        plan = Prot.plan(self.dt)
+        self.nShared = 0
+        for spec in plan:
 
-                    PC.ssInf = np.array(RhO.ssInf)
-                    Prot.PD.trials[run][phiInd][vInd] = PC
-                    Prot.PD.peak_[run][phiInd][vInd] = PC.peak_
-                    Prot.PD.ss_[run][phiInd][vInd] = PC.ss_
+            if verbose > 1 and spec.vInd == 0 and (Prot.nPhis > 1 or (spec.run == 0 and spec.phiInd == 0)):
+                RhO.dispRates()
 
-                    self.saveExtras(run, phiInd, vInd)
+            PC = self.runSpec(spec, verbose)
+            Prot.storeTrial(spec, PC)
+            self.saveExtras(spec.run, spec.phiInd, spec.vInd)
 
-                    if verbose > 1:
-                        print('Run=#{}/{}; phiInd=#{}/{}; vInd=#{}/{}; Irange=[{:.3g},{:.3g}]'.format(run, Prot.nRuns, phiInd, Prot.nPhis, vInd, Prot.nVs, PC.range_[0], PC.range_[1]))
+            if verbose > 1:
+                print('Run=#{}/{}; phiInd=#{}/{}; vInd=#{}/{}; Irange=[{:.3g},{:.3g}]'.format(spec.run, Prot.nRuns, spec.phiInd, Prot.nPhis, spec.vInd, Prot.nVs, PC.range_[0], PC.range_[1]))
 
         Prot.finish(PC, RhO)
         # self.finish() # Reset dt and Vclamp
@@ -157,12 +190,101 @@ class Simulator(PyRhOobject):  # object
 
         self.runTime = wallTime() - t0
         if verbose > 0:
+            if self.dedup:
+                print("\n{} of {} trials were shared with identical earlier simulations".format(self.nShared, len(plan)))
             print("\nFinished '{}' protocol with {} for the {} model in {:.3g}s".format(Prot, self, RhO, self.runTime))
             print("--------------------------------------------------------------------------------\n")
 
         return Prot.PD
 
 
+    def setPulseInds(self, RhO, phi_ts, delD, cycles, dt):
+        """Set the pulse indices and steady-states of a phi(t) trial without sampling phi(t).
+        Returns the number of samples in the trial."""
+
+        nPulses = cycles.shape[0]
+        onInds = np.zeros(nPulses, dtype=int)
+        offInds = np.zeros(nPulses, dtype=int)
+        end = delD
+        nSamples = int(round(delD/dt)) # Index of the end of the delay phase
+        for p in range(nPulses):
+            start = end
+            onD, offD = cycles[p,0], cycles[p,1]
+            end = start + onD + offD
+            onInds[p] = nSamples                            # Start of on-phase
+            offInds[p] = onInds[p] + int(round(onD/dt))     # Start of off-phase
+            nSamples += int(round((onD + offD)/dt))
+            RhO.ssInf.append(RhO.calcSteadyState(phi_ts[p](end-offD)))
+        RhO.pulseInd = np.vstack((RhO.pulseInd, np.c_[onInds, offInds]))
+        return nSamples + 1
+
+    def runSpec(self, spec, verbose=config.verbose):
+        """Simulate the trial described by a TrialSpec (see Protocol.plan) and return its PhotoCurrent"""
+
+        RhO = self.RhO
+        Prot = self.Prot
+
+        ### Reset simulation environment...
+        self.runInd, self.phiInd, self.vInd = spec.run, spec.phiInd, spec.vInd
+        self.initialise()
+
+        key = self.trialKey(spec) if self.dedup else None
+        trial = trialCache.get(key) if key is not None else None
+        if trial is not None: # Identical to an earlier trial: restore the model's record of it
+            I_RhO, t, soln, ssInf, pulseInd = trial
+            RhO.initStates(phi=0)
+            RhO.states, RhO.t, RhO.pulseInd, RhO.ssInf = soln, t, pulseInd, list(ssInf)
+            self.nShared = getattr(self, 'nShared', 0) + 1
+        else:
+            # TODO: Deprecate special square pulse fucntions
+            if Prot.squarePulse and self.simulator == 'Python':
+                I_RhO, t, soln = self.runTrial(RhO, spec.phi, spec.V, spec.delD, spec.cycles, spec.dt, verbose)
+            else: # Arbitrary functions of time: phi(t)
+                I_RhO, t, soln = self.runTrialPhi_t(RhO, list(spec.stimulus), spec.V, spec.delD, spec.cycles, spec.dt, verbose)
+            ssInf = np.array(RhO.ssInf)
+            if key is not None:
+                trialCache.add(key, (I_RhO, t, soln, ssInf, np.array(RhO.pulseInd)))
+
+        stim = self.getStimulus(spec, t)
+        PC = PhotoCurrent(I_RhO, t, spec.pulses, spec.phi, spec.V, stimuli=stim, states=soln, stateLabels=RhO.stateLabels, label=Prot.protocol)
+        #PC.alignToTime()
+        PC.ssInf = np.array(ssInf)
+        return PC
+
+    def trialKey(self, spec):
+        """
+        Canonical description of a trial: the simulator settings, model and
+        its parameters, stimulus, cycles, delay, flux, voltage and dt. Trials
+        with the same key give identical results. Returns None if the trial
+        cannot be described e.g. for stimulus functions without a ``key``.
+        """
+        RhO = self.RhO
+        if self.Prot.squarePulse and self.simulator == 'Python':
+            stimulus = 'square' # Only phi and the cycles are used
+        else:
+            stimulus = tuple(phi_t.key() if hasattr(phi_t, 'key') else None for phi_t in spec.stimulus)
+            if None in stimulus:
+                return None
+        settings = (getattr(self, 'adaptive', False), getattr(self, 'growth', None), getattr(self, 'dtMax', None))
+        return (self.simulator, settings, type(RhO).__name__, RhO.useAnalyticSoln,
+                tuple(getattr(RhO, p) for p in RhO.paramsList), tuple(np.ravel(RhO.s_0)),
+                stimulus, spec.cycles.shape, np.asarray(spec.cycles, dtype=float).tobytes(),
+                spec.delD, spec.phi, spec.V, spec.dt)
+
+    def getStimulus(self, spec, t):
+        """Return the stimulus array sampled at t for a trial, shared with the previous trial if it had the same (run, phiInd)"""
+        key = (spec.run, spec.phiInd, len(t))
+        if getattr(self, '_stim', None) is None or self._stim[0] != key: # The stimulus is independent of V
+            Prot = self.Prot
+            if getattr(self, 'adaptive', False) and Prot.squarePulse: # Non-uniform output grid
+                stim = Prot.getStimArray(spec.run, spec.phiInd, self.dt, t=t)
+            else:
+                stim = Prot.getStimArray(spec.run, spec.phiInd, self.dt) # phi_ts, delD, cycles,
+            if len(stim) != len(t): # e.g. decimated recordings
+                stim = np.interp(t, np.arange(len(stim))*self.dt, stim)
+            self._stim = (key, stim)
+        return self._stim[1]
+
     def saveExtras(self, run, phiInd, vInd):
         pass
 
@@ -181,9 +303,37 @@ class simPython(Simulator):
 
     def __init__(self, Prot, RhO, params=simParams['Python']):
         self.dt = params['dt'].value
+        self.adaptive = params['adaptive'].value
+        self.growth = params['growth'].value
+        self.dtMax = params['dtMax'].value
+        self.dedup = params['dedup'].value
         self.Prot = Prot
         self.RhO = RhO
 
+    def getTimes(self, start, end, dt):
+        """
+        Return the output time points for a phase from start to end [ms].
+
+        These are uniformly spaced by dt unless the simulator is adaptive, in
+        which case the steps start at dt after the light transition at the
+        beginning of the phase and grow geometrically by growth up to dtMax,
+        so the grid is dense over the fast kinetics and peaks and sparse on
+        plateaus and tails. Both ends are always included.
+        """
+        if not self.adaptive or end - start <= 2 * dt:
+            nSteps = int(round(((end-start)/dt)+1))
+            return np.linspace(start, end, nSteps, endpoint=True)
+
+        dtMax = max(dt, self.dtMax)
+        nGrow = int(np.ceil(np.log(dtMax/dt) / np.log(self.growth))) if self.growth > 1 else 0
+        steps = np.minimum(dt * self.growth**np.arange(nGrow+1), dtMax)
+        offsets = np.cumsum(steps)
+        if offsets[-1] < end - start:
+            nFlat = int(np.ceil((end - start - offsets[-1]) / dtMax))
+            offsets = np.r_[offsets, offsets[-1] + dtMax * np.arange(1, nFlat+1)]
+        offsets = offsets[offsets < end - start - dt/2] # Avoid a sliver before the end point
+        return np.r_[start, start + offsets, end]
+
     '''
     # Add this into runTrial and fitting routines...
     def run(RhO, t):
@@ -240,8 +390,7 @@ class simPython(Simulator):
         RhO.initStates(phi)         # Reset state and time arrays from previous runs
         RhO.s0 = RhO.states[-1,:]   # Store initial state used
         start, end = RhO.t[0], RhO.t[0]+delD
-        nSteps = int(round(((end-start)/dt)+1))
-        t = np.linspace(start, end, nSteps, endpoint=True)
+        t = self.getTimes(start, end, dt)
 
         if verbose > 1:
             print("Trial initial conditions:{}".format(RhO.s0))
@@ -261,8 +410,7 @@ class simPython(Simulator):
             RhO.s_on = soln[-1,:]
             start = end
             end = start + cycles[p,0]
-            nSteps = int(round(((end-start)/dt)+1))
-            t = np.linspace(start, end, nSteps, endpoint=True)
+            t = self.getTimes(start, end, dt)
             onInd = len(RhO.t) - 1      # Start of on-phase
             offInd = onInd + len(t) - 1 # Start of off-phase
             RhO.pulseInd = np.vstack((RhO.pulseInd,[onInd,offInd]))
@@ -287,8 +435,7 @@ class simPython(Simulator):
             RhO.s_off = soln[-1,:]
             start = end
             end = start + cycles[p,1]
-            nSteps = int(round(((end-start)/dt)+1))
-            t = np.linspace(start, end, nSteps, endpoint=True)
+            t = self.getTimes(start, end, dt)
             # Turn off light and set transition rates
             phi = 0  # Light flux
             RhO.setLight(phi)
@@ -439,10 +586,11 @@ class simNEURON(Simulator):
         self.buildCell(params['cell'].value)
         if config.verbose > 0:
             self.h.topology() # Print topology
-        self.transduce(self.RhO, expProb=params['expProb'].value)
+        self.transduce(self.RhO, expProb=params['expProb'].value,
+                       expVar=params['expVar'].value, seed=params['seed'].value)
         self.rhoParams = copy.deepcopy(modelParams[str(self.RhO.nStates)])
         self.RhO.exportParams(self.rhoParams)
-        self.setOpsinParams(self.rhoList, self.rhoParams) #self.RhO, modelParams[str(self.RhO.nStates)])
+        self.setOpsinParams(self.rhoList, self.rhoParams, self.expLevels) #self.RhO, modelParams[str(self.RhO.nStates)])
 
         self.rhoRec = self.rhoList[recInd] # Choose a rhodopsin to record
         self.setRecords(self.rhoRec, params['Vcomp'].value, self.RhO)
@@ -492,6 +640,8 @@ class simNEURON(Simulator):
             self.addVclamp()
 
         self.Vms = Prot.genContainer()
+        self.playCache = {} # Played stimulus vectors keyed by (run, phiInd, dt)
+        self.stopPlaying()
         return #self.h.dt
 
 
@@ -534,24 +684,62 @@ class simNEURON(Simulator):
             print('Total sections: ', self.nSecs) #self.cell.count())
 
 
-    def transduce(self, RhO, expProb=1):
-        import random
+    def transduce(self, RhO, expProb=1, expVar=0, seed=None):
+        """Insert rhodopsins into the cell's sections with probability expProb.
+
+        Expression is drawn for all sections at once from a seeded generator
+        so that heterogeneous cells are reproducible. Each rhodopsin is also
+        assigned a relative expression level (mean 1, coefficient of
+        variation expVar) which scales its conductance in setOpsinParams.
+        """
+
+        if seed is not None:
+            seed = int(seed)
+        rng = np.random.RandomState(seed)
+        sections = list(self.cell)
+        expressed = rng.random_sample(len(sections)) <= expProb
+        nRhO = np.count_nonzero(expressed)
+        if expVar > 0: # Log-normal levels with unit mean
+            sigma = np.sqrt(np.log(1 + expVar**2))
+            self.expLevels = rng.lognormal(-sigma**2/2, sigma, nRhO)
+        else:
+            self.expLevels = np.ones(nRhO)
 
         self.compList = self.h.List()
         self.rhoList = self.h.List()
         self.h('objectvar rho')
-        mech = self.mechanisms[RhO.nStates]
-        for sec in self.cell: #self.h.allsec(): # Loop over every section in the cell
+        mech = getattr(self.h, self.mechanisms[RhO.nStates])
+        for sec, exp in zip(sections, expressed): # Loop over every section in the cell
             self.compList.append(sec)
-            if random.random() <= expProb: # Insert a rhodopsin and append it to a rhoList
-                self.h('rho = new {}(0.5)'.format(mech))
-                self.rhoList.append(self.h.rho)
+            if exp: # Insert a rhodopsin and append it to a rhoList
+                self.rhoList.append(mech(sec(0.5)))
+
+        if config.verbose > 0:
+            print('Rhodopsins expressed: {}/{}'.format(nRhO, len(sections)))
 
     ### Set Rhodopsin parameters
-    def setOpsinParams(self, rhoList, pSet): #compList
-        for rho in rhoList:     # not self.rhoList so that subsets can be passed
-            for p in pSet:
-                setattr(rho, p, pSet[p].value)
+    expScaled = ['g0'] # Parameters scaled by each rhodopsin's expression level
+
+    def setOpsinParams(self, rhoList, pSet, expLevels=None): #compList
+        """Assign a parameter set to every rhodopsin in rhoList.
+
+        Each parameter is assigned with a single hoc loop rather than a Python
+        call per rhodopsin. Parameters in expScaled are multiplied by the
+        per-rhodopsin expLevels (an array of the same length as rhoList).
+        """
+
+        self.h('objref rhoSet, pVec')
+        self.h.rhoSet = rhoList     # not self.rhoList so that subsets can be passed
+        nRhO = int(rhoList.count())
+        if expLevels is not None:
+            expLevels = np.asarray(expLevels, dtype=float)
+            assert(len(expLevels) == nRhO)
+        for p in pSet:
+            if expLevels is not None and p in self.expScaled:
+                self.h.pVec = self.h.Vector(pSet[p].value * expLevels)
+                self.h('for rhoInd=0, rhoSet.count()-1 rhoSet.o(rhoInd).{} = pVec.x[rhoInd]'.format(p))
+            else:
+                self.h('for rhoInd=0, rhoSet.count()-1 rhoSet.o(rhoInd).{} = {!r}'.format(p, float(pSet[p].value)))
 
     def getOpsinParams(self):
         # Use nrnpython to set Python variables from within hoc?
@@ -816,39 +1004,19 @@ class simNEURON(Simulator):
         if verbose > 1:
             print("Trial initial conditions:{}".format(RhO.s0))
 
-        start, end = RhO.t[0], RhO.t[0]+delD #start, end = 0.00, delD
-        nSteps = int(round(((end-start)/dt)+1))
-        t = np.linspace(start, end, nSteps, endpoint=True)
-        phi_tV = np.zeros_like(t)
-
-        discontinuities = np.asarray([len(t) - 1]) # -1?
-        for p in range(nPulses):
-            start = end
-            onD, offD = cycles[p,0], cycles[p,1]
-            end = start + onD + offD
-            nSteps = int(round(((end-start)/dt)+1))
-            tPulse = np.linspace(start, end, nSteps, endpoint=True)
-            phi_t = phi_ts[p]
-            phiPulse = phi_t(tPulse) # -tPulse[0] # Align time vector to 0 for phi_t to work properly
-            discontinuities = np.r_[discontinuities, len(tPulse) - 1] # -1?
-
-            onInd = len(t) - 1 # Start of on-phase
-            offInd = onInd + int(round(onD/dt))
-            RhO.pulseInd = np.vstack((RhO.pulseInd, [onInd,offInd]))
+        self.setPulseInds(RhO, phi_ts, delD, cycles, dt)
+        onInds, offInds = RhO.pulseInd[:,0], RhO.pulseInd[:,1]
 
-            t = np.r_[t, tPulse[1:]]
-            phi_tV = np.r_[phi_tV, phiPulse[1:]]
-
-            RhO.ssInf.append(RhO.calcSteadyState(phi_t(end-offD)))
-
-        tvec = self.h.Vector(t)
-        tvec.label('Time [ms]')
-        phi_tV[np.ma.where(phi_tV < 0)] = 0 # Safeguard for negative phi values # Necessary? Handled in mods
-        phiVec = self.h.Vector(phi_tV)
-        phiVec.label('phi [ph./mm^2/s]')
-
-        phiVec.play(self.rhoRec._ref_phi, tvec, 1, discontinuities)
-        #phiVec.play_remove()
+        ### Play the stimulus into every rhodopsin (reusing vectors across trials with the same waveform)
+        key = (self.runInd, self.phiInd, dt)
+        if key not in self.playCache:
+            self.playCache[key] = self.genPlayVectors(self.runInd, self.phiInd, dt, onInds, offInds)
+        tvec, phiVec, discVec = self.playCache[key]
+        if self.playing is not phiVec:
+            self.stopPlaying()
+            for rho in self.rhoList:
+                phiVec.play(rho, rho._ref_phi, tvec, 1, discVec)
+            self.playing = phiVec
 
         self.h.init()
         self.h.run()
@@ -889,6 +1057,52 @@ class simNEURON(Simulator):
 
         return I_RhO, t, soln
 
+    def genPlayVectors(self, run, phiInd, dt, onInds, offInds):
+        """Build the time, flux and discontinuity vectors to play into phi (see getPlayArrays)"""
+
+        t, phi_tV, discontinuities = self.getPlayArrays(self.Prot, run, phiInd, dt, onInds, offInds)
+        tvec = self.h.Vector(t)
+        tvec.label('Time [ms]')
+        phiVec = self.h.Vector(phi_tV)
+        phiVec.label('phi [ph./mm^2/s]')
+        discVec = self.h.Vector(discontinuities)
+        return tvec, phiVec, discVec
+
+    @staticmethod
+    def getPlayArrays(Prot, run, phiInd, dt, onInds, offInds):
+        """Return the time, flux and discontinuity index arrays to play into phi.
+
+        The flux is sampled with Protocol.getStimArray. Since phi is linearly
+        interpolated between samples, a duplicate time point with zero flux is
+        inserted at the start and end of each pulse so that square edges are
+        represented exactly and flagged as discontinuities for CVode.
+        """
+
+        phi_tV = Prot.getStimArray(run, phiInd, dt)
+        cycles, delD = Prot.getRunCycles(run)
+        t = np.zeros(len(phi_tV))
+        lapsed, ind = 0, 0
+        for dur in np.r_[delD, cycles.ravel()]: # Match the segment sampling of getStimArray
+            nSteps = int(round(dur/dt))
+            t[ind:ind+nSteps+1] = np.linspace(lapsed, lapsed+dur, nSteps+1, endpoint=True)
+            lapsed += dur
+            ind += nSteps
+
+        phi_tV = np.array(phi_tV, dtype=float) # getStimArray may return a cached read-only array
+        # getStimArray samples each pulse from just after its onset: light the onset sample
+        phi_tV[onInds] = [phi_t(t[i]) for phi_t, i in zip(Prot.phi_ts[run][phiInd], onInds)]
+        edges = np.sort(np.r_[onInds, offInds+1])
+        t = np.insert(t, edges, t[edges-np.in1d(edges, offInds+1)])
+        phi_tV = np.insert(phi_tV, edges, 0)
+        discontinuities = edges + np.arange(len(edges))
+        return t, phi_tV, discontinuities
+
+    def stopPlaying(self):
+        """Stop any stimulus vector from being played into the rhodopsins"""
+        if getattr(self, 'playing', None) is not None:
+            self.playing.play_remove()
+        self.playing = None
+
     def saveExtras(self, run, phiInd, vInd):
         ### TODO: Clean up this HACK!!!
         self.Vms[run][phiInd][vInd] = copy.copy(self.Vm)
@@ -972,8 +1186,10 @@ class simBrian(Simulator):
     """Class for network level simulations with Brian"""
 
     simulator = 'Brian'
+    standaloneBuild = {} # The most recent standalone build: {'key':..., 'objects':...}
+    compiledParams = ['p', 'q'] # Exponents of dimensioned quantities must be constants for unit checking
 
-    def __init__(self, Prot, RhO, params=simParams['Brian'], network=None, netParams=None, monitors=None, G_RhO='Inputs', varIrho='I', varV='v'):
+    def __init__(self, Prot, RhO, params=simParams['Brian'], network=None, netParams=None, monitors=None, G_RhO='Inputs', varIrho='I', varV='v', records=None):
 
         #from brian2 import *
         # from brian2.only import * # Do not import pylab etc
@@ -988,6 +1204,11 @@ class simBrian(Simulator):
         self.br = br
 
         self.dt = params['dt'].value
+        self.batch = params['batch'].value
+        self.standalone = params['standalone'].value
+        if self.standalone and not self.batch:
+            warnings.warn('The standalone device is only used in batch mode - enabling batch mode!')
+            self.batch = True
         # http://brian2.readthedocs.org/en/2.0b4/advanced/state_update.html
         # http://brian2.readthedocs.org/en/2.0b4/user/models.html
         #self.method_choice = params['method_choice'].value
@@ -1007,7 +1228,8 @@ class simBrian(Simulator):
         #    modelUnits['phi_m'] = 1
 
         self.namespace = self.setParams(RhO)
-        self.namespace.update(netParams)
+        if netParams is not None:
+            self.namespace.update(netParams)
         self.netParams = netParams
 
         #if network is None:
@@ -1015,13 +1237,15 @@ class simBrian(Simulator):
 
         self.net = network
 
-        #setRecords(self, GroupRec=None, IndRec=None)
         self.monitors = monitors
 
         self.G_RhO = G_RhO      #'Inputs' ### Change to match RhO type?
         self.varIrho = varIrho  #'I'
         self.varV = varV        #'v'
-        self.net[self.G_RhO].__dict__[self.stateVars[0]] = 1. # Set rhodopsins to dark-adapted state
+        if self.net is not None: # No network is needed in batch mode
+            self.net[self.G_RhO].__dict__[self.stateVars[0]] = 1. # Set rhodopsins to dark-adapted state
+            if self.monitors is None: # records: options for setRecords e.g. {'record':[0, 10], 'recDt':1, 'spikes':False}
+                self.setRecords(**(records or {}))
 
 
     def setParams(self, RhO):
@@ -1039,13 +1263,133 @@ class simBrian(Simulator):
         self.br.defaultclock.dt = self.dt * ms
         self.rasters = Prot.genContainer()
         self.Vms = Prot.genContainer()
+        self.rates = Prot.genContainer()
+        self.stimCache = {} # TimedArrays keyed by (run, phiInd)
+        if self.batch:
+            self.runBatch(Prot, self.RhO)
+            return
         # Skip last state value since this is defined as 1 - sum(states) not as an ODE
         self.net[self.G_RhO].set_states({s: o for s, o in zip(self.stateVars[:-1], self.RhO.s_0[:-1])}) # Necessary?
         self.net.store() # http://brian2.readthedocs.org/en/latest/user/running.html
         return # self.dt
 
     def initialise(self):
-        self.net.restore()
+        if not self.batch:
+            self.net.restore()
+
+    def runBatch(self, Prot, RhO, verbose=config.verbose):
+        """
+        Simulate every (run, phi, V) trial of the protocol in a single network run.
+
+        The opsin model is replicated once per trial in a voltage-clamped
+        NeuronGroup and each neuron is driven by its own column of a 2-D
+        TimedArray. The recorded states are sliced out per trial by
+        runTrialPhi_t. Unclamped trials (V=None) need the network and so
+        cannot be run in batch mode.
+        """
+
+        if any(V is None for V in Prot.Vs):
+            raise ValueError("Batch mode voltage-clamps every opsin: run unclamped protocols (V=None) "
+                             "with batch=False and a network")
+
+        br = self.br
+        dt = self.dt
+        nTrials = Prot.nRuns * Prot.nPhis * Prot.nVs
+        stims = [Prot.getStimArray(run, phiInd, dt) for run in range(Prot.nRuns)
+                                                    for phiInd in range(Prot.nPhis)]
+        nSamples = max(len(stim) for stim in stims)
+
+        phi_tM = np.zeros((nSamples, nTrials))
+        Vclamps = np.zeros(nTrials)
+        for trial in range(nTrials):
+            stim = stims[trial // Prot.nVs]
+            phi_tM[:len(stim), trial] = stim
+            V = Prot.Vs[trial % Prot.nVs]
+            Vclamps[trial] = V
+
+        if self.standalone:
+            self.batchMonitor = self.runStandalone(RhO, phi_tM, Vclamps, verbose)
+            return
+
+        # The flux now differs between neurons so Theta can no longer be shared
+        eqs = RhO.brian_phi_t.replace('phi(t)', 'phi(t, i)').replace('(shared)', '')
+        eqs += '\n' + self.varV + ' : volt (constant)'
+        G = br.NeuronGroup(nTrials, eqs, name='batch')
+        G.set_states({s: o for s, o in zip(self.stateVars, RhO.s_0)})
+        setattr(G, self.varV, Vclamps * modelUnits['E'])
+        monitor = br.StateMonitor(G, self.stateVars + [self.varIrho], record=True)
+        net = br.Network(G, monitor)
+
+        phi = br.TimedArray(phi_tM * modelUnits['phi_m'], dt=dt*ms, name='phi')
+        self.namespace.update({'phi':phi})
+        report = 'text' if verbose > 1 else None
+        net.run(duration=(nSamples-1)*dt*ms, namespace=self.namespace, report=report)
+        monitor.record_single_timestep()
+
+        self.batchMonitor = monitor
+        return
+
+    def runStandalone(self, RhO, phi_tM, Vclamps, verbose=config.verbose):
+        """
+        Run a batch with Brian's C++ standalone device.
+
+        The project is built in a directory named by a hash of the model
+        equations and the structure of the batch (trials, samples, dt and
+        recorded variables). Model parameters (except the Hill coefficients)
+        are declared as shared constants rather than compiled in, so a later
+        run with different parameter values, voltages or stimuli only passes
+        the new values to the compiled binary. The build is reused within a
+        session and make only recompiles changed files across sessions.
+        """
+
+        br = self.br
+        dt = self.dt
+        nSamples, nTrials = phi_tM.shape
+        constants = {p: self.namespace[p] for p in RhO.paramsList if p in self.compiledParams}
+        runParams = [p for p in RhO.paramsList if p not in self.compiledParams]
+        structure = (nTrials, nSamples, dt, tuple(self.stateVars), self.varIrho, self.varV, sorted(constants.items()))
+        key = hashlib.md5((RhO.brian + RhO.brian_phi_t + repr(structure)).encode()).hexdigest()
+
+        if self.standaloneBuild.get('key') != key:
+            directory = os.path.join(config.dDir, 'standalone', key)
+            device = br.get_device()
+            br.set_device('cpp_standalone', directory=directory, build_on_run=False)
+            br.device.reinit()
+            br.device.activate(directory=directory, build_on_run=False)
+            br.defaultclock.dt = dt*ms
+
+            eqs = RhO.brian_phi_t.replace('phi(t)', 'phi(t, i)').replace('(shared)', '')
+            eqs += '\n' + self.varV + ' : volt (constant)'
+            for p in runParams: # Pass parameters at run time
+                dims = br.get_dimensions(self.namespace[p])
+                unit = '1' if dims.is_dimensionless else repr(br.get_unit(dims))
+                eqs += '\n{} : {} (constant, shared)'.format(p, unit)
+            G = br.NeuronGroup(nTrials, eqs, name='batch')
+            monitor = br.StateMonitor(G, self.stateVars + [self.varIrho], record=True)
+            net = br.Network(G, monitor)
+            phi = br.TimedArray(phi_tM * modelUnits['phi_m'], dt=dt*ms, name='phi')
+            # Include the final time step which is recorded by record_single_timestep at runtime
+            constants.update({'phi':phi})
+            net.run(duration=nSamples*dt*ms, namespace=constants)
+            br.device.build(directory=directory, compile=True, run=False, with_output=verbose > 1)
+
+            self.standaloneBuild.clear()
+            self.standaloneBuild.update({'key':key, 'device':br.get_device(), 'objects':(G, monitor, phi)})
+            br.set_device(device) # Restore the previous device for any other networks
+        else:
+            if verbose > 0:
+                print('Reusing standalone build: {}'.format(key))
+
+        G, monitor, phi = self.standaloneBuild['objects']
+        runArgs = {phi: phi_tM * modelUnits['phi_m'],
+                   getattr(G, self.varV): Vclamps * modelUnits['E']}
+        for s, s0 in zip(self.stateVars, RhO.s_0):
+            runArgs[getattr(G, s)] = s0 * np.ones(nTrials)
+        for p in runParams:
+            runArgs[getattr(G, p)] = self.namespace[p]
+        self.standaloneBuild['device'].run(run_args=runArgs, with_output=verbose > 1)
+        return monitor
+
 
     '''
     def buildNetwork(self, network, namespace, G_RhO='G0', varIrho='I_RhO', varV='v'):
@@ -1089,6 +1433,103 @@ class simBrian(Simulator):
         self.net.add(self.monitors)  # manually add the monitors
     '''
 
+    def setRecords(self, group=None, record=0, recDt=None, states=True, voltage=True, summary=False, spikes=True):
+        """
+        Create the monitors for the rhodopsin group and add them to the network,
+        replacing any monitors created by an earlier call.
+
+        Parameters
+        ----------
+        group : str, optional
+            Name of the rhodopsin NeuronGroup (default: G_RhO).
+        record : int, list or bool, optional
+            Indices of the neurons to record (True for all). The first is used for the PhotoCurrent.
+        recDt : float, optional
+            Recording interval [ms] for the state monitors (default: every time step).
+        states : bool, optional
+            Record the rhodopsin state variables. If False the current is still
+            recorded for the first index.
+        voltage : bool, optional
+            Record the membrane potential.
+        summary : bool, optional
+            Record the mean photocurrent and population rate of the whole group
+            rather than the current of individual neurons.
+        spikes : bool, optional
+            Record the spikes of the group (if it has a threshold).
+
+        Set states=False, voltage=False for spike-only recording.
+        """
+
+        br = self.br
+        if group is None:
+            group = self.G_RhO
+        G = self.net[group]
+        if getattr(self, '_recObjects', None): # Remove the monitors from an earlier call (their names would clash)
+            self.net.remove(self._recObjects)
+        if recDt is not None:
+            recDt = recDt * ms
+        if record is not True:
+            record = list(np.atleast_1d(record))
+
+        monitors = {'spikes' : []}
+        if spikes and 'spike' in getattr(G, 'events', {}): # Only groups with a threshold emit spikes
+            monitors['spikes'].append(br.SpikeMonitor(G, name=group+'_spikes'))
+        if states:
+            monitors['states'] = br.StateMonitor(G, self.stateVars, record=record, dt=recDt)
+        if summary:
+            S = br.NeuronGroup(1, 'Imean : amp', name=group+'_summary')
+            Sy = br.Synapses(G, S, 'Imean_post = {}_pre/N_incoming : amp (summed)'.format(self.varIrho))
+            Sy.connect()
+            self._summed = Sy.summed_updaters['Imean_post']
+            self._summed.when = 'start' # Sum the current of this time step before it is recorded
+            monitors['Imean'] = br.StateMonitor(S, 'Imean', record=0, dt=recDt)
+            monitors['rate'] = br.PopulationRateMonitor(G)
+        else:
+            monitors['I'] = br.StateMonitor(G, self.varIrho, record=record, dt=recDt)
+        if voltage:
+            monitors['V'] = br.StateMonitor(G, self.varV, record=record, dt=recDt)
+
+        self._recObjects = [mon for key, mon in monitors.items() if key != 'spikes'] + monitors['spikes']
+        if summary:
+            self._recObjects += [S, Sy]
+        self.net.add(self._recObjects)
+        self.monitors = monitors
+        return monitors
+
+    def getRecords(self, RhO, V):
+        """Extract the states and photocurrent of the first recorded neuron by slicing the monitors"""
+
+        monitors = self.monitors
+
+        # Last value is not automatically recorded!
+        # https://github.com/brian-team/brian2/issues/452
+        if 'Imean' in monitors:
+            self._summed.run() # Sum the final current
+        for key in ['states', 'I', 'Imean', 'V']:
+            if key in monitors:
+                monitors[key].record_single_timestep()
+
+        if 'states' in monitors:
+            mon = monitors['states']
+            soln = np.empty((len(mon.t_), RhO.nStates))
+            for sInd, s in enumerate(self.stateVars):
+                soln[:, sInd] = mon.variables[s].get_value()[:, 0]
+            t = mon.t_ * 1000 # s -> ms
+            RhO.storeStates(soln[1:], t[1:])
+            states, t = RhO.getStates()
+        else: # Current only
+            states = None
+
+        if V is not None and states is not None:
+            I_RhO = RhO.calcI(V, RhO.states)
+        else:
+            key = 'I' if 'I' in monitors else 'Imean'
+            I_RhO = monitors[key].variables[monitors[key].record_variables[0]].get_value()[:, 0] * 1e9 # / nA
+            if states is None:
+                t = monitors[key].t_ * 1000 # s -> ms
+
+        return I_RhO, t, states
+
     def runTrial(self, RhO, phiOn, V, delD, cycles, dt, verbose=config.verbose):
         """Main routine for simulating a square pulse train"""
 
@@ -1177,23 +1618,7 @@ class simBrian(Simulator):
         If all neurons have been recorded (e.g. with record=True) then both forms give the same result.
         '''
 
-        assert(self.monitors['states'].n_indices == 1) # Assumes that only one neuron is recorded from...
-        # Last value is not automatically recorded!
-        # https://github.com/brian-team/brian2/issues/452
-        self.monitors['states'].record_single_timestep()
-        soln = np.hstack([self.monitors['states'].variables[s].get_value() for s in self.stateVars])
-        t = self.monitors['states'].t/ms
-        RhO.storeStates(soln[1:], t[1:])
-
-        states, t = RhO.getStates()
-
-        if V != None: # and 'I' in self.monitors:
-            I_RhO = RhO.calcI(V, RhO.states)
-        else:
-            self.monitors['I'].record_single_timestep()
-            I_RhO = self.monitors['I'].variables[self.varIrho].get_value() * 1e9# / nA
-            I_RhO = np.squeeze(I_RhO) # Replace with record indexing?
-        self.monitors['V'].record_single_timestep()
+        I_RhO, t, states = self.getRecords(RhO, V)
 
         #times, totT = cycles2times(cycles, delD)
         #self.plotRasters(times, totT)
@@ -1238,55 +1663,31 @@ class simBrian(Simulator):
             print(self.namespace)
 
         duration = totT # self.totT instead?
-        start, end = RhO.t[0], RhO.t[0]+delD
-        nSteps = int(round(((end-start)/dt)+1))
-        t = np.linspace(start, end, nSteps, endpoint=True)
-        phi_tV = np.zeros_like(t)
-
-        for p in range(nPulses):
-
-            start = end
-            onD, offD = cycles[p,0], cycles[p,1]
-            end = start + onD + offD
-
-            nSteps = int(round(((end-start)/dt)+1))
-            tPulse = np.linspace(start, end, nSteps, endpoint=True)
-            phi_t = phi_ts[p]
-            phiPulse = phi_t(tPulse) # -tPulse[0] # Align time vector to 0 for phi_t to work properly
-
-            onInd = len(t) - 1 # Start of on-phase
-            offInd = onInd + int(round(onD/dt))
-            RhO.pulseInd = np.vstack((RhO.pulseInd,[onInd,offInd]))
-
-            t = np.r_[t, tPulse[1:]]
-            phi_tV = np.r_[phi_tV, phiPulse[1:]]
+        nSamples = self.setPulseInds(RhO, phi_ts, delD, cycles, dt)
 
-            RhO.ssInf.append(RhO.calcSteadyState(phi_t(end-offD)))
-
-
-        phi_tV[np.ma.where(phi_tV < 0)] = 0 # Safeguard for negative phi values # np.clip(phi_tV, 0, phiMax)?
-        phi = self.br.TimedArray(phi_tV * modelUnits['phi_m'], dt=dt*ms, name='phi') # 'phi_t'
-        self.namespace.update({'phi':phi})
+        if self.batch: # Trials were simulated together in prepare
+            trial = (self.runInd * self.Prot.nPhis + self.phiInd) * self.Prot.nVs + self.vInd
+            soln = np.column_stack([self.batchMonitor.variables[s].get_value()[:nSamples, trial] for s in self.stateVars])
+            RhO.storeStates(soln[1:], self.batchMonitor.t[1:nSamples]/ms)
+            states, t = RhO.getStates()
+            if V is not None:
+                I_RhO = RhO.calcI(V, RhO.states)
+            else:
+                I_RhO = self.batchMonitor.variables[self.varIrho].get_value()[:nSamples, trial] * 1e9 # / nA
+            return I_RhO, t, states
+
+        # Reuse the same TimedArray for every trial with this waveform so that
+        # the namespace is unchanged and Brian does not regenerate code
+        key = (self.runInd, self.phiInd)
+        if key not in self.stimCache:
+            phi_tV = self.Prot.getStimArray(self.runInd, self.phiInd, dt)
+            self.stimCache[key] = self.br.TimedArray(phi_tV * modelUnits['phi_m'], dt=dt*ms, name='phi') # 'phi_t'
+        if self.namespace.get('phi') is not self.stimCache[key]:
+            self.namespace['phi'] = self.stimCache[key]
         self.net.run(duration=duration*ms, namespace=self.namespace, report=report)
 
         ### Calculate photocurrent
-        assert(self.monitors['states'].n_indices == 1) # Assumes that only one neuron is recorded
-        # Last value is not automatically recorded!
-        # https://github.com/brian-team/brian2/issues/452
-        self.monitors['states'].record_single_timestep()
-        soln = np.hstack([self.monitors['states'].variables[s].get_value() for s in self.stateVars])
-        t = self.monitors['states'].t/ms
-
-        RhO.storeStates(soln[1:], t[1:])
-        states, t = RhO.getStates()
-
-        if V != None: # and 'I' in self.monitors:
-            I_RhO = RhO.calcI(V, RhO.states)
-        else:
-            self.monitors['I'].record_single_timestep()
-            I_RhO = self.monitors['I'].variables[self.varIrho].get_value() * 1e9# / nA
-            I_RhO = np.squeeze(I_RhO) # Replace with record indexing?
-        self.monitors['V'].record_single_timestep()
+        I_RhO, t, states = self.getRecords(RhO, V)
 
         #for mon in self.monitors:
         #    mon.record_single_timestep()
@@ -1297,15 +1698,24 @@ class simBrian(Simulator):
 
 
     def saveExtras(self, run, phiInd, vInd):
+        if self.batch: # Only the clamped opsins are simulated
+            return
         ### TODO: Rethink this HACK!!!
         #self.rasters[run][phiInd][vInd] = copy.copy(self.monitors['spikes'])
-        self.rasters[run][phiInd][vInd] = [{'name' : self.monitors['spikes'][lay].name,
-                                            't' : self.monitors['spikes'][lay].t/ms,
-                                            'i' : self.monitors['spikes'][lay].i,
-                                            'n' : len(self.monitors['spikes'][lay].spike_trains())} for lay in range(len(self.monitors['spikes']))]
-        self.Vms[run][phiInd][vInd] = copy.copy(self.monitors['V'])
+        spikeMonitors = self.monitors.get('spikes', [])
+        self.rasters[run][phiInd][vInd] = [{'name' : spikeMonitors[lay].name,
+                                            't' : spikeMonitors[lay].t/ms,
+                                            'i' : spikeMonitors[lay].i,
+                                            'n' : len(spikeMonitors[lay].spike_trains())} for lay in range(len(spikeMonitors))]
+        if 'V' in self.monitors:
+            self.Vms[run][phiInd][vInd] = copy.copy(self.monitors['V'])
+        if 'rate' in self.monitors:
+            self.rates[run][phiInd][vInd] = {'t' : self.monitors['rate'].t/ms,
+                                             'rate' : np.array(self.monitors['rate'].rate_)} # Hz
 
     def plotExtras(self):
+        if self.batch:
+            return
         Prot = self.Prot
         RhO = self.RhO
         for run in range(Prot.nRuns):                   # Loop over the number of runs...
@@ -1319,10 +1729,13 @@ class simBrian(Simulator):
 
                     figName = '{}Vm{}s-{}-{}-{}'.format(Prot.protocol, RhO.nStates, run, phiInd, vInd)
                     Vmonitor = self.Vms[run][phiInd][vInd]
-                    self.plotVm(Vmonitor=Vmonitor, times=pulses, totT=totT, offset=delD, figName=figName)
+                    if Vmonitor is not None:
+                        self.plotVm(Vmonitor=Vmonitor, times=pulses, totT=totT, offset=delD, figName=figName)
 
                     figName = '{}Spikes{}s-{}-{}-{}'.format(Prot.protocol, RhO.nStates, run, phiInd, vInd)
                     spikeMonitors = self.rasters[run][phiInd][vInd]
+                    if not spikeMonitors: # e.g. groups without a threshold
+                        continue
                     self.plotRasters(spikeSets=spikeMonitors, times=pulses, totT=totT, offset=delD, figName=figName)
         return
 
@@ -649,3 +649,31 @@ def biExpSum(t, a_act, tau_act, a_deact, tau_deact, a0):
     """Calculate the sum of two opposite exponential functions"""
     return a0 + a_act*(1-np.exp(-t/tau_act)) + a_deact*np.exp(-t/tau_deact)
 
+
+def solveAmplitude(I, base, basis, aMin=-np.inf, aMax=np.inf):
+    r"""
+    Solve for the linear amplitude of a separable model in closed form.
+
+    Finds the least-squares :math:`a` in :math:`I \approx base + a \cdot basis`
+    (clipped to the bounds :math:`[aMin, aMax]`) so that only the nonlinear
+    parameters (e.g. rates) which define ``base`` and ``basis`` need to be
+    searched by the optimiser (variable projection).
+
+    Parameters
+    ----------
+    I : ndarray
+        Data to fit.
+    base, basis : ndarray
+        Fixed part of the model and the term scaled by the amplitude.
+    aMin, aMax : float, optional
+        Bounds on the amplitude.
+
+    Returns
+    -------
+    float
+        The optimal (bounded) amplitude.
+    """
+    norm = np.dot(basis, basis)
+    if norm == 0: # The amplitude is unidentifiable e.g. for equal rates
+        return np.clip(0, aMin, aMax)
+    return np.clip(np.dot(I - base, basis) / norm, aMin, aMax)
@@ -0,0 +1,16 @@
+"""Shared settings for the PyRhO test suite"""
+
+import matplotlib
+matplotlib.use('Agg') # Tests must not open figures
+
+import pytest
+
+import pyrho as pr
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    """Silence the progress reports"""
+    verbose, pr.config.verbose = pr.config.verbose, 0
+    yield
+    pr.config.verbose = verbose
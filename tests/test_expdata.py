@@ -0,0 +1,120 @@
+"""Tests for the photocurrent data"""
+
+import numpy as np
+import pytest
+
+import pyrho as pr
+from pyrho.expdata import PhotoCurrent, StreamingPhotoCurrent, extractFeatures, MovingAverage
+
+
+def simulate(protocol='step'):
+    Prot = pr.protocols[protocol](saveData=False)
+    Sim = pr.simulators['Python'](Prot, pr.models['6']())
+    Sim.run(verbose=0)
+    return Prot.PD
+
+
+def trials(PD):
+    return [PD.trials[run][phiInd][vInd] for run in range(PD.nRuns)
+            for phiInd in range(PD.nPhis) for vInd in range(PD.nVs)]
+
+
+### Filters
+
+@pytest.mark.parametrize('nPoints', [1, 4, 11])
+def test_moving_average_matches_convolution(nPoints):
+    rng = np.random.RandomState(42)
+    dt = 0.1
+    t = np.arange(2000) * dt
+    I = rng.randn(len(t)).cumsum()
+    Ifilt, tfilt = MovingAverage(t_window=nPoints*dt)(I, t)
+    np.testing.assert_allclose(Ifilt, np.convolve(I, np.ones(nPoints)/nPoints, mode='same'), atol=1e-9)
+    assert tfilt is t
+
+
+def test_filtering_protocol_data_refreshes_its_features():
+    PD = simulate('step')
+    before = [pc.peak_ for pc in trials(PD)]
+    PD.filter([MovingAverage(5)])
+    for run, phiInd, vInd in np.ndindex(PD.nRuns, PD.nPhis, PD.nVs):
+        pc = PD.trials[run][phiInd][vInd]
+        assert PD.peak_[run][phiInd][vInd] == pc.peak_
+        assert PD.ss_[run][phiInd][vInd] == pc.ss_
+    assert [pc.peak_ for pc in trials(PD)] != before
+
+
+### Feature extraction
+
+@pytest.mark.parametrize('protocol', ['step', 'shortPulse', 'recovery'])
+def test_extracted_features_match_photocurrents(protocol):
+    pcs = trials(simulate(protocol))
+    features = extractFeatures(pcs, chunkSize=2**12) # Spread over several chunks
+    assert len(features) == sum(pc.nPulses for pc in pcs)
+    for record in features:
+        pc = pcs[record.trial]
+        p = record.pulse
+        assert record.peakInd == pc.peakInds_[p]
+        assert np.isclose(record.Ipeak, pc.peaks_[p])
+        assert np.isclose(record.Iss, pc.sss_[p])
+        assert np.isclose(record.lag, pc.lags_[p])
+
+
+def test_feature_table_can_be_restricted_to_trials():
+    PD = simulate('step')
+    features = PD.getFeatures()
+    assert len(features) == PD.nRuns * PD.nPhis * PD.nVs
+    subset = PD.getFeatures(phiInd=1, vInd=2)
+    assert len(subset) == 1 and (subset.phiInd[0], subset.vInd[0]) == (1, 2)
+    assert subset[0] == features[(features.phiInd == 1) & (features.vInd == 2)][0]
+
+
+def oldIpmax(PD, vInds):
+    """Most extreme of the stored peaks, searched in (run, phi, V) order"""
+    Ipmax, inds = 0, None
+    for run, phiInd, vInd in np.ndindex(PD.nRuns, PD.nPhis, PD.nVs):
+        if vInd in vInds and abs(PD.trials[run][phiInd][vInd].peak_) > abs(Ipmax):
+            Ipmax, inds = PD.trials[run][phiInd][vInd].peak_, (run, phiInd, vInd)
+    return Ipmax, inds
+
+
+def test_protocol_peaks_and_steady_states_match_the_photocurrents():
+    PD = simulate('step')
+    assert PD.getIpmax() == oldIpmax(PD, range(PD.nVs))
+    assert PD.getIpmax(vInd=1) == oldIpmax(PD, [1])
+
+    Iss, Vs = PD.getSteadyStates()
+    assert Iss.shape == Vs.shape == (PD.nPhis, PD.nVs)
+    for phiInd, vInd in np.ndindex(PD.nPhis, PD.nVs):
+        pc = PD.trials[0][phiInd][vInd]
+        assert np.isclose(Iss[phiInd, vInd], pc.ss_, rtol=1e-12) and Vs[phiInd, vInd] == pc.V # Summed in a different order
+    Iss, Vs = PD.getSteadyStates(phiInd=1)
+    np.testing.assert_allclose(Iss, [pc.ss_ for pc in PD.trials[0][1]], rtol=1e-12)
+    assert list(Vs) == PD.Vs
+
+    Ipeaks, tpeaks = PD.getProtPeaks() # Along the voltages (the last variation)
+    assert Ipeaks == [pc.peak_ for pc in PD.trials[0][0]] and tpeaks == [pc.tpeak_ for pc in PD.trials[0][0]]
+    assert PD.IphiPeaks == [PD.trials[0][phiInd][0].peak_ for phiInd in range(PD.nPhis)]
+
+
+def test_protocol_peaks_along_runs_take_the_most_extreme_pulse():
+    PD = simulate('recovery') # Two pulses per trial
+    Ipeaks, tpeaks = PD.getProtPeaks()
+    assert Ipeaks == PD.IrunPeaks == [PD.trials[run][0][0].peak_ for run in range(PD.nRuns)]
+    assert tpeaks == [PD.trials[run][0][0].tpeak_ for run in range(PD.nRuns)]
+
+
+### Streaming acquisition
+
+def test_streaming_photocurrent_matches_batch():
+    pc = trials(simulate('recovery'))[3]
+    stream = StreamingPhotoCurrent(pc.pulses, pc.phi, pc.V, dt=pc.dt, begT=pc.t[0], capacity=64)
+    for start in range(0, pc.nSamples, 777):
+        stream.append(pc.I[start:start+777], pc.t[start:start+777])
+    assert len(stream) == pc.nSamples
+    np.testing.assert_array_equal(stream.peakInds_, pc.peakInds_)
+    np.testing.assert_allclose(stream.peaks_, pc.peaks_)
+    np.testing.assert_allclose(stream.sss_, pc.sss_)
+    finished = stream.finish()
+    assert isinstance(finished, PhotoCurrent)
+    np.testing.assert_array_equal(finished.I, pc.I)
+    assert np.isclose(finished.peak_, pc.peak_)
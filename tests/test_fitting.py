@@ -0,0 +1,320 @@
+"""Tests for model fitting"""
+
+import copy
+
+import numpy as np
+import pytest
+from lmfit import Parameters, minimize
+from scipy.integrate import odeint
+
+import pyrho as pr
+from pyrho.fitting import (bootstrapFit, calcCycleCurrents, errCycle, errOffPhase, errOnPhase, fit3states, fitModel,
+                           fitModels, FitStore, fitPopulation, getFitData, profileFit, resampleBlocks, sampleStarts,
+                           solveOffAmplitudes)
+from pyrho.utilities import solveAmplitude
+
+
+def simulateSteps(**values):
+    """Step protocol photocurrents of the 3-state model (with any changed parameter values) at two fluxes"""
+    Prot = pr.protocols['step'](saveData=False)
+    Prot.phis, Prot.Vs = [1e16, 1e17], [-70]
+    RhO = pr.models['3']()
+    RhO.updateParams(pr.modelParams['3'])
+    for name, value in values.items():
+        setattr(RhO, name, value)
+    PD = pr.simulators['Python'](Prot, RhO).run(verbose=0)
+    return {'step': PD}
+
+
+@pytest.fixture(scope='module')
+def steps():
+    """Step protocol photocurrents of the default 3-state model"""
+    return simulateSteps()
+
+
+### Fitting several models
+
+def test_fitting_models_in_a_pool_matches_serial_fits(steps):
+    nStates = [3, 4]
+    serialParams, serialResults = fitModels(steps, nStates=nStates, postFitOpt=False, workers=1, plot=False, verbose=0)
+    pooledParams, pooledResults = fitModels(steps, nStates=nStates, postFitOpt=False, workers=2, plot=False, verbose=0)
+    assert len(pooledParams) == len(pooledResults) == len(nStates)
+    # Results are returned in the order of the models however the workers finish
+    for nSt, params, pooled in zip(nStates, serialParams, pooledParams):
+        assert list(params) == list(pr.modelParams[str(nSt)])
+        assert list(pooled) == list(params)
+        np.testing.assert_allclose(list(pooled.valuesdict().values()), list(params.valuesdict().values()), rtol=1e-9)
+    for serial, pooled in zip(serialResults, pooledResults):
+        assert np.isclose(pooled.chisqr, serial.chisqr, rtol=1e-9)
+
+
+### Multiple starts
+
+@pytest.mark.parametrize('sampler', ['lhs', 'sobol'])
+def test_starts_are_repeatable_and_within_the_bounds(sampler):
+    params = pr.modelParams['6']
+    nStarts, spread = 16, 10
+    starts = sampleStarts(params, nStarts, sampler, spread=spread, seed=1)
+    assert len(starts) == nStarts
+    assert starts[0].valuesdict() == params.valuesdict()
+    names = [p for p in params if params[p].vary and params[p].expr is None]
+    for p in names:
+        values = np.array([start[p].value for start in starts])
+        assert np.all((values >= params[p].min) & (values <= params[p].max))
+        if params[p].value > 0:
+            lo, hi = max(params[p].min, params[p].value/spread), min(params[p].max, params[p].value*spread)
+            assert np.all((values >= lo*(1-1e-12)) & (values <= hi*(1+1e-12)))
+            if sampler == 'lhs': # One start in each stratum (the first start keeps the initial value)
+                u = np.log(values[1:]/lo) / np.log(hi/lo)
+                assert len(set(np.floor(u*nStarts).astype(int))) == nStarts - 1
+
+    again = sampleStarts(params, nStarts, sampler, spread=spread, seed=1)
+    assert [start.valuesdict() for start in again] == [start.valuesdict() for start in starts]
+    other = sampleStarts(params, nStarts, sampler, spread=spread, seed=2)
+    assert [start.valuesdict() for start in other[1:]] != [start.valuesdict() for start in starts[1:]]
+
+
+def test_multiple_starts_fit_at_least_as_well_as_one(steps):
+    kwargs = dict(nStates=4, postFitOpt=False, workers=1, plot=False, verbose=0)
+    _, single = fitModel(steps, **kwargs)
+    _, multi = fitModel(steps, nStarts=4, seed=0, **kwargs)
+    assert multi.chisqr <= single.chisqr
+    assert len(multi.starts) == 4 and multi.starts[0][1] == multi.chisqr
+
+
+### Variable projection
+
+def biexponentialDecays():
+    """Off-phase decays with known rates and amplitudes"""
+    lam1, lam2 = 0.02, 0.3
+    Isss, Islows = [-1.5, -0.6, 2.], [-0.4, -0.1, 0.5]
+    toffs = [np.linspace(0, 100, n) for n in [401, 301, 201]]
+    Ioffs = [Islow*np.exp(-lam1*t) + (Iss-Islow)*np.exp(-lam2*t) for t, Iss, Islow in zip(toffs, Isss, Islows)]
+    return lam1, lam2, Ioffs, toffs, Islows
+
+
+def test_solve_amplitude_recovers_and_bounds_the_amplitude():
+    t = np.linspace(0, 10, 50)
+    base, basis = np.sin(t), np.exp(-t)
+    assert np.isclose(solveAmplitude(base + 2.5*basis, base, basis), 2.5)
+    assert solveAmplitude(base + 2.5*basis, base, basis, aMax=1) == 1
+    assert solveAmplitude(base, base, np.zeros_like(t), aMin=0.5) == 0.5 # Unidentifiable
+
+
+def test_off_amplitudes_are_solved_for_known_rates():
+    lam1, lam2, Ioffs, toffs, Islows = biexponentialDecays()
+    np.testing.assert_allclose(solveOffAmplitudes(Ioffs, toffs, lam1, lam2), Islows, rtol=1e-12)
+    weights = [np.linspace(0.5, 1, len(t)) for t in toffs]
+    np.testing.assert_allclose(solveOffAmplitudes(Ioffs, toffs, lam1, lam2, weights), Islows, rtol=1e-12)
+    assert np.allclose(errOffPhase(lam1, lam2, Ioffs, toffs), 0, atol=1e-12)
+
+
+def test_projected_and_full_off_phase_fits_agree():
+    lam1, lam2, Ioffs, toffs, Islows = biexponentialDecays()
+    rates = Parameters()
+    rates.add('Gd1', value=0.01, min=0)
+    rates.add('Gd2', value=0.1, min=0)
+    projected = minimize(lambda p: errOffPhase(p['Gd1'].value, p['Gd2'].value, Ioffs, toffs), rates)
+
+    full = copy.deepcopy(rates)
+    for i, Ioff in enumerate(Ioffs):
+        full.add('Islow_'+str(i), value=0.2*Ioff[0])
+    def errFull(p):
+        v = p.valuesdict()
+        return np.concatenate([(Ioff - (v['Islow_'+str(i)]*np.exp(-v['Gd1']*t) + (Ioff[0]-v['Islow_'+str(i)])*np.exp(-v['Gd2']*t)))/Ioff[0]
+                               for i, (Ioff, t) in enumerate(zip(Ioffs, toffs))])
+    unprojected = minimize(errFull, full)
+
+    for fit in [projected, unprojected]:
+        assert np.isclose(fit.params['Gd1'].value, lam1, rtol=1e-6)
+        assert np.isclose(fit.params['Gd2'].value, lam2, rtol=1e-6)
+    assert projected.nvarys == 2 and unprojected.nvarys == 2 + len(Ioffs)
+    np.testing.assert_allclose(solveOffAmplitudes(Ioffs, toffs, lam1, lam2), 
+                               [unprojected.params['Islow_'+str(i)].value for i in range(len(Ioffs))], rtol=1e-6)
+
+
+def test_three_state_fits_agree_with_and_without_variable_projection(steps):
+    fits = [fit3states(steps['step'], 0, 0, copy.deepcopy(pr.modelParams['3']), verbose=0, varPro=varPro)
+            for varPro in [True, False]]
+    (projected, projectedResult), (full, fullResult) = fits
+    for p in projected:
+        assert np.isclose(projected[p].value, full[p].value, rtol=1e-6, atol=1e-9)
+    assert np.isclose(projectedResult.chisqr, fullResult.chisqr, rtol=1e-3, atol=1e-9)
+    assert np.isclose(projected['Gd'].value, pr.modelParams['3']['Gd'].value, rtol=1e-6) # The true rate
+
+
+### Residuals solved for all fluxes together
+
+def integratedCycles(data, RhO):
+    """Currents of each trial's on and off-phases integrated separately with odeint"""
+    Ions, Ioffs = [], []
+    for ton, toff, phi, V in zip(data.tons, data.toffs, data.phis, data.Vs):
+        RhO.setLight(phi)
+        on = odeint(RhO.solveStates, RhO.s_0, ton, Dfun=RhO.jacobian, rtol=1e-13, atol=1e-13)
+        RhO.setLight(0)
+        off = odeint(RhO.solveStates, on[-1], toff, Dfun=RhO.jacobian, rtol=1e-13, atol=1e-13)
+        Ions.append(RhO.calcI(V, on))
+        Ioffs.append(RhO.calcI(V, off))
+    return np.concatenate(Ions), np.concatenate(Ioffs)
+
+
+@pytest.mark.parametrize('nStates', ['3', '6'])
+def test_cycle_residuals_match_integration(steps, nStates):
+    data = getFitData(steps['step'])
+    params = copy.deepcopy(pr.modelParams[nStates])
+    RhO = pr.models[nStates]()
+    RhO.updateParams(params)
+    Ion, Ioff = integratedCycles(data, RhO)
+    scale = np.abs(data.Ion).max()
+
+    onModel, offModel = calcCycleCurrents(params, data, RhO)
+    np.testing.assert_allclose(onModel, Ion, rtol=0, atol=2e-10*scale)
+    np.testing.assert_allclose(offModel, Ioff, rtol=0, atol=2e-10*scale)
+
+    np.testing.assert_allclose(errOnPhase(params, data, RhO), (data.Ion - Ion) / data.onNorm, rtol=0, atol=1e-9)
+    expected = np.concatenate(((data.Ion - Ion) / data.onNorm, (data.IoffTail - Ioff[data.offTail]) / data.offTailNorm))
+    np.testing.assert_allclose(errCycle(params, data, RhO), expected, rtol=0, atol=1e-9)
+
+
+### Coarse-to-fine fits
+
+def test_decimation_keeps_the_pulse_boundaries(steps):
+    data = getFitData(steps['step'])
+    coarse = data.decimate(8)
+    assert coarse.factor == 8 and data.decimate(1) is data
+    assert len(coarse.Ion) + len(coarse.Ioff) < (len(data.Ion) + len(data.Ioff)) / 4
+    np.testing.assert_array_equal(coarse.nfs, data.nfs)
+    for segments in [('Ions', 'tons', 'onLengths'), ('Ioffs', 'toffs', 'offLengths')]:
+        Is, ts, lengths = segments
+        for I, t, cI, ct, n in zip(getattr(data, Is), getattr(data, ts), getattr(coarse, Is), getattr(coarse, ts), getattr(data, lengths)):
+            assert ct[0] == t[0] == 0 and ct[-1] == t[-1] # Light on/off at the segment ends
+            assert cI[0] == I[0] and cI[-1] == I[-1]
+            assert np.all(np.diff(ct) > 0) and np.all(np.isin(ct, t))
+    # Each retained sample stands for its share of the original samples
+    onWeights = np.split(coarse.onWeight, np.cumsum(coarse.onLengths)[:-1])
+    np.testing.assert_allclose([np.sum(w**2) for w in onWeights], data.onLengths)
+    np.testing.assert_allclose([np.sum(w**2) for w in coarse.offWeights], data.offLengths)
+
+
+@pytest.mark.parametrize('postFitOpt', [False, True])
+def test_coarse_to_fine_fit_matches_the_full_fit(steps, postFitOpt):
+    kwargs = dict(nStates=3, postFitOpt=postFitOpt, plot=False, verbose=0)
+    full, fullResult = fitModel(steps, **kwargs)
+    multi, multiResult = fitModel(steps, multiRes=(8, 1), **kwargs)
+    assert multiResult.ndata == fullResult.ndata # Finished on the full resolution data
+    for p in full:
+        if full[p].vary:
+            assert np.isclose(multi[p].value, full[p].value, rtol=1e-3), p
+    assert multiResult.chisqr <= max(2 * fullResult.chisqr, 1e-9)
+
+
+### Fit store
+
+def test_fingerprint_ignores_time_alignment(steps):
+    fingerprint = FitStore.fingerprint(steps)
+    shifted = copy.deepcopy(steps)
+    for pc in [pc for run in shifted['step'].trials for phis in run for pc in phis if pc is not None]:
+        pc.alignToTime()
+    assert FitStore.fingerprint(shifted) == fingerprint
+
+    changed = copy.deepcopy(steps)
+    changed['step'].trials[0][0][0].I[10] += 1e-3
+    assert FitStore.fingerprint(changed) != fingerprint
+
+
+def test_store_hits_identical_fits_and_misses_changed_parameters(steps, tmpdir):
+    store = FitStore(str(tmpdir))
+    defaults = copy.deepcopy(pr.modelParams['3'])
+    kwargs = dict(nStates=3, postFitOpt=False, store=store, plot=False, verbose=0)
+    params, _ = fitModel(steps, **kwargs)
+    assert len(store.records(3)) == 1
+    assert FitStore.dumpParams(pr.modelParams['3']) == FitStore.dumpParams(defaults) # Defaults left unchanged
+
+    # Hit: the stored parameters are returned without refitting
+    stored, _ = fitModel(steps, **kwargs)
+    assert len(store.records(3)) == 1
+    assert stored.valuesdict() == params.valuesdict()
+
+    # Miss: different bounds give a new fit
+    bounded = copy.deepcopy(pr.modelParams['3'])
+    bounded['Gd'].max = 0.2
+    fitModel(steps, params=bounded, **kwargs)
+    assert len(store.records(3)) == 2
+
+
+### Population fits
+
+def test_population_fit_keys_cells_and_records_failures(steps):
+    g0 = pr.modelParams['3']['g0'].value
+    cells = {'control': steps, 'strong': simulateSteps(g0=2*g0), 'empty': {}}
+    population = fitPopulation(cells, nStates=3, postFitOpt=False, workers=1, verbose=0)
+
+    assert len(population) == 3 and population['cell'] == ['control', 'strong', 'empty']
+    assert set(population.params) == {('control', 3), ('strong', 3)}
+    assert [row['cell'] for row in population.failures] == ['empty']
+    assert population['error'][2].startswith('KeyError')
+    assert str(population) == 'Population fit of 3 cells: 3 fits (1 failed)'
+
+    for cell, values in [('control', {}), ('strong', {'g0': 2*g0})]:
+        _, result = fitModel(cells[cell], nStates=3, postFitOpt=False, plot=False, verbose=0)
+        row = population[population['cell'].index(cell)]
+        for stat in population.statColumns:
+            assert np.isclose(row[stat], getattr(result, stat), rtol=1e-9)
+        assert row['error'] is None and row['time'] > 0
+        assert np.isclose(row['g0'], values.get('g0', g0), rtol=1e-2)
+    assert np.isnan(population['chisqr'][2]) and np.isnan(population['g0'][2])
+
+
+### Confidence intervals
+
+@pytest.fixture(scope='module')
+def noisyFit(steps):
+    """Noisy step photocurrents with a fit of g0 and Gd (the other parameters are fixed at their true values)"""
+    noisy = copy.deepcopy(steps['step'])
+    rng = np.random.RandomState(0)
+    for pc in [pc for run in noisy.trials for phis in run for pc in phis]:
+        pc.I = pc.I + 0.02 * np.abs(pc.I).max() * rng.randn(len(pc.I))
+    params = copy.deepcopy(pr.modelParams['3'])
+    for p in params:
+        params[p].vary = p in ('g0', 'Gd')
+    fitted = minimize(errCycle, params, args=(getFitData(noisy), pr.models['3']()), method='lbfgsb').params
+    return noisy, fitted
+
+
+def test_block_resampling_keeps_blocks_within_their_segments():
+    lengths = [10, 7, 1]
+    residuals = np.arange(sum(lengths), dtype=float)
+    resampled = resampleBlocks(residuals, lengths, blockLength=3, rng=np.random.RandomState(0))
+    assert np.array_equal(resampled, resampleBlocks(residuals, lengths, blockLength=3, rng=np.random.RandomState(0)))
+    start = 0
+    for n in lengths:
+        segment = resampled[start:start+n] - start
+        assert np.all((segment >= 0) & (segment < n)) # Drawn from the same segment
+        for block in range(0, n, 3): # Each block is a contiguous (circular) run
+            assert np.all(np.diff(segment[block:block+3]) % n == 1 % n)
+        start += n
+
+
+@pytest.mark.parametrize('kind', ['residual', 'case'])
+def test_bootstrap_intervals_are_repeatable_and_cover_the_truth(noisyFit, kind):
+    noisy, fitted = noisyFit
+    kwargs = dict(nBoot=20, kind=kind, workers=1, seed=1, verbose=0)
+    cis, samples = bootstrapFit(noisy, 3, fitted, **kwargs)
+    again, againSamples = bootstrapFit(noisy, 3, fitted, **kwargs)
+    assert set(cis) == {'g0', 'Gd'} and cis == again
+    for p in cis:
+        assert np.array_equal(samples[p], againSamples[p])
+        assert cis[p][0] < cis[p][1]
+        assert cis[p][0] <= pr.modelParams['3'][p].value <= cis[p][1]
+
+
+def test_profile_intervals_bracket_the_fit_and_the_truth(noisyFit):
+    noisy, fitted = noisyFit
+    cis, profiles = profileFit(noisy, 3, fitted, nPoints=10, spread=1.01, workers=1, verbose=0)
+    assert set(cis) == {'g0', 'Gd'}
+    for p in cis:
+        lower, upper = cis[p]
+        assert lower < fitted[p].value < upper
+        assert lower <= pr.modelParams['3'][p].value <= upper
+        values, chisqrs = profiles[p]
+        assert np.all(np.diff(values) > 0) and np.argmin(chisqrs) == np.searchsorted(values, fitted[p].value)
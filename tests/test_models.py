@@ -0,0 +1,48 @@
+"""Tests for the rhodopsin models"""
+
+import sys
+
+import numpy as np
+import pytest
+from scipy.integrate import odeint
+
+import pyrho as pr
+
+
+def integrate(RhO, ts, phis, s0s):
+    """Integrate each constant-flux trial with tight tolerances"""
+    states = []
+    for t, phi, s0 in zip(ts, phis, s0s):
+        RhO.setLight(phi)
+        states.append(odeint(RhO.solveStates, s0, t, Dfun=RhO.jacobian, rtol=1e-13, atol=1e-13))
+    return np.concatenate(states)
+
+
+@pytest.mark.parametrize('nStates', ['3', '4', '6'])
+def test_trial_solutions_match_integration(nStates):
+    RhO = pr.models[nStates]()
+    phis = [0, 1e15, 1e17, 1e19]
+    ts = [np.linspace(0, T, n) for T, n in [(50, 101), (100, 1001), (250, 2501), (10, 3)]]
+    s0s = np.tile(RhO.s_0, (len(phis), 1))
+    s0s[0] = np.roll(RhO.s_0, 1) # Relax from a non-dark state without light
+    states, lengths = RhO.calcSolns(ts, phis, s0s)
+    assert list(lengths) == [len(t) for t in ts]
+    np.testing.assert_allclose(states, integrate(RhO, ts, phis, s0s), rtol=0, atol=2e-10)
+
+    # The concatenated form gives the same solutions
+    concatenated, _ = RhO.calcSolns(np.concatenate(ts), phis, s0s, lengths=lengths)
+    np.testing.assert_array_equal(concatenated, states)
+
+
+def test_defective_matrices_fall_back_to_integration(monkeypatch):
+    RhO = pr.models['6']()
+    phis = [1e16, 1e18]
+    ts = [np.linspace(0, 100, 501) for phi in phis]
+    eigen, _ = RhO.calcSolns(ts, phis)
+    monkeypatch.setattr(np.linalg, 'cond', lambda vecs: np.full(vecs.shape[:-2], np.inf)) # Ill-conditioned eigenvectors
+    calls = []
+    monkeypatch.setattr(sys.modules[type(RhO).__module__], 'odeint',
+                        lambda *args, **kwargs: calls.append(args) or odeint(*args, **kwargs))
+    integrated, lengths = RhO.calcSolns(ts, phis)
+    assert len(calls) == len(phis) and list(lengths) == [len(t) for t in ts]
+    np.testing.assert_allclose(integrated, eigen, rtol=0, atol=1e-6)
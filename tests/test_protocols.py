@@ -0,0 +1,141 @@
+"""Tests for the protocols and their simulation"""
+
+import itertools
+import pickle
+
+import numpy as np
+import pytest
+from scipy.interpolate import InterpolatedUnivariateSpline as spline
+
+import pyrho as pr
+from pyrho.protocols import Pulse, RampPulse, SinusoidPulse, ChirpPulse
+from pyrho.simulators import trialCache
+
+
+def simulate(protocol='step', nStates=3, dedup=False):
+    """Run a protocol with default parameters and return it with its simulator and model"""
+    Prot = pr.protocols[protocol](saveData=False)
+    RhO = pr.models[str(nStates)]()
+    Sim = pr.simulators['Python'](Prot, RhO)
+    Sim.dedup = dedup
+    Sim.run(verbose=0)
+    return Prot, Sim, RhO
+
+
+def currents(PD):
+    return [PD.trials[run][phiInd][vInd].I for run in range(PD.nRuns)
+            for phiInd in range(PD.nPhis) for vInd in range(PD.nVs)]
+
+
+### Analytic pulses
+
+def test_square_and_ramp_pulses_match_linear_splines():
+    t = np.linspace(0, 300, 3001)
+    np.testing.assert_allclose(Pulse(50, 150, 1e17)(t), spline([50, 150], [1e17, 1e17], k=1, ext=1)(t))
+    np.testing.assert_allclose(RampPulse(50, 150, 1e17, 1e15)(t),
+                               spline([50, 150], [1e15, 1e15+1e17], k=1, ext=1)(t), rtol=1e-12, atol=1)
+
+
+@pytest.mark.parametrize('startOn', [False, True])
+def test_sinusoid_pulse_matches_spline(startOn):
+    start, onD, phi, phi0, w, sr = 25, 200, 1e17, 1e15, 2*np.pi*10/1000, 10000
+    tau = np.linspace(0, onD, int(round(onD*sr/1000))+1)
+    sign = 1 if startOn else -1
+    phi_t = spline(start + tau, phi0 + 0.5*phi*(1 + sign*np.cos(w*tau)), ext=1, k=5)
+    pulse = SinusoidPulse(start, start + onD, phi, w, phi0, startOn)
+    t = np.linspace(0, 300, 6001)
+    np.testing.assert_allclose(pulse(t), phi_t(t), rtol=0, atol=1e-6*phi)
+    assert pulse(start - 1) == 0 and pulse(start + onD + 1) == 0
+
+
+@pytest.mark.parametrize('linear', [True, False])
+def test_chirp_pulse_matches_spline(linear):
+    start, onD, phi, f0, fT, sr = 100, 500, 1e17, 0.1, 50, 10000
+    tau = np.linspace(0, onD, int(round(onD*sr/1000))+1)
+    ft = (f0 + (fT-f0)*(tau/onD) if linear else f0 * (fT/f0)**(tau/onD)) / 1000
+    phi_t = spline(start + tau, 0.5*phi*(1 - np.cos(ft*tau)), ext=1, k=5)
+    pulse = ChirpPulse(start, start + onD, phi, f0, fT, linear)
+    t = np.linspace(0, 700, 7001)
+    np.testing.assert_allclose(pulse(t), phi_t(t), rtol=0, atol=1e-6*phi)
+
+
+def test_scalar_and_array_evaluation_agree():
+    pulse = SinusoidPulse(10, 60, 1e16, 0.5)
+    t = np.linspace(0, 70, 71)
+    assert np.array_equal(pulse(t), [pulse(ti) for ti in t])
+
+
+### Trial plans
+
+def test_plan_covers_every_trial_in_order():
+    Prot = pr.protocols['rectifier'](saveData=False)
+    Prot.prepare()
+    plan = Prot.plan(0.1)
+    assert len(plan) == Prot.nRuns * Prot.nPhis * Prot.nVs
+    assert [(spec.run, spec.phiInd, spec.vInd) for spec in plan] == \
+           list(itertools.product(range(Prot.nRuns), range(Prot.nPhis), range(Prot.nVs)))
+    for spec in plan:
+        assert spec.phi == Prot.phis[spec.phiInd] and spec.V == Prot.Vs[spec.vInd]
+        assert not spec.cycles.flags.writeable and not spec.pulses.flags.writeable
+        assert len(spec.stimulus) == spec.cycles.shape[0]
+
+
+def test_plan_follows_the_cycles_of_each_run():
+    Prot = pr.protocols['recovery'](saveData=False)
+    Prot.prepare()
+    for spec in Prot.plan(0.1):
+        cycles, delD = Prot.getRunCycles(spec.run)
+        assert np.array_equal(spec.cycles, cycles) and spec.delD == delD
+
+
+### Trial sharing
+
+def test_dedup_is_opt_in_and_bit_identical():
+    trialCache.clear()
+    Prot, Sim, RhO = simulate(dedup=False)
+    assert not pr.simulators['Python'](Prot, RhO).dedup
+    reference = [I.copy() for I in currents(Prot.PD)]
+    states, pulseInd = RhO.states.copy(), RhO.pulseInd.copy()
+    assert len(trialCache) == 0
+
+    Sim.dedup = True
+    Sim.run(verbose=0) # Fills the cache
+    Sim.run(verbose=0) # Shares every trial
+    assert Sim.nShared == len(Prot.plan())
+    for I, Iref in zip(currents(Prot.PD), reference):
+        assert np.array_equal(I, Iref)
+    assert np.array_equal(RhO.states, states) and np.array_equal(RhO.pulseInd, pulseInd)
+    trialCache.clear()
+    assert len(trialCache) == 0
+
+
+### Stimulus cache
+
+def test_stimulus_arrays_are_cached_but_not_pickled():
+    Prot, _, _ = simulate('sinusoid')
+    stim = Prot.getStimArray(0, 0, Prot.dt)
+    assert Prot.getStimArray(0, 0, Prot.dt) is stim and not stim.flags.writeable
+    assert '_stimCache' not in pickle.loads(pickle.dumps(Prot)).__dict__
+
+
+### Sweeps and batteries
+
+def test_sweep_simulates_duplicate_points_once():
+    sweep = pr.Sweep('step', {'Gd': [0.1, 0.2, 0.1]})
+    jobs, cells = sweep.plan()
+    assert len(jobs) == 2 and cells == [0, 1, 0]
+    results = sweep.run(workers=1, verbose=0)
+    assert results.shape == (3,) and results[0] is results[2]
+    assert sweep.sel(Gd=0.2) is results[1]
+    assert abs(results[0].trials[0][0][0].peak_) != abs(results[1].trials[0][0][0].peak_)
+
+
+def test_battery_keeps_models_with_the_same_states_apart():
+    slow, fast = pr.models['3'](), pr.models['3']()
+    fast.g0 = 2 * slow.g0
+    report = pr.runBattery([slow, fast], ['step', 'delta'], workers=1, saveData=False, verbose=0)
+    assert len(report) == 4 and not report.failures
+    matrix = report.matrix
+    assert matrix.shape == (2, 2, 1)
+    peaks = [matrix[m, 0, 0].PD.trials[0][0][0].peak_ for m in range(2)]
+    assert np.isclose(peaks[1], 2 * peaks[0])
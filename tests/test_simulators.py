@@ -0,0 +1,274 @@
+"""Tests for the simulators: NEURON expression and stimulus playback, Brian batches and monitors and adaptive grids"""
+
+import copy
+
+import numpy as np
+import pytest
+
+import pyrho as pr
+from pyrho.expdata import PhotoCurrent
+
+
+def neuronSimulator(nSections=20, **simValues):
+    """Create a NEURON simulator for the step protocol on a cell with extra dendrites"""
+    pytest.importorskip('neuron')
+    params = copy.deepcopy(pr.simParams['NEURON'])
+    for name, value in simValues.items():
+        params[name].value = value
+    Prot = pr.protocols['step'](saveData=False)
+    RhO = pr.models['3']()
+    Sim = pr.simulators['NEURON'](Prot, RhO, params)
+    Sim.h('create dend[{}]'.format(nSections))
+    Sim.buildCell([]) # Collect the new sections
+    return Sim, RhO
+
+
+### NEURON expression
+
+def expression(Sim, RhO, seed):
+    Sim.transduce(RhO, expProb=0.5, expVar=0.3, seed=seed)
+    sections = [rho.get_segment().sec.name() for rho in Sim.rhoList]
+    return sections, Sim.expLevels.copy()
+
+
+def test_neuron_expression_is_seeded():
+    Sim, RhO = neuronSimulator()
+    sections, levels = expression(Sim, RhO, seed=1)
+    assert 0 < len(sections) < Sim.nSecs and len(levels) == len(sections)
+    assert np.isclose(levels.mean(), 1, atol=0.5)
+
+    sameSections, sameLevels = expression(Sim, RhO, seed=1)
+    assert sameSections == sections and np.array_equal(sameLevels, levels)
+
+    otherSections, otherLevels = expression(Sim, RhO, seed=2)
+    assert otherSections != sections or not np.array_equal(otherLevels, levels)
+
+
+def test_neuron_bulk_parameters_match_per_rhodopsin_assignment():
+    Sim, RhO = neuronSimulator()
+    Sim.transduce(RhO, expProb=1, expVar=0.3, seed=3)
+    Sim.setOpsinParams(Sim.rhoList, Sim.rhoParams, Sim.expLevels)
+    for rho, level in zip(Sim.rhoList, Sim.expLevels):
+        for p in Sim.rhoParams:
+            expected = Sim.rhoParams[p].value * (level if p in Sim.expScaled else 1)
+            assert np.isclose(getattr(rho, p), expected)
+
+    # Assigning each rhodopsin in Python gives the same values
+    bulk = [[getattr(rho, p) for p in Sim.rhoParams] for rho in Sim.rhoList]
+    for rho, level in zip(Sim.rhoList, Sim.expLevels):
+        for p in Sim.rhoParams:
+            setattr(rho, p, Sim.rhoParams[p].value * (level if p in Sim.expScaled else 1))
+    assert bulk == [[getattr(rho, p) for p in Sim.rhoParams] for rho in Sim.rhoList]
+
+
+### NEURON stimulus playback
+
+def pythonTrials(protocol):
+    """Simulate a protocol with the Python simulator and return it with its trials"""
+    Prot = pr.protocols[protocol](saveData=False)
+    Sim = pr.simulators['Python'](Prot, pr.models['3']())
+    Sim.run(verbose=0)
+    return Prot, Sim
+
+
+@pytest.mark.parametrize('protocol', ['step', 'recovery'])
+def test_play_arrays_duplicate_the_pulse_edges(protocol):
+    Prot, Sim = pythonTrials(protocol)
+    for run, phiInd in np.ndindex(Prot.nRuns, Prot.nPhis):
+        pc = Prot.PD.trials[run][phiInd][0]
+        onInds, offInds = pc.pulseInds[:, 0], pc.pulseInds[:, 1]
+        t, phi_tV, disc = pr.simulators['NEURON'].getPlayArrays(Prot, run, phiInd, Sim.dt, onInds, offInds)
+        stim = Prot.getStimArray(run, phiInd, Sim.dt)
+
+        assert np.all(np.diff(t) >= 0)
+        assert len(t) == len(phi_tV) == len(stim) + 2 * pc.nPulses
+        assert len(disc) == 2 * pc.nPulses and np.all(np.diff(disc) > 0)
+        assert np.all(phi_tV[disc] == 0) # Zero flux at the inserted samples
+        # Removing the inserted samples recovers the sampled stimulus, with lit onsets
+        lit = stim.copy()
+        lit[onInds] = pc.phi
+        assert np.array_equal(np.delete(phi_tV, disc), lit)
+        np.testing.assert_allclose(np.delete(t, disc), pc.t - pc.t[0], atol=1e-9)
+        for p in range(pc.nPulses):
+            on, off = disc[2*p], disc[2*p+1]
+            assert t[on] == t[on+1] == pc.pulses[p, 0] - pc.t[0]   # Dark then lit at the same time
+            assert phi_tV[on+1] == pc.phi
+            assert t[off] == t[off-1] == pc.pulses[p, 1] - pc.t[0] # Lit then dark at the same time
+            assert phi_tV[off-1] == pc.phi
+
+
+def test_neuron_plays_the_python_stimulus():
+    Sim, RhO = neuronSimulator(nSections=0)
+    rec = Sim.h.Vector()
+    rec.record(Sim.rhoList.o(0)._ref_phi)
+    Sim.run(verbose=0)
+    Prot = Sim.Prot
+    tN, phiN = np.array(Sim.t), np.array(rec.to_python())[:len(Sim.t)]
+
+    PyProt, _ = pythonTrials('step')
+    pc = PyProt.PD.trials[-1][-1][0] # The last trial was recorded
+    tPy = pc.t - pc.t[0]
+    edges = np.any(np.isclose(tN[:, None], (pc.pulses - pc.t[0]).ravel()[None, :], atol=2*Sim.dt), axis=1)
+    np.testing.assert_allclose(phiN[~edges], np.interp(tN, tPy, pc.stimuli)[~edges], rtol=1e-9)
+
+
+### Brian batches
+
+def brianSimulator(phis=(1e16, 1e17), Vs=(None,), batch=False, clamped=False, threshold=True, records=None):
+    """Create a Brian simulator for a short step protocol on a small group of
+    leaky integrate-and-fire neurons (or voltage-clamped opsins)"""
+    br = pytest.importorskip('brian2.only')
+    br.prefs.codegen.target = 'numpy' # Nothing to gain from compiling such short runs
+    params = copy.deepcopy(pr.simParams['Brian'])
+    params['batch'].value = batch
+    Prot = pr.protocols['step'](saveData=False)
+    Prot.phis, Prot.Vs, Prot.cycles = list(phis), list(Vs), [[20., 10.]] # Sorted in place by prepare
+    RhO = pr.models['3']()
+    if batch:
+        return pr.simulators['Brian'](Prot, RhO, params)
+
+    netParams = {'tau_m': 10*br.ms, 'R_m': 70*br.Mohm, 'E_m': -70*br.mV, 'v_t0': -50*br.mV, 't_ref': 4*br.ms}
+    if clamped: # The clamped current is calculated from the recorded states
+        G = br.NeuronGroup(4, RhO.brian_phi_t + '\nv : volt (constant)', name='Inputs')
+    else:
+        eqs = 'dv/dt = ((-I*R_m)+E_m-v)/tau_m : volt' + RhO.brian_phi_t
+        spiking = {'threshold': 'v>v_t0', 'reset': 'v=E_m', 'refractory': 't_ref'} if threshold else {}
+        G = br.NeuronGroup(4, eqs, namespace=netParams, name='Inputs', **spiking)
+    G.v = -70*br.mV + np.arange(4)*br.mV # Distinct neurons
+    return pr.simulators['Brian'](Prot, RhO, params, br.Network(G), netParams, records=records)
+
+
+def test_brian_batch_matches_per_trial_simulation():
+    Vs = [-70, 10]
+    batchPD = brianSimulator(Vs=Vs, batch=True).run(verbose=0)
+    trialPD = brianSimulator(Vs=Vs, clamped=True).run(verbose=0)
+    for run, phiInd, vInd in np.ndindex(batchPD.nRuns, batchPD.nPhis, batchPD.nVs):
+        batch = batchPD.trials[run][phiInd][vInd]
+        trial = trialPD.trials[run][phiInd][vInd]
+        np.testing.assert_allclose(batch.t, trial.t)
+        np.testing.assert_allclose(batch.I, trial.I, rtol=1e-9, atol=1e-12)
+        np.testing.assert_array_equal(batch.pulseInds, trial.pulseInds)
+
+
+def test_brian_batch_refuses_unclamped_protocols():
+    Sim = brianSimulator(Vs=[None], batch=True)
+    with pytest.raises(ValueError, match='unclamped'):
+        Sim.run(verbose=0)
+
+
+def test_brian_builds_one_timed_array_per_waveform(monkeypatch):
+    Sim = brianSimulator(Vs=[-70, 10], clamped=True)
+    built = []
+    TimedArray = Sim.br.TimedArray
+    def countingTimedArray(*args, **kwargs):
+        built.append(TimedArray(*args, **kwargs))
+        return built[-1]
+    monkeypatch.setattr(Sim.br, 'TimedArray', countingTimedArray)
+
+    PD = Sim.run(verbose=0)
+    assert len(built) == PD.nRuns * PD.nPhis # Reused across the clamp voltages
+    assert sorted(Sim.stimCache) == [(run, phiInd) for run in range(PD.nRuns) for phiInd in range(PD.nPhis)]
+    assert Sim.namespace['phi'] is Sim.stimCache[PD.nRuns-1, PD.nPhis-1]
+    for run, phiInd in Sim.stimCache:
+        stim = Sim.Prot.getStimArray(run, phiInd, Sim.dt)
+        np.testing.assert_array_equal(Sim.stimCache[run, phiInd].values, np.asarray(stim * pr.parameters.modelUnits['phi_m']))
+
+
+### Brian monitors
+
+def test_brian_recDt_decimates_the_monitors():
+    br = pytest.importorskip('brian2.only')
+    Sim = brianSimulator(phis=[1e17], records={'recDt': 0.5})
+    PD = Sim.run(verbose=0)
+    for key in ['states', 'I', 'V']:
+        np.testing.assert_allclose(np.diff(Sim.monitors[key].t/br.ms), 0.5)
+    pc = PD.trials[0][0][0]
+    np.testing.assert_allclose(np.diff(pc.t), 0.5)
+    assert len(pc.t) == int(round((pc.t[-1] - pc.t[0]) / 0.5)) + 1 # Five times fewer samples than dt=0.1
+
+
+def test_brian_records_every_index():
+    br = pytest.importorskip('brian2.only')
+    Sim = brianSimulator(phis=[1e17], records={'record': [1, 3]})
+    PD = Sim.run(verbose=0)
+    for key, var in [('states', 'O'), ('I', 'I'), ('V', 'v')]:
+        assert list(Sim.monitors[key].record) == [1, 3]
+        assert getattr(Sim.monitors[key], var).shape[0] == 2
+    # The neurons start at different voltages (the opsin states do not depend on them)
+    assert not np.allclose(Sim.monitors['I'].I[0]/br.nA, Sim.monitors['I'].I[1]/br.nA)
+    # The photocurrent is taken from the first recorded neuron
+    pc = PD.trials[0][0][0]
+    np.testing.assert_allclose(pc.I, Sim.monitors['I'].I[0]/br.nA)
+
+
+def test_brian_summary_records_the_mean_current_and_rate():
+    br = pytest.importorskip('brian2.only')
+    Sim = brianSimulator(phis=[1e17], records={'summary': True})
+    PD = Sim.run(verbose=0)
+    assert 'I' not in Sim.monitors and {'Imean', 'rate'} <= set(Sim.monitors)
+    rates = Sim.rates[0][0][0]
+    assert len(rates['t']) == len(rates['rate']) and np.any(rates['rate'] > 0)
+
+    full = brianSimulator(phis=[1e17], records={'record': True})
+    full.run(verbose=0)
+    np.testing.assert_allclose(Sim.monitors['Imean'].Imean[0]/br.nA, np.mean(full.monitors['I'].I/br.nA, axis=0), rtol=1e-9)
+    np.testing.assert_allclose(PD.trials[0][0][0].I, Sim.monitors['Imean'].Imean[0]/br.nA)
+
+
+@pytest.mark.parametrize('threshold, spikes', [(True, True), (True, False), (False, True)])
+def test_brian_records_spikes_of_spiking_groups(threshold, spikes):
+    Sim = brianSimulator(phis=[1e17], threshold=threshold, records={'spikes': spikes, 'states': False, 'voltage': False})
+    Sim.run(verbose=0)
+    assert set(Sim.monitors) == {'spikes', 'I'}
+    rasters = Sim.rasters[0][0][0]
+    if threshold and spikes:
+        assert [raster['name'] for raster in rasters] == ['Inputs_spikes']
+        assert rasters[0]['n'] == 4 and len(rasters[0]['t']) == len(rasters[0]['i']) > 0
+    else:
+        assert rasters == []
+
+
+### Adaptive output grids
+
+def pythonSimulation(protocol, **simValues):
+    """Simulate a protocol for the 6-state model with the Python simulator"""
+    params = copy.deepcopy(pr.simParams['Python'])
+    for name, value in simValues.items():
+        params[name].value = value
+    Prot = pr.protocols[protocol](saveData=False)
+    Sim = pr.simulators['Python'](Prot, pr.models['6'](), params)
+    return Sim.run(verbose=0)
+
+
+def test_adaptive_grid_shrinks_the_output_and_keeps_the_features():
+    uniform = pythonSimulation('step', dt=0.01)
+    adaptive = pythonSimulation('step', dt=0.01, adaptive=True)
+    for run, phiInd, vInd in np.ndindex(uniform.nRuns, uniform.nPhis, uniform.nVs):
+        pcU, pcA = uniform.trials[run][phiInd][vInd], adaptive.trials[run][phiInd][vInd]
+        assert pcU.uniform and not pcA.uniform
+        assert pcU.nSamples > 50 * pcA.nSamples
+        np.testing.assert_allclose(pcA.t[pcA.pulseInds], pcU.t[pcU.pulseInds]) # Light transitions are sampled
+        assert np.isclose(pcA.peak_, pcU.peak_, rtol=1e-3)
+        assert abs(pcA.tpeak_ - pcU.tpeak_) < 0.1
+        assert np.isclose(pcA.ss_, pcU.ss_, rtol=1e-3)
+
+
+def test_steady_states_of_non_uniform_grids_are_time_weighted():
+    # Dense samples crowd the start of the tail, where a sample mean would be biased towards
+    t = np.r_[np.linspace(0, 90, 91), np.linspace(90.01, 95, 500), np.linspace(96, 100, 5), np.linspace(101, 150, 49)]
+    I = -t / 100
+    pc = PhotoCurrent(I, t, np.array([[0., 100.]]), 1e17, -70)
+    assert not pc.uniform
+    tail = (t >= 90) & (t <= 100)
+    assert np.isclose(pc.findSteadyState(0, tail=0.1), -0.95) # The mean over the last 10% of the on-phase
+    assert not np.isclose(np.mean(I[tail]), -0.95, rtol=1e-2)
+
+
+def test_adaptive_grid_is_not_used_for_functions_of_time():
+    uniform = pythonSimulation('sinusoid')
+    adaptive = pythonSimulation('sinusoid', adaptive=True)
+    for run, phiInd, vInd in np.ndindex(uniform.nRuns, uniform.nPhis, uniform.nVs):
+        pcU, pcA = uniform.trials[run][phiInd][vInd], adaptive.trials[run][phiInd][vInd]
+        assert pcA.uniform
+        np.testing.assert_array_equal(pcA.t, pcU.t)
+        np.testing.assert_allclose(pcA.I, pcU.I)